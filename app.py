@@ -4,16 +4,28 @@ import json
 import uuid
 import requests
 import secrets
+import shutil
+import tempfile
 import time
-import telebot
+import threading
 import telegram
-from flask import Flask, render_template, jsonify, request, send_from_directory
+from flask import Flask, render_template, jsonify, request, send_from_directory, g, has_app_context
 from flask_cors import CORS
 import base64
+import click
+import collections
+import csv
+import hashlib
+import io
+from contextlib import contextmanager
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 import math
-from datetime import datetime
+import re
+import weakref
+from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 
 app = Flask(__name__,
             template_folder='webapp/templates',
@@ -23,14 +35,18 @@ CORS(app)
 # ========== КОНФИГУРАЦИЯ ==========
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
 app.config['DATABASE'] = 'shop.db'
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 8))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+app.config['DB_BUSY_TIMEOUT_MS'] = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+app.config['DB_CACHE_SIZE_KB'] = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+app.config['DB_MMAP_SIZE'] = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+app.config['QUOTE_TTL_SECONDS'] = int(os.environ.get('QUOTE_TTL_SECONDS', 900))
+app.config['DELIVERY_COST'] = float(os.environ.get('DELIVERY_COST', 100))
+app.config['FREE_DELIVERY_THRESHOLD'] = float(os.environ.get('FREE_DELIVERY_THRESHOLD', 1000))
 app.config['UPLOAD_FOLDER'] = 'webapp/static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024
 API_KEY = os.environ.get('API_KEY', secrets.token_hex(32))
 
-# ========== КОНФИГУРАЦИЯ ДЛЯ TELEGRAM БОТА ==========
-TELEGRAM_BOT_TOKEN = os.getenv('BOT_TOKEN')
-TELEGRAM_BOT = telebot.TeleBot(TELEGRAM_BOT_TOKEN) if TELEGRAM_BOT_TOKEN else None
-
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
 # Создаем папку для загрузок если её нет
@@ -40,9 +56,7 @@ if not os.path.exists(UPLOAD_PATH):
 
 
 def get_db_connection():
-    conn = sqlite3.connect('shop.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return get_db()
 
 
 # ========== ХЕЛПЕР ДЛЯ БЕЗОПАСНЫХ ЗАПРОСОВ ==========
@@ -109,12 +123,244 @@ def allowed_file(filename):
 
 
 # ========== БАЗА ДАННЫХ ==========
+class PooledConnection:
+    """Соединение из пула: close() не закрывает файл, а возвращает соединение в пул"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        # Обертку потеряли без close() (поток/фоновая задача вне запроса) - слот вернет сборщик мусора
+        self._finalizer = weakref.finalize(self, pool.reclaim, conn)
+        self._finalizer.atexit = False
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    @property
+    def closed(self):
+        return self._conn is None
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        self._finalizer.detach()
+        self._pool.release(conn)
+
+
+class SQLitePool:
+    """Пул соединений SQLite на процесс воркера (WAL + настроенные PRAGMA)"""
+
+    def __init__(self, database, size=8, timeout=5.0, busy_timeout_ms=5000,
+                 cache_size_kb=16384, mmap_size=256 * 1024 * 1024):
+        self.database = database
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.pragmas = [
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('cache_size', -abs(cache_size_kb)),
+            ('mmap_size', mmap_size),
+            ('busy_timeout', busy_timeout_ms),
+            ('temp_store', 'MEMORY'),
+        ]
+        self._busy_timeout = busy_timeout_ms / 1000.0
+        self._cond = threading.Condition()
+        self._idle = []
+        self._in_use = 0
+        self._orphans = collections.deque()
+        self._pid = os.getpid()
+        self._stats = {
+            'created': 0,
+            'reclaimed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'overflow': 0,
+            'peak_in_use': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=self._busy_timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas:
+            conn.execute(f'PRAGMA {name} = {value}')
+        self._stats['created'] += 1
+        return conn
+
+    def _check_fork(self):
+        # После fork() gunicorn соединения родителя использовать нельзя - просто забываем их
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._in_use = 0
+            self._orphans.clear()
+
+    def reclaim(self, conn):
+        """Финализатор PooledConnection: только ставит соединение в очередь.
+
+        Может сработать внутри acquire()/release() того же потока, поэтому
+        под замком пула ничего не делает; очередь разбирает _drain_orphans().
+        """
+        self._orphans.append((os.getpid(), conn))
+
+    def _drain_orphans(self):
+        # Вызывается под self._cond
+        while self._orphans:
+            pid, conn = self._orphans.popleft()
+            if pid != self._pid:
+                continue
+            self._stats['reclaimed'] += 1
+            self._in_use = max(0, self._in_use - 1)
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                conn = None
+            if conn is not None and len(self._idle) < self.size:
+                self._idle.append(conn)
+            elif conn is not None:
+                conn.close()
+
+    def acquire(self):
+        started = time.monotonic()
+        waited = False
+        with self._cond:
+            self._check_fork()
+            self._drain_orphans()
+            while not self._idle and self._in_use >= self.size:
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    break
+                waited = True
+                self._cond.wait(remaining)
+                self._drain_orphans()
+
+            wait_time = time.monotonic() - started
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['wait_time_total'] += wait_time
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+
+            conn = self._idle.pop() if self._idle else None
+            if conn is None and self._in_use >= self.size:
+                # Пул исчерпан: отдаем временное соединение вместо ошибки
+                self._stats['timeouts'] += 1
+                self._stats['overflow'] += 1
+            self._in_use += 1
+            self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._in_use)
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            conn = None
+
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._drain_orphans()
+            self._in_use = max(0, self._in_use - 1)
+            if conn is not None and len(self._idle) < self.size:
+                self._idle.append(conn)
+                conn = None
+            self._cond.notify()
+
+        if conn is not None:
+            conn.close()
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def stats(self):
+        with self._cond:
+            result = dict(self._stats)
+            result['size'] = self.size
+            result['in_use'] = self._in_use
+            result['idle'] = len(self._idle)
+            result['pid'] = self._pid
+        result['wait_time_avg_ms'] = round(result['wait_time_total'] / result['waits'] * 1000, 3) \
+            if result['waits'] else 0.0
+        result['wait_time_total_ms'] = round(result.pop('wait_time_total') * 1000, 3)
+        result['wait_time_max_ms'] = round(result.pop('wait_time_max') * 1000, 3)
+        return result
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    global _db_pool
+    database = app.config['DATABASE']
+    if _db_pool is None or _db_pool.database != database:
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool.database != database:
+                old_pool = _db_pool
+                _db_pool = SQLitePool(
+                    database,
+                    size=app.config['DB_POOL_SIZE'],
+                    timeout=app.config['DB_POOL_TIMEOUT'],
+                    busy_timeout_ms=app.config['DB_BUSY_TIMEOUT_MS'],
+                    cache_size_kb=app.config['DB_CACHE_SIZE_KB'],
+                    mmap_size=app.config['DB_MMAP_SIZE']
+                )
+                if old_pool:
+                    old_pool.close_all()
+    return _db_pool
+
+
 def get_db():
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.row_factory = sqlite3.Row
+    """Взять соединение из пула; внутри запроса оно будет возвращено в пул при teardown"""
+    conn = get_db_pool().acquire()
+    if has_app_context():
+        g.setdefault('_db_connections', []).append(conn)
     return conn
 
 
+@app.teardown_appcontext
+def release_db_connections(exception=None):
+    """Вернуть в пул соединения, которые обработчик забыл закрыть"""
+    for conn in g.pop('_db_connections', []):
+        conn.close()
+
+
 def init_db():
     with app.app_context():
         db = get_db()
@@ -1022,6 +1268,1215 @@ def init_security():
 init_security()
 
 
+# ========== МИГРАЦИИ СХЕМЫ ==========
+def migration_hot_path_indexes(db):
+    """Индексы под горячие запросы заказов, чатов и логинов"""
+    # Дубликаты назначений мешают уникальному индексу - оставляем самое раннее
+    db.execute('''
+               DELETE
+               FROM order_assignments
+               WHERE id NOT IN (SELECT MIN(id) FROM order_assignments GROUP BY order_id)
+               ''')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_order_assignments_order_id ON order_assignments (order_id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_order_assignments_courier_status '
+               'ON order_assignments (courier_id, status)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_created_at ON orders (status, created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_id_created_at ON orders (user_id, created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_chat_messages_order_created_at ON chat_messages (order_id, created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_failed_logins_ip_time ON failed_logins (ip_address, attempt_time)')
+
+
+def migration_notification_outbox(db):
+    """pending_notifications становится очередью исходящих уведомлений (outbox)"""
+    db.execute('ALTER TABLE pending_notifications ADD COLUMN kind TEXT')
+    db.execute('ALTER TABLE pending_notifications ADD COLUMN payload TEXT')
+    db.execute('ALTER TABLE pending_notifications ADD COLUMN attempts INTEGER DEFAULT 0')
+    db.execute('ALTER TABLE pending_notifications ADD COLUMN enqueued_at REAL')
+    db.execute('ALTER TABLE pending_notifications ADD COLUMN available_at REAL')
+    db.execute('ALTER TABLE pending_notifications ADD COLUMN claimed_at REAL')
+    db.execute('ALTER TABLE pending_notifications ADD COLUMN sent_at REAL')
+    db.execute('ALTER TABLE pending_notifications ADD COLUMN last_error TEXT')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_pending_notifications_queue '
+               'ON pending_notifications (sent, available_at)')
+
+
+def migration_cache_versions(db):
+    """Общие для всех воркеров номера версий кэшей"""
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS cache_versions
+               (
+                   name       TEXT PRIMARY KEY,
+                   version    INTEGER NOT NULL DEFAULT 0,
+                   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               )
+               ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_discounts_active ON discounts (is_active, apply_to)')
+
+
+# Текст для FTS: unicode61 складывает регистр кириллицы, но не 'ё' -> 'е'
+FTS_TEXT_SQL = "replace(replace(coalesce({0}, ''), 'ё', 'е'), 'Ё', 'Е')"
+FTS_CATEGORY_SQL = ("coalesce(nullif(new.category, ''), "
+                    "(SELECT name FROM product_categories WHERE id = new.category_id))")
+
+
+def migration_products_fts(db):
+    """Полнотекстовый индекс товаров (название, описание, категория) с триггерами синхронизации"""
+    db.execute('''
+               CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+                   name, description, category,
+                   tokenize = 'unicode61 remove_diacritics 2',
+                   prefix = '2 3'
+               )
+               ''')
+
+    values = ', '.join([
+        'new.id',
+        FTS_TEXT_SQL.format('new.name'),
+        FTS_TEXT_SQL.format('new.description'),
+        FTS_TEXT_SQL.format(FTS_CATEGORY_SQL)
+    ])
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products
+               BEGIN
+                   INSERT INTO products_fts (rowid, name, description, category) VALUES ({values});
+               END
+               ''')
+    # Остатки и цены меняются часто - индекс трогаем только при смене текстовых полей
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS products_fts_update
+                   AFTER UPDATE OF name, description, category, category_id ON products
+               BEGIN
+                   DELETE FROM products_fts WHERE rowid = old.id;
+                   INSERT INTO products_fts (rowid, name, description, category) VALUES ({values});
+               END
+               ''')
+    db.execute('''
+               CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products
+               BEGIN
+                   DELETE FROM products_fts WHERE rowid = old.id;
+               END
+               ''')
+
+    db.execute('DELETE FROM products_fts')
+    db.execute(f'''
+               INSERT INTO products_fts (rowid, name, description, category)
+               SELECT p.id, {FTS_TEXT_SQL.format('p.name')}, {FTS_TEXT_SQL.format('p.description')},
+                      {FTS_TEXT_SQL.format("coalesce(nullif(p.category, ''), pc.name)")}
+               FROM products p
+                        LEFT JOIN product_categories pc ON pc.id = p.category_id
+               ''')
+
+
+# Условие "в наличии" - в том же виде, что и у частичного индекса idx_products_in_stock_created;
+# {p} - префикс таблицы в запросе ('p.' или '')
+PRODUCTS_IN_STOCK_SQL = ("(({p}product_type = 'piece' AND {p}stock > 0) "
+                         "OR ({p}product_type = 'weight' AND {p}stock_weight > 0))")
+
+# Цена, которую показывает каталог: за кг у весовых товаров, иначе за штуку
+PRODUCTS_DISPLAY_PRICE_SQL = ("(CASE WHEN {p}product_type = 'weight' AND {p}price_per_kg > 0 "
+                              "THEN {p}price_per_kg ELSE {p}price END)")
+
+
+def migration_products_keyset_indexes(db):
+    """Индексы под keyset-пагинацию товаров по (created_at, id) и фильтры каталога"""
+    db.execute('CREATE INDEX IF NOT EXISTS idx_products_created_id ON products (created_at, id)')
+    db.execute(f'CREATE INDEX IF NOT EXISTS idx_products_in_stock_created ON products (created_at, id) '
+               f"WHERE {PRODUCTS_IN_STOCK_SQL.format(p='')}")
+    db.execute('CREATE INDEX IF NOT EXISTS idx_products_category_created ON products (category, created_at, id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_products_category_id_created '
+               'ON products (category_id, created_at, id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_products_type_created ON products (product_type, created_at, id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_products_price ON products (price)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_product_categories_parent ON product_categories (parent_id)')
+
+
+def migration_product_prices(db):
+    """Материализованные цены со скидками; триггеры помечают строку устаревшей при смене цены или категории"""
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS product_prices
+               (
+                   product_id          INTEGER PRIMARY KEY,
+                   base_price          REAL,
+                   final_price         REAL,
+                   discount_amount     REAL    DEFAULT 0,
+                   discount_percentage REAL    DEFAULT 0,
+                   discount_id         INTEGER,
+                   stale               INTEGER DEFAULT 1,
+                   computed_at         REAL
+               )
+               ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_product_prices_stale ON product_prices (product_id) WHERE stale = 1')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_product_prices_discount ON product_prices (discount_id)')
+
+    db.execute('''
+               CREATE TRIGGER IF NOT EXISTS product_prices_insert AFTER INSERT ON products
+               BEGIN
+                   INSERT OR REPLACE INTO product_prices (product_id, stale) VALUES (new.id, 1);
+               END
+               ''')
+    db.execute('''
+               CREATE TRIGGER IF NOT EXISTS product_prices_update
+                   AFTER UPDATE OF price, price_per_kg, product_type, category, category_id ON products
+               BEGIN
+                   UPDATE product_prices SET stale = 1 WHERE product_id = new.id;
+               END
+               ''')
+    db.execute('''
+               CREATE TRIGGER IF NOT EXISTS product_prices_delete AFTER DELETE ON products
+               BEGIN
+                   DELETE FROM product_prices WHERE product_id = old.id;
+               END
+               ''')
+
+    db.execute('INSERT OR IGNORE INTO product_prices (product_id, stale) SELECT id, 1 FROM products')
+
+
+def migration_promo_code_batches(db):
+    """Пакеты массово сгенерированных промокодов; batch_id связывает коды с пакетом для выгрузки в CSV"""
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS promo_code_batches
+               (
+                   id               INTEGER PRIMARY KEY AUTOINCREMENT,
+                   prefix           TEXT,
+                   alphabet         TEXT    NOT NULL,
+                   code_length      INTEGER NOT NULL,
+                   requested        INTEGER NOT NULL,
+                   created          INTEGER   DEFAULT 0,
+                   status           TEXT      DEFAULT 'running',
+                   discount_type    TEXT,
+                   value            DECIMAL(10, 2),
+                   usage_limit      INTEGER,
+                   min_order_amount DECIMAL(10, 2) DEFAULT 0,
+                   start_date       TIMESTAMP,
+                   end_date         TIMESTAMP,
+                   created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   finished_at      TIMESTAMP
+               )
+               ''')
+    columns = {row['name'] for row in db.execute('PRAGMA table_info(promo_codes)').fetchall()}
+    if 'batch_id' not in columns:
+        db.execute('ALTER TABLE promo_codes ADD COLUMN batch_id INTEGER')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_promo_codes_batch ON promo_codes (batch_id, id)')
+
+
+def migration_inventory_ledger(db):
+    """Журнал движений склада: удержания остатков под заказы"""
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS inventory_ledger
+               (
+                   id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                   order_id   INTEGER,
+                   product_id INTEGER NOT NULL,
+                   kind       TEXT    NOT NULL,
+                   quantity   REAL    NOT NULL,
+                   unit       TEXT    NOT NULL,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               )
+               ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_inventory_ledger_order ON inventory_ledger (order_id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_inventory_ledger_product ON inventory_ledger (product_id, id)')
+
+
+def migration_idempotency_keys(db):
+    """Ключи идемпотентности запросов с сохраненным ответом и сроком хранения"""
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS idempotency_keys
+               (
+                   key             TEXT PRIMARY KEY,
+                   status          TEXT NOT NULL,
+                   response_status INTEGER,
+                   response_body   TEXT,
+                   locked_at       REAL,
+                   created_at      REAL,
+                   expires_at      REAL NOT NULL
+               )
+               ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)')
+
+
+def migration_order_items(db):
+    """Позиции заказов отдельной таблицей; исторические заказы переносит команда backfill-order-items"""
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS order_items
+               (
+                   id             INTEGER PRIMARY KEY AUTOINCREMENT,
+                   order_id       INTEGER NOT NULL,
+                   position       INTEGER NOT NULL,
+                   product_id     INTEGER,
+                   name           TEXT,
+                   quantity       INTEGER NOT NULL DEFAULT 1,
+                   weight         REAL,
+                   is_weight      INTEGER NOT NULL DEFAULT 0,
+                   unit_price     REAL    NOT NULL DEFAULT 0,
+                   original_price REAL,
+                   line_total     REAL    NOT NULL DEFAULT 0
+               )
+               ''')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id, position)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items (product_id, order_id)')
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS backfill_progress
+               (
+                   name       TEXT PRIMARY KEY,
+                   last_id    INTEGER   DEFAULT 0,
+                   done       INTEGER   DEFAULT 0,
+                   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               )
+               ''')
+
+
+# Поле JSON orders.delivery_address -> колонка orders.address_<поле>
+ORDER_ADDRESS_FIELDS = ['city', 'street', 'house', 'building', 'entrance', 'apartment', 'floor', 'doorcode',
+                        'comment', 'recipient_name', 'phone']
+
+
+def migration_order_address_columns(db):
+    """Части адреса доставки генерируемыми колонками с индексом по городу/улице/дому.
+
+    VIRTUAL-колонки заполняются SQLite сами при любой записи и для старых заказов;
+    json_valid защищает от заказов, где в delivery_address лежит не JSON
+    """
+    columns = {row['name'] for row in db.execute('PRAGMA table_xinfo(orders)').fetchall()}
+    for field in ORDER_ADDRESS_FIELDS:
+        if f'address_{field}' in columns:
+            continue
+        db.execute(f'''
+                   ALTER TABLE orders ADD COLUMN address_{field} TEXT
+                       GENERATED ALWAYS AS (CASE
+                                                WHEN json_valid(delivery_address)
+                                                    THEN json_extract(delivery_address, '$.{field}') END) VIRTUAL
+                   ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_address ON orders (address_city, address_street, address_house)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_address_status ON orders (address_city, status, created_at)')
+
+
+def order_address_columns(delivery_address):
+    """delivery_address (dict или JSON-строка) -> {'address_<поле>': значение} для записи в orders"""
+    if isinstance(delivery_address, str):
+        try:
+            delivery_address = json.loads(delivery_address)
+        except ValueError:
+            delivery_address = None
+    if not isinstance(delivery_address, dict):
+        delivery_address = {}
+    return {f'address_{field}': delivery_address.get(field) for field in ORDER_ADDRESS_FIELDS}
+
+
+def rebuild_shop_counters(db):
+    """Пересчитать shop_counters/shop_customers по orders и products (в транзакции вызывающего).
+
+    Возвращает расхождения {счетчик: (было, стало)}
+    """
+    before = {row['name']: row['value'] for row in db.execute('SELECT name, value FROM shop_counters').fetchall()}
+
+    db.execute('DELETE FROM shop_customers')
+    db.execute('''
+               INSERT INTO shop_customers (user_id, orders)
+               SELECT user_id, COUNT(*)
+               FROM orders
+               WHERE user_id IS NOT NULL
+               GROUP BY user_id
+               ''')
+    db.execute('DELETE FROM shop_counters')
+    db.execute('''
+               INSERT INTO shop_counters (name, value)
+               SELECT 'orders', COUNT(*)
+               FROM orders
+               UNION ALL
+               SELECT 'revenue', COALESCE(SUM(total_price), 0)
+               FROM orders
+               UNION ALL
+               SELECT 'customers', COUNT(*)
+               FROM shop_customers
+               UNION ALL
+               SELECT 'products', COUNT(*)
+               FROM products
+               UNION ALL
+               SELECT 'status:' || COALESCE(status, ''), COUNT(*)
+               FROM orders
+               GROUP BY status
+               ''')
+
+    after = {row['name']: row['value'] for row in db.execute('SELECT name, value FROM shop_counters').fetchall()}
+    return {name: (before.get(name, 0), after.get(name, 0))
+            for name in sorted(set(before) | set(after))
+            if round(before.get(name, 0) or 0, 2) != round(after.get(name, 0) or 0, 2)}
+
+
+def migration_shop_counters(db):
+    """Счетчики дашборда, которые триггеры обновляют в транзакции каждой записи в orders/products"""
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS shop_counters
+               (
+                   name  TEXT PRIMARY KEY,
+                   value REAL NOT NULL DEFAULT 0
+               )
+               ''')
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS shop_customers
+               (
+                   user_id INTEGER PRIMARY KEY,
+                   orders  INTEGER NOT NULL DEFAULT 0
+               )
+               ''')
+
+    bump = '''
+           INSERT INTO shop_counters (name, value)
+           VALUES ({name}, {delta})
+           ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+           '''
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS shop_counters_order_insert AFTER INSERT ON orders
+               BEGIN
+                   {bump.format(name="'orders'", delta='1')}
+                   {bump.format(name="'revenue'", delta='COALESCE(new.total_price, 0)')}
+                   {bump.format(name="'status:' || COALESCE(new.status, '')", delta='1')}
+               END
+               ''')
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS shop_counters_order_status
+                   AFTER UPDATE OF status ON orders
+                   WHEN old.status IS NOT new.status
+               BEGIN
+                   {bump.format(name="'status:' || COALESCE(old.status, '')", delta='-1')}
+                   {bump.format(name="'status:' || COALESCE(new.status, '')", delta='1')}
+               END
+               ''')
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS shop_counters_order_total
+                   AFTER UPDATE OF total_price ON orders
+                   WHEN old.total_price IS NOT new.total_price
+               BEGIN
+                   {bump.format(name="'revenue'", delta='COALESCE(new.total_price, 0) - COALESCE(old.total_price, 0)')}
+               END
+               ''')
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS shop_counters_order_delete AFTER DELETE ON orders
+               BEGIN
+                   {bump.format(name="'orders'", delta='-1')}
+                   {bump.format(name="'revenue'", delta='-COALESCE(old.total_price, 0)')}
+                   {bump.format(name="'status:' || COALESCE(old.status, '')", delta='-1')}
+               END
+               ''')
+
+    # Уникальные покупатели: shop_customers хранит число заказов каждого, счетчик меняется на первом/последнем
+    db.execute('''
+               CREATE TRIGGER IF NOT EXISTS shop_customers_order_insert
+                   AFTER INSERT ON orders
+                   WHEN new.user_id IS NOT NULL
+               BEGIN
+                   INSERT INTO shop_counters (name, value)
+                   SELECT 'customers', 1
+                   WHERE NOT EXISTS (SELECT 1 FROM shop_customers WHERE user_id = new.user_id)
+                   ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                   INSERT INTO shop_customers (user_id, orders)
+                   VALUES (new.user_id, 1)
+                   ON CONFLICT(user_id) DO UPDATE SET orders = orders + 1;
+               END
+               ''')
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS shop_customers_order_delete
+                   AFTER DELETE ON orders
+                   WHEN old.user_id IS NOT NULL
+               BEGIN
+                   UPDATE shop_customers SET orders = orders - 1 WHERE user_id = old.user_id;
+                   INSERT INTO shop_counters (name, value)
+                   SELECT 'customers', -1
+                   WHERE EXISTS (SELECT 1 FROM shop_customers WHERE user_id = old.user_id AND orders <= 0)
+                   ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+                   DELETE FROM shop_customers WHERE user_id = old.user_id AND orders <= 0;
+               END
+               ''')
+
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS shop_counters_product_insert AFTER INSERT ON products
+               BEGIN
+                   {bump.format(name="'products'", delta='1')}
+               END
+               ''')
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS shop_counters_product_delete AFTER DELETE ON products
+               BEGIN
+                   {bump.format(name="'products'", delta='-1')}
+               END
+               ''')
+
+    rebuild_shop_counters(db)
+
+
+# Гранулярности роллапов продаж: имя -> выражение бакета по created_at (UTC, как CURRENT_TIMESTAMP)
+SALES_ROLLUP_GRAINS = {
+    'hour': "strftime('%Y-%m-%d %H:00:00', {created_at})",
+    'day': "date({created_at})"
+}
+
+
+# Заказ создан после миграции - его учитывают триггеры, а не backfill
+SALES_ROLLUP_NEW_ORDER_SQL = "{order_id} > (SELECT last_id FROM backfill_progress WHERE name = 'sales_rollups_target')"
+# Изменения учитываем для заказов, уже попавших в роллапы: новых и перенесенных backfill
+SALES_ROLLUP_COUNTED_ORDER_SQL = ("(" + SALES_ROLLUP_NEW_ORDER_SQL + " OR {order_id} <= "
+                                  "(SELECT last_id FROM backfill_progress WHERE name = 'sales_rollups'))")
+
+
+def sales_rollup_order_sql(order, sign):
+    """UPSERT вклада заказа order ('new'/'old') со знаком sign во все гранулярности sales_rollups"""
+    statements = []
+    for grain, bucket in SALES_ROLLUP_GRAINS.items():
+        statements.append(f'''
+            INSERT INTO sales_rollups (grain, bucket, delivery_type, payment_method, pickup_point,
+                                       orders, revenue, discount)
+            VALUES ('{grain}', {bucket.format(created_at=f'{order}.created_at')},
+                    COALESCE({order}.delivery_type, ''), COALESCE({order}.payment_method, ''),
+                    COALESCE({order}.pickup_point, ''),
+                    {sign}1, {sign}COALESCE({order}.total_price, 0), {sign}COALESCE({order}.discount_amount, 0))
+            ON CONFLICT(grain, bucket, delivery_type, payment_method, pickup_point)
+                DO UPDATE SET orders   = orders + excluded.orders,
+                              revenue  = revenue + excluded.revenue,
+                              discount = discount + excluded.discount;
+        ''')
+    return ''.join(statements)
+
+
+def sales_rollup_items_sql(created_at, sign, where):
+    """UPSERT вклада позиций order_items (условие where) со знаком sign во все гранулярности category_sales_rollups"""
+    statements = []
+    for grain, bucket in SALES_ROLLUP_GRAINS.items():
+        statements.append(f'''
+            INSERT INTO category_sales_rollups (grain, bucket, category, lines, quantity, weight, revenue)
+            SELECT '{grain}', {bucket.format(created_at=created_at)}, COALESCE(p.category, ''),
+                   {sign}COUNT(*), {sign}SUM(CASE WHEN oi.is_weight THEN 0 ELSE oi.quantity END),
+                   {sign}SUM(CASE WHEN oi.is_weight THEN COALESCE(oi.weight, 0) * oi.quantity ELSE 0 END),
+                   {sign}SUM(oi.line_total)
+            FROM order_items oi
+                     LEFT JOIN products p ON p.id = oi.product_id
+            WHERE {where}
+            GROUP BY COALESCE(p.category, '')
+            ON CONFLICT(grain, bucket, category)
+                DO UPDATE SET lines    = lines + excluded.lines,
+                              quantity = quantity + excluded.quantity,
+                              weight   = weight + excluded.weight,
+                              revenue  = revenue + excluded.revenue;
+        ''')
+    return ''.join(statements)
+
+
+def migration_sales_rollups(db):
+    """Часовые и дневные роллапы продаж; новые заказы учитывают триггеры, историю - backfill-sales-rollups"""
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS sales_rollups
+               (
+                   grain          TEXT    NOT NULL,
+                   bucket         TEXT    NOT NULL,
+                   delivery_type  TEXT    NOT NULL DEFAULT '',
+                   payment_method TEXT    NOT NULL DEFAULT '',
+                   pickup_point   TEXT    NOT NULL DEFAULT '',
+                   orders         INTEGER NOT NULL DEFAULT 0,
+                   revenue        REAL    NOT NULL DEFAULT 0,
+                   discount       REAL    NOT NULL DEFAULT 0,
+                   PRIMARY KEY (grain, bucket, delivery_type, payment_method, pickup_point)
+               )
+               ''')
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS category_sales_rollups
+               (
+                   grain    TEXT    NOT NULL,
+                   bucket   TEXT    NOT NULL,
+                   category TEXT    NOT NULL DEFAULT '',
+                   lines    INTEGER NOT NULL DEFAULT 0,
+                   quantity INTEGER NOT NULL DEFAULT 0,
+                   weight   REAL    NOT NULL DEFAULT 0,
+                   revenue  REAL    NOT NULL DEFAULT 0,
+                   PRIMARY KEY (grain, bucket, category)
+               )
+               ''')
+
+    # Заказы с id <= last_id этой записи - история, ее переносит backfill; более новые считают триггеры
+    db.execute('''
+               INSERT OR REPLACE INTO backfill_progress (name, last_id, done)
+               VALUES ('sales_rollups_target', (SELECT COALESCE(MAX(id), 0) FROM orders), 0)
+               ''')
+    db.execute("INSERT OR REPLACE INTO backfill_progress (name, last_id, done) VALUES ('sales_rollups', 0, 0)")
+    new_order = SALES_ROLLUP_NEW_ORDER_SQL
+    counted_order = SALES_ROLLUP_COUNTED_ORDER_SQL
+
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS sales_rollups_order_insert
+                   AFTER INSERT ON orders
+                   WHEN COALESCE(new.status, '') != 'cancelled' AND {new_order.format(order_id='new.id')}
+               BEGIN
+                   {sales_rollup_order_sql('new', '')}
+               END
+               ''')
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS sales_rollups_order_cancel
+                   AFTER UPDATE OF status ON orders
+                   WHEN COALESCE(old.status, '') != 'cancelled' AND new.status = 'cancelled'
+                       AND {counted_order.format(order_id='new.id')}
+               BEGIN
+                   {sales_rollup_order_sql('old', '-')}
+                   {sales_rollup_items_sql('old.created_at', '-', 'oi.order_id = old.id')}
+               END
+               ''')
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS sales_rollups_order_restore
+                   AFTER UPDATE OF status ON orders
+                   WHEN old.status = 'cancelled' AND COALESCE(new.status, '') != 'cancelled'
+                       AND {counted_order.format(order_id='new.id')}
+               BEGIN
+                   {sales_rollup_order_sql('new', '')}
+                   {sales_rollup_items_sql('new.created_at', '', 'oi.order_id = new.id')}
+               END
+               ''')
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS sales_rollups_order_delete
+                   AFTER DELETE ON orders
+                   WHEN COALESCE(old.status, '') != 'cancelled' AND {counted_order.format(order_id='old.id')}
+               BEGIN
+                   {sales_rollup_order_sql('old', '-')}
+                   {sales_rollup_items_sql('old.created_at', '-', 'oi.order_id = old.id')}
+               END
+               ''')
+    # Позиции пишутся после строки заказа - их вклад добавляет отдельный триггер на order_items
+    order_sql = '(SELECT {column} FROM orders WHERE id = new.order_id)'
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS sales_rollups_item_insert
+                   AFTER INSERT ON order_items
+                   WHEN {new_order.format(order_id='new.order_id')}
+                       AND COALESCE({order_sql.format(column='status')}, '') != 'cancelled'
+               BEGIN
+                   {sales_rollup_items_sql(order_sql.format(column='created_at'), '', 'oi.id = new.id')}
+               END
+               ''')
+
+
+
+# Время изменения заказа с миллисекундами: сравнивается строкой в ?updated_since=
+ORDER_UPDATED_AT_SQL = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def migration_orders_updated_at(db):
+    """orders.updated_at (ставят триггеры) и индексы под фильтры и курсор списка заказов в админке"""
+    db.execute('ALTER TABLE orders ADD COLUMN updated_at TEXT')
+    db.execute("UPDATE orders SET updated_at = strftime('%Y-%m-%d %H:%M:%f', created_at)")
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS orders_updated_at_insert
+                   AFTER INSERT ON orders
+                   WHEN new.updated_at IS NULL
+               BEGIN
+                   UPDATE orders SET updated_at = {ORDER_UPDATED_AT_SQL} WHERE id = new.id;
+               END
+               ''')
+    # Любое изменение заказа, где updated_at не выставили явно
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS orders_updated_at_update
+                   AFTER UPDATE ON orders
+                   WHEN new.updated_at IS old.updated_at
+               BEGIN
+                   UPDATE orders SET updated_at = {ORDER_UPDATED_AT_SQL} WHERE id = new.id;
+               END
+               ''')
+    # Назначение курьера видно в списке заказов - тоже изменение заказа
+    for event, row in (('INSERT', 'new'), ('UPDATE', 'new'), ('DELETE', 'old')):
+        db.execute(f'''
+                   CREATE TRIGGER IF NOT EXISTS orders_updated_at_assignment_{event.lower()}
+                       AFTER {event} ON order_assignments
+                   BEGIN
+                       UPDATE orders SET updated_at = {ORDER_UPDATED_AT_SQL} WHERE id = {row}.order_id;
+                   END
+                   ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_updated_at ON orders (updated_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_delivery_type_created_at ON orders (delivery_type, created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_phone_number ON orders (phone_number)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_recipient_name ON orders (recipient_name COLLATE NOCASE)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_username ON orders (username COLLATE NOCASE)')
+
+
+def migration_order_events(db):
+    """Журнал событий заказов: только добавление, id растут в порядке коммитов"""
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS order_events
+               (
+                   id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                   order_id    INTEGER NOT NULL,
+                   event       TEXT    NOT NULL,
+                   from_status TEXT,
+                   to_status   TEXT,
+                   actor       TEXT,
+                   payload     TEXT,
+                   created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               )
+               ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_order_events_order_id ON order_events (order_id, id)')
+    for event in ('UPDATE', 'DELETE'):
+        db.execute(f'''
+                   CREATE TRIGGER IF NOT EXISTS order_events_no_{event.lower()}
+                       BEFORE {event} ON order_events
+                   BEGIN
+                       SELECT RAISE(ABORT, 'order_events is append-only');
+                   END
+                   ''')
+
+
+def migration_sales_rollups_order_update(db):
+    """Правки суммы, скидки и измерений заказа (редактирование в админке) переносятся в sales_rollups"""
+    db.execute(f'''
+               CREATE TRIGGER IF NOT EXISTS sales_rollups_order_update
+                   AFTER UPDATE OF total_price, discount_amount, delivery_type, payment_method, pickup_point
+                   ON orders
+                   WHEN COALESCE(old.status, '') != 'cancelled' AND COALESCE(new.status, '') != 'cancelled'
+                       AND {SALES_ROLLUP_COUNTED_ORDER_SQL.format(order_id='new.id')}
+               BEGIN
+                   {sales_rollup_order_sql('old', '-')}
+                   {sales_rollup_order_sql('new', '')}
+               END
+               ''')
+    # В пустой базе переносить нечего - история полна сразу
+    db.execute('''
+               UPDATE backfill_progress
+               SET done = 1
+               WHERE name = 'sales_rollups'
+                 AND (SELECT last_id FROM backfill_progress WHERE name = 'sales_rollups_target') = 0
+               ''')
+
+
+def migration_idempotency_request_hash(db):
+    """Отпечаток запроса при ключе идемпотентности: повтор с другим телом не получает чужой ответ"""
+    columns = {row['name'] for row in db.execute('PRAGMA table_info(idempotency_keys)').fetchall()}
+    if 'request_hash' not in columns:
+        db.execute('ALTER TABLE idempotency_keys ADD COLUMN request_hash TEXT')
+
+
+def migration_order_address_stored(db):
+    """Части адреса - обычными колонками, которые пишет код заказа (order_address_columns).
+
+    VIRTUAL-колонки из миграции 11 попадали в каждый SELECT o.* и разбирали JSON при каждом
+    чтении. Старые заказы заполняются здесь один раз; orders_updated_at_update на время
+    переноса снимается, чтобы перенос не выглядел правкой всех заказов.
+    """
+    db.execute('DROP INDEX IF EXISTS idx_orders_address')
+    db.execute('DROP INDEX IF EXISTS idx_orders_address_status')
+
+    # table_xinfo: hidden = 2/3 у генерируемых колонок
+    columns = {row['name']: row['hidden'] for row in db.execute('PRAGMA table_xinfo(orders)').fetchall()}
+    for field in ORDER_ADDRESS_FIELDS:
+        column = f'address_{field}'
+        if columns.get(column) in (2, 3):
+            db.execute(f'ALTER TABLE orders DROP COLUMN {column}')
+            columns.pop(column)
+        if column not in columns:
+            db.execute(f'ALTER TABLE orders ADD COLUMN {column} TEXT')
+
+    trigger = db.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'orders_updated_at_update'"
+                         ).fetchone()
+    if trigger:
+        db.execute('DROP TRIGGER orders_updated_at_update')
+    assignments = ', '.join(f"address_{field} = json_extract(delivery_address, '$.{field}')"
+                            for field in ORDER_ADDRESS_FIELDS)
+    db.execute(f'UPDATE orders SET {assignments} WHERE json_valid(delivery_address)')
+    if trigger:
+        db.execute(trigger['sql'])
+
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_address ON orders (address_city, address_street, address_house)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_orders_address_status ON orders (address_city, status, created_at)')
+
+
+def migration_order_items_cart_fields(db):
+    """Скидка позиции и id позиции корзины в order_items - те же поля, что у заказов из JSON orders.items.
+
+    Уже перенесенные позиции дополняются из orders.items: position - индекс позиции в этом JSON
+    """
+    columns = {row['name'] for row in db.execute('PRAGMA table_info(order_items)').fetchall()}
+    if 'discount_info' not in columns:
+        db.execute('ALTER TABLE order_items ADD COLUMN discount_info TEXT')
+    if 'cart_id' not in columns:
+        db.execute('ALTER TABLE order_items ADD COLUMN cart_id TEXT')
+    db.execute('''
+               UPDATE order_items
+               SET (discount_info, cart_id) = (SELECT NULLIF(j.value -> '$.discount_info', 'null'),
+                                                      CASE
+                                                          WHEN CAST(j.value ->> '$.id' AS TEXT) !=
+                                                               CAST(order_items.product_id AS TEXT)
+                                                              THEN j.value ->> '$.id' END
+                                               FROM orders o,
+                                                    json_each(o.items) j
+                                               WHERE o.id = order_items.order_id
+                                                 AND json_valid(o.items)
+                                                 AND j.key = order_items.position)
+               ''')
+
+
+
+def migration_products_display_price_index(db):
+    """Индекс под фильтр min_price/max_price по отображаемой цене вместо products.price"""
+    db.execute('DROP INDEX IF EXISTS idx_products_price')
+    db.execute(f'CREATE INDEX IF NOT EXISTS idx_products_display_price '
+               f"ON products ({PRODUCTS_DISPLAY_PRICE_SQL.format(p='')})")
+
+
+
+def migration_idempotency_owner_token(db):
+    """Токен владельца ключа идемпотентности: перехват и освобождение ключа только своим токеном"""
+    columns = {row['name'] for row in db.execute('PRAGMA table_info(idempotency_keys)').fetchall()}
+    if 'owner_token' not in columns:
+        db.execute('ALTER TABLE idempotency_keys ADD COLUMN owner_token TEXT')
+
+
+# Номера миграций только растут; уже примененные миграции не меняются
+MIGRATIONS = [
+    (1, 'hot_path_indexes', migration_hot_path_indexes),
+    (2, 'notification_outbox', migration_notification_outbox),
+    (3, 'cache_versions', migration_cache_versions),
+    (4, 'products_fts', migration_products_fts),
+    (5, 'products_keyset_indexes', migration_products_keyset_indexes),
+    (6, 'product_prices', migration_product_prices),
+    (7, 'promo_code_batches', migration_promo_code_batches),
+    (8, 'inventory_ledger', migration_inventory_ledger),
+    (9, 'idempotency_keys', migration_idempotency_keys),
+    (10, 'order_items', migration_order_items),
+    (11, 'order_address_columns', migration_order_address_columns),
+    (12, 'shop_counters', migration_shop_counters),
+    (13, 'sales_rollups', migration_sales_rollups),
+    (14, 'orders_updated_at', migration_orders_updated_at),
+    (15, 'order_events', migration_order_events),
+    (16, 'sales_rollups_order_update', migration_sales_rollups_order_update),
+    (17, 'idempotency_request_hash', migration_idempotency_request_hash),
+    (18, 'order_address_stored', migration_order_address_stored),
+    (19, 'order_items_cart_fields', migration_order_items_cart_fields),
+    (20, 'products_display_price_index', migration_products_display_price_index),
+    (21, 'idempotency_owner_token', migration_idempotency_owner_token),
+]
+
+
+def get_schema_version(db):
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS schema_version
+               (
+                   version    INTEGER PRIMARY KEY,
+                   name       TEXT NOT NULL,
+                   applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               )
+               ''')
+    db.commit()
+    return db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def run_migrations():
+    """Применить все новые миграции; каждая - в отдельной транзакции BEGIN IMMEDIATE"""
+    db = get_db()
+    applied = []
+    try:
+        current = get_schema_version(db)
+        for version, name, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                # Другой воркер мог успеть применить миграцию, пока мы ждали блокировку
+                already = db.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)).fetchone()
+                if not already:
+                    migrate(db)
+                    db.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+                    applied.append(version)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        return applied
+    finally:
+        db.close()
+
+
+run_migrations()
+
+
+def get_cache_version(db, name):
+    row = db.execute('SELECT version FROM cache_versions WHERE name = ?', (name,)).fetchone()
+    return row['version'] if row else 0
+
+
+def bump_cache_version(db, name):
+    """Увеличить версию кэша. Выполняется в транзакции вызывающего кода, коммит - за ним"""
+    db.execute('''
+               INSERT INTO cache_versions (name, version)
+               VALUES (?, 1)
+               ON CONFLICT(name) DO UPDATE SET version    = version + 1,
+                                               updated_at = CURRENT_TIMESTAMP
+               ''', (name,))
+
+
+# ========== КЭШ КАТАЛОГА ==========
+class CatalogCache:
+    """Готовые JSON-ответы каталога по (эндпоинт, параметры), привязанные к версии 'catalog'.
+
+    Версия хранится в cache_versions и увеличивается в транзакции каждой записи в products/
+    product_categories, поэтому все воркеры gunicorn видят изменения при следующем запросе.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._stats = {}
+
+    def _endpoint_stats(self, endpoint):
+        return self._stats.setdefault(endpoint, {
+            'hits': 0, 'misses': 0, 'rebuild_time_ms': 0.0, 'rebuild_max_ms': 0.0
+        })
+
+    def respond(self, db, key, builder, extra_version=None):
+        """Ответ из кэша, если версия каталога не менялась, иначе построить и сохранить"""
+        version = (get_cache_version(db, 'catalog'), extra_version)
+        endpoint = key[0]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                self._endpoint_stats(endpoint)['hits'] += 1
+                return self._response(entry[1], entry[2])
+
+        started = time.perf_counter()
+        body = app.json.dumps(builder())
+        etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        with self._lock:
+            stats = self._endpoint_stats(endpoint)
+            stats['misses'] += 1
+            stats['rebuild_time_ms'] += elapsed_ms
+            stats['rebuild_max_ms'] = max(stats['rebuild_max_ms'], elapsed_ms)
+
+            self._entries[key] = (version, body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return self._response(body, etag)
+
+    @staticmethod
+    def _response(body, etag):
+        response = app.response_class(body, mimetype='application/json')
+        # ETag посчитан один раз при сборке ответа, http_cache его не пересчитывает
+        response.set_etag(etag)
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            endpoints = {}
+            for endpoint, stats in self._stats.items():
+                requests_total = stats['hits'] + stats['misses']
+                endpoints[endpoint] = {
+                    'hits': stats['hits'],
+                    'misses': stats['misses'],
+                    'hit_ratio': round(stats['hits'] / requests_total, 3) if requests_total else None,
+                    'rebuild_avg_ms': round(stats['rebuild_time_ms'] / stats['misses'], 2) if stats['misses'] else None,
+                    'rebuild_max_ms': round(stats['rebuild_max_ms'], 2)
+                }
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'pid': os.getpid(),
+                'endpoints': endpoints
+            }
+
+
+catalog_cache = CatalogCache(max_entries=int(os.environ.get('CATALOG_CACHE_ENTRIES', 256)))
+
+
+# ========== HTTP-КЭШИРОВАНИЕ ==========
+# Политики Cache-Control: max_age=0 - браузер хранит ответ, но перепроверяет его по ETag
+HTTP_CACHE_POLICIES = {
+    # Остатки меняются при каждом заказе
+    'catalog': {'max_age': 0, 'public': True},
+    # Скидки и категории правит только админ
+    'reference': {'max_age': 60, 'public': True},
+    'pickup_points': {'max_age': 300, 'public': True},
+    'private': {'max_age': 0, 'public': False},
+}
+
+
+def http_cache(policy_name):
+    """Сильный ETag по содержимому, ответ 304 на If-None-Match и Cache-Control по политике"""
+    policy = HTTP_CACHE_POLICIES[policy_name]
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            response = app.make_response(f(*args, **kwargs))
+            # Ошибки обработчики отдают с 4xx/5xx: такой ответ уходит без ETag и Cache-Control
+            if request.method != 'GET' or response.status_code != 200:
+                return response
+
+            if not response.get_etag()[0]:
+                response.add_etag()
+
+            if policy['public']:
+                response.cache_control.public = True
+            else:
+                response.cache_control.private = True
+            if policy['max_age']:
+                response.cache_control.max_age = policy['max_age']
+            else:
+                response.cache_control.no_cache = True
+            response.vary.add('Accept-Encoding')
+
+            return response.make_conditional(request)
+
+        return decorated_function
+
+    return decorator
+
+
+# ========== ИДЕМПОТЕНТНОСТЬ ЗАПРОСОВ ==========
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+IDEMPOTENCY_WAIT_SECONDS = 30.0
+IDEMPOTENCY_LOCK_SECONDS = 120.0
+IDEMPOTENCY_CLEANUP_INTERVAL = 300.0
+_idempotency_cleanup = {'at': 0.0}
+
+
+def claim_idempotency_key(db, key, request_hash=None):
+    """Занять ключ запроса: ('owner', токен), ('done', (статус, тело)), ('busy', None) или ('mismatch', None)
+
+    'mismatch' - ключ уже занят запросом с другим отпечатком (другой пользователь или тело).
+    Токен владельца нужен для записи ответа и освобождения ключа.
+    """
+    now = time.time()
+    token = secrets.token_hex(16)
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        if now - _idempotency_cleanup['at'] > IDEMPOTENCY_CLEANUP_INTERVAL:
+            _idempotency_cleanup['at'] = now
+            db.execute('DELETE FROM idempotency_keys WHERE expires_at < ?', (now,))
+        else:
+            db.execute('DELETE FROM idempotency_keys WHERE key = ? AND expires_at < ?', (key, now))
+
+        row = db.execute('SELECT * FROM idempotency_keys WHERE key = ?', (key,)).fetchone()
+        if not row:
+            db.execute('''
+                       INSERT INTO idempotency_keys (key, status, request_hash, owner_token, locked_at, created_at,
+                                                     expires_at)
+                       VALUES (?, 'in_flight', ?, ?, ?, ?, ?)
+                       ''', (key, request_hash, token, now, now, now + IDEMPOTENCY_TTL_SECONDS))
+            state = ('owner', token)
+        elif row['request_hash'] and request_hash and row['request_hash'] != request_hash:
+            state = ('mismatch', None)
+        elif row['status'] == 'done':
+            state = ('done', (row['response_status'], row['response_body']))
+        elif row['locked_at'] < now - IDEMPOTENCY_LOCK_SECONDS:
+            # Воркер, начавший запрос, упал или завис, не записав ответ - забираем ключ себе.
+            # Новый токен отменяет прежнего владельца: его запись ответа и освобождение ключа не сработают
+            cursor = db.execute('''
+                                UPDATE idempotency_keys
+                                SET locked_at   = ?,
+                                    owner_token = ?
+                                WHERE key = ?
+                                  AND status = 'in_flight'
+                                  AND owner_token IS ?
+                                ''', (now, token, key, row['owner_token']))
+            state = ('owner', token) if cursor.rowcount else ('busy', None)
+        else:
+            state = ('busy', None)
+        db.commit()
+        return state
+    except Exception:
+        db.rollback()
+        raise
+
+
+def record_idempotent_response(db, body, status=200):
+    """Сохранить ответ для повторов в транзакции вызывающего кода (если запрос пришел с ключом)"""
+    key = g.get('idempotency_key')
+    if key:
+        db.execute('''
+                   UPDATE idempotency_keys
+                   SET status          = 'done',
+                       response_status = ?,
+                       response_body   = ?
+                   WHERE key = ?
+                     AND owner_token = ?
+                   ''', (status, app.json.dumps(body), key, g.get('idempotency_token')))
+
+
+def idempotency_request_hash(ignore_fields=()):
+    """Отпечаток запроса: user_id и JSON-тело без полей, которые клиент может обновить при повторе"""
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        user_id = data.get('user_id')
+        body = json.dumps({k: v for k, v in data.items() if k not in ignore_fields},
+                          sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    else:
+        user_id = None
+        body = request.get_data()
+    return hashlib.sha256(f'{user_id}\n'.encode('utf-8') + body).hexdigest()
+
+
+def idempotent(scope, ignore_fields=()):
+    """Повтор с тем же Idempotency-Key получает сохраненный ответ, параллельный повтор ждет первый запрос.
+
+    Ответ сохраняет сам обработчик через record_idempotent_response; если он этого не сделал
+    (ошибка, отказ), ключ освобождается и повтор выполнится заново. Ключ привязан к отпечатку
+    запроса: тот же ключ с другим пользователем или телом получает 422.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            raw_key = (request.headers.get('Idempotency-Key') or '').strip()
+            if not raw_key:
+                return f(*args, **kwargs)
+            if len(raw_key) > 255:
+                return jsonify({'success': False, 'error': 'Слишком длинный Idempotency-Key'}), 400
+
+            key = f'{scope}:{raw_key}'
+            request_hash = idempotency_request_hash(ignore_fields)
+            deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+            while True:
+                db = get_db()
+                try:
+                    state, stored = claim_idempotency_key(db, key, request_hash)
+                finally:
+                    db.close()
+
+                if state == 'owner':
+                    break
+                if state == 'mismatch':
+                    return jsonify({'success': False,
+                                    'error': 'Idempotency-Key уже использован для другого запроса'}), 422
+                if state == 'done':
+                    response = app.response_class(stored[1], status=stored[0], mimetype='application/json')
+                    response.headers['Idempotent-Replayed'] = 'true'
+                    return response
+                if time.monotonic() >= deadline:
+                    return jsonify({'success': False, 'error': 'Запрос с этим ключом еще обрабатывается'}), 409
+                time.sleep(0.05)
+
+            g.idempotency_key, g.idempotency_token = key, stored
+            try:
+                return f(*args, **kwargs)
+            finally:
+                g.pop('idempotency_key', None)
+                g.pop('idempotency_token', None)
+                db = get_db()
+                try:
+                    # Ключ, перехваченный повтором после IDEMPOTENCY_LOCK_SECONDS, уже не наш - не трогаем
+                    db.execute("DELETE FROM idempotency_keys WHERE key = ? AND status = 'in_flight' "
+                               "AND owner_token = ?", (key, stored))
+                    db.commit()
+                finally:
+                    db.close()
+
+        return decorated_function
+
+    return decorator
+
+
+# Горячие запросы для отчета EXPLAIN QUERY PLAN: (название, SQL, параметры)
+HOT_QUERIES = [
+    ('orders_by_user', '''
+        SELECT o.id, o.total_price, o.status, o.created_at
+        FROM orders o
+                 LEFT JOIN order_assignments a ON o.id = a.order_id
+        WHERE o.user_id = ?
+        ORDER BY o.created_at DESC LIMIT 10
+    ''', (0,)),
+    ('admin_orders_recent', '''
+        SELECT o.*, a.status, c.full_name
+        FROM orders o
+                 LEFT JOIN order_assignments a ON o.id = a.order_id
+                 LEFT JOIN couriers c ON a.courier_id = c.id
+        ORDER BY o.created_at DESC LIMIT 100
+    ''', ()),
+    ('orders_pending_count', "SELECT COUNT(*) FROM orders WHERE status = 'pending'", ()),
+    ('orders_by_address', '''
+        SELECT id FROM orders WHERE address_city = ? AND address_street = ? AND address_house = ?
+    ''', ('', '', '')),
+    ('orders_by_city_status', '''
+        SELECT id FROM orders WHERE address_city = ? AND status = 'pending' ORDER BY created_at DESC
+    ''', ('',)),
+    ('courier_available_orders', '''
+        SELECT o.id
+        FROM orders o
+                 LEFT JOIN order_assignments a ON o.id = a.order_id
+        WHERE o.delivery_type = 'courier'
+          AND o.status = 'pending'
+          AND a.id IS NULL
+        ORDER BY o.created_at DESC
+    ''', ()),
+    ('courier_active_orders', '''
+        SELECT o.id
+        FROM orders o
+                 JOIN order_assignments a ON o.id = a.order_id
+        WHERE a.courier_id = ?
+          AND a.status IN ('assigned', 'picked_up')
+        ORDER BY a.assigned_at DESC
+    ''', (0,)),
+    ('chat_messages_by_order', '''
+        SELECT cm.*
+        FROM chat_messages cm
+        WHERE cm.order_id = ?
+        ORDER BY cm.created_at ASC
+    ''', (0,)),
+    ('promo_code_lookup', 'SELECT id FROM promo_codes WHERE code = ? AND is_active = 1', ('',)),
+    ('failed_logins_by_ip', '''
+        SELECT COUNT(*)
+        FROM failed_logins
+        WHERE ip_address = ?
+          AND attempt_time > datetime('now', '-5 minutes')
+    ''', ('',)),
+    ('catalog_products', '''
+        SELECT id
+        FROM products
+        WHERE ((product_type = 'piece' AND stock > 0) OR (product_type = 'weight' AND stock_weight > 0))
+        ORDER BY created_at DESC
+    ''', ()),
+    ('sales_timeseries', '''
+        SELECT bucket, SUM(orders), SUM(revenue)
+        FROM sales_rollups
+        WHERE grain = ?
+          AND bucket BETWEEN ? AND ?
+        GROUP BY bucket
+    ''', ('day', '', '')),
+]
+
+
+def explain_hot_queries(db):
+    """План выполнения горячих запросов с пометкой полных сканирований"""
+    report = []
+    for name, sql, params in HOT_QUERIES:
+        plan = [row['detail'] for row in db.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+        full_scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+        report.append({
+            'name': name,
+            'plan': plan,
+            'full_scan': bool(full_scans),
+            'full_scans': full_scans,
+            'temp_sort': any('TEMP B-TREE' in step for step in plan)
+        })
+    return report
+
+
+@app.cli.command('db-explain')
+def db_explain_command():
+    """Отчет EXPLAIN QUERY PLAN по горячим запросам"""
+    db = get_db()
+    try:
+        print(f'schema_version: {get_schema_version(db)}')
+        for entry in explain_hot_queries(db):
+            mark = 'FULL SCAN' if entry['full_scan'] else 'ok'
+            print(f"[{mark}] {entry['name']}")
+            for step in entry['plan']:
+                print(f'    {step}')
+    finally:
+        db.close()
+
+
 @app.route('/api/bot/get-orders/<int:telegram_id>', methods=['GET'])
 def api_bot_get_orders(telegram_id):
     """API для получения заказов пользователя (для бота)"""
@@ -1104,11 +2559,7 @@ def api_bot_get_order_detail(order_id, telegram_id):
             return jsonify({'success': False, 'error': 'Заказ не найден'}), 404
 
         order_dict = dict(order)
-
-        try:
-            order_dict['items_list'] = json.loads(order_dict['items'])
-        except:
-            order_dict['items_list'] = []
+        order_dict['items_list'] = load_order_items(db, [order])[order_dict['id']]
 
         if order_dict.get('delivery_address'):
             try:
@@ -1124,35 +2575,230 @@ def api_bot_get_order_detail(order_id, telegram_id):
         db.close()
 
 
+# ========== TELEGRAM КЛИЕНТ ==========
+class TelegramRateLimiter:
+    """Token bucket на N сообщений в секунду; пауза для всех потоков после ответа 429"""
+
+    def __init__(self, rate=30, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class TelegramClient:
+    """Единый клиент Bot API: keep-alive сессия, таймауты, повторы и счетчики по методам"""
+
+    def __init__(self, connect_timeout=3.05, read_timeout=10, max_retries=3, backoff=0.5,
+                 pool_maxsize=16, rate=30):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_maxsize = pool_maxsize
+        self.limiter = TelegramRateLimiter(rate)
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @property
+    def token(self):
+        return os.getenv('BOT_TOKEN')
+
+    @property
+    def session(self):
+        # Своя сессия в каждом воркере: сокеты не должны переживать fork()
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def _record(self, method, ok, elapsed):
+        with self._lock:
+            stats = self._stats.setdefault(method, {'calls': 0, 'errors': 0, 'latency_total': 0.0,
+                                                    'latency_max': 0.0})
+            stats['calls'] += 1
+            if not ok:
+                stats['errors'] += 1
+            stats['latency_total'] += elapsed
+            stats['latency_max'] = max(stats['latency_max'], elapsed)
+
+    def call(self, method, payload=None, files=None, timeout=None):
+        """Вызвать метод Bot API. Возвращает dict: ok, status_code, error, result, attempts"""
+        result = {'ok': False, 'status_code': None, 'error': None, 'result': None, 'attempts': 0}
+        token = self.token
+        if not token:
+            result['error'] = 'BOT_TOKEN не задан'
+            return result
+
+        url = f'https://api.telegram.org/bot{token}/{method}'
+        timeouts = (self.connect_timeout, timeout or self.read_timeout)
+        started = time.monotonic()
+
+        for attempt in range(1, self.max_retries + 1):
+            result['attempts'] = attempt
+            self.limiter.acquire()
+            try:
+                if files:
+                    response = self.session.post(url, data=payload, files=files, timeout=timeouts)
+                else:
+                    response = self.session.post(url, json=payload, timeout=timeouts)
+            except requests.exceptions.ConnectionError as e:
+                # Соединение не установлено - сообщение точно не ушло, можно повторить
+                result['error'] = str(e)
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+                continue
+            except requests.RequestException as e:
+                # ReadTimeout: Telegram мог принять сообщение, повтор дал бы дубль
+                result['error'] = str(e)
+                break
+
+            result['status_code'] = response.status_code
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+
+            if response.status_code == 200:
+                result['ok'] = True
+                result['error'] = None
+                result['result'] = body.get('result')
+                break
+
+            result['error'] = body.get('description') or f'HTTP {response.status_code}'
+            if response.status_code == 429:
+                retry_after = float((body.get('parameters') or {}).get('retry_after', 1))
+                self.limiter.pause(retry_after)
+            elif response.status_code >= 500:
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+            else:
+                # 400/403 (бот заблокирован, чат не найден) повторять бессмысленно
+                break
+
+        self._record(method, result['ok'], time.monotonic() - started)
+        return result
+
+    def send_message(self, chat_id, text, **params):
+        payload = dict(params, chat_id=int(chat_id), text=text)
+        return self.call('sendMessage', payload)['ok']
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for method, stats in self._stats.items():
+                result[method] = {
+                    'calls': stats['calls'],
+                    'errors': stats['errors'],
+                    'latency_avg_ms': round(stats['latency_total'] / stats['calls'] * 1000, 1),
+                    'latency_max_ms': round(stats['latency_max'] * 1000, 1)
+                }
+            return result
+
+
+class TelegramFanout:
+    """Отправка одного сообщения N получателям параллельно через общий клиент"""
+
+    def __init__(self, client, max_workers=8):
+        self.client = client
+        self.max_workers = max_workers
+
+    def _send_one(self, method, payload):
+        result = self.client.call(method, payload)
+        return {'chat_id': payload['chat_id'], 'ok': result['ok'], 'status_code': result['status_code'],
+                'error': result['error'], 'attempts': result['attempts']}
+
+    def send(self, chat_ids, payload, method='sendMessage'):
+        """Разослать payload всем chat_ids. Возвращает результаты в порядке получателей"""
+        payloads = [dict(payload, chat_id=int(chat_id)) for chat_id in chat_ids]
+        if len(payloads) <= 1:
+            return [self._send_one(method, item) for item in payloads]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(payloads))) as executor:
+            return list(executor.map(lambda item: self._send_one(method, item), payloads))
+
+
+telegram_client = TelegramClient(
+    connect_timeout=float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=float(os.environ.get('TELEGRAM_READ_TIMEOUT', 10)),
+    max_retries=int(os.environ.get('TELEGRAM_MAX_RETRIES', 3)),
+    pool_maxsize=int(os.environ.get('TELEGRAM_POOL_SIZE', 16)),
+    rate=float(os.environ.get('TELEGRAM_RATE_LIMIT', 30))
+)
+
+telegram_fanout = TelegramFanout(telegram_client, max_workers=int(os.environ.get('TELEGRAM_FANOUT_WORKERS', 8)))
+
+
+class NotificationSkipped:
+    """Результат отправки, который повтор не исправит (нет заказа, получателей, токена).
+
+    Ложен как False, поэтому прямые вызовы send_*_notification работают как раньше,
+    а диспетчер outbox закрывает такую задачу сразу, без повторов.
+    """
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return f'NotificationSkipped({self.reason!r})'
+
+
 def send_order_details_notification(telegram_id, order_id, items, status, delivery_type,
                                     courier_name=None, courier_phone=None):
     """Отправить красивое уведомление клиенту с полной информацией"""
     try:
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
-
         if not telegram_id or telegram_id == 0:
-            return False
+            return NotificationSkipped('Нет telegram_id получателя')
 
-        if not BOT_TOKEN:
-            return False
+        if not telegram_client.token:
+            return NotificationSkipped('BOT_TOKEN не задан')
 
         db = get_db()
         try:
             order = db.execute('''
                                SELECT o.*,
                                       (o.total_price + COALESCE(o.delivery_cost, 0) -
-                                       COALESCE(o.discount_amount, 0))                as total_amount,
-                                      json_extract(o.delivery_address, '$.city')      as city,
-                                      json_extract(o.delivery_address, '$.street')    as street,
-                                      json_extract(o.delivery_address, '$.house')     as house,
-                                      json_extract(o.delivery_address, '$.apartment') as apartment
+                                       COALESCE(o.discount_amount, 0)) as total_amount,
+                                      o.address_city                  as city,
+                                      o.address_street                as street,
+                                      o.address_house                 as house,
+                                      o.address_apartment             as apartment
                                FROM orders o
                                WHERE o.id = ?
                                ''', (order_id,)).fetchone()
 
             if not order:
                 db.close()
-                return False
+                return NotificationSkipped('Заказ не найден')
 
             order_data = dict(order)
 
@@ -1359,7 +3005,6 @@ def send_order_details_notification(telegram_id, order_id, items, status, delive
 
         keyboard = {"inline_keyboard": keyboard_buttons}
 
-        url = f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage'
         data = {
             'chat_id': int(telegram_id),
             'text': message,
@@ -1368,12 +3013,7 @@ def send_order_details_notification(telegram_id, order_id, items, status, delive
             'reply_markup': json.dumps(keyboard)
         }
 
-        response = requests.post(url, json=data, timeout=10)
-
-        if response.status_code == 200:
-            return True
-        else:
-            return False
+        return telegram_client.call('sendMessage', data)['ok']
 
     except Exception as e:
         return False
@@ -1381,6 +3021,7 @@ def send_order_details_notification(telegram_id, order_id, items, status, delive
 
 def send_order_notification(order_id, status, courier_id=None, photo_base64=None):
     """Универсальная функция отправки уведомлений"""
+    db = None
     try:
         db = get_db()
 
@@ -1452,35 +3093,31 @@ def send_order_notification(order_id, status, courier_id=None, photo_base64=None
 
     except Exception as e:
         return False
+    finally:
+        if db:
+            db.close()
 
 
 def send_photo_to_telegram(chat_id, photo_path, caption="", reply_markup=None):
     """Отправить фото напрямую через Telegram API"""
     try:
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
-
         if not os.path.exists(photo_path):
             return False
 
-        url = f'https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto'
-
+        # Файл читается в память, чтобы клиент мог повторить отправку
         with open(photo_path, 'rb') as photo_file:
-            files = {'photo': photo_file}
-            data = {
-                'chat_id': chat_id,
-                'caption': caption[:1024],
-                'parse_mode': 'Markdown'
-            }
+            files = {'photo': (os.path.basename(photo_path), photo_file.read())}
 
-            if reply_markup:
-                data['reply_markup'] = json.dumps(reply_markup)
+        data = {
+            'chat_id': chat_id,
+            'caption': caption[:1024],
+            'parse_mode': 'Markdown'
+        }
 
-            response = requests.post(url, files=files, data=data, timeout=30)
+        if reply_markup:
+            data['reply_markup'] = json.dumps(reply_markup)
 
-        if response.status_code == 200:
-            return True
-        else:
-            return False
+        return telegram_client.call('sendPhoto', data, files=files, timeout=30)['ok']
 
     except Exception as e:
         return False
@@ -1621,8 +3258,6 @@ def send_order_delivered_with_photo_notification(telegram_id, order_id, courier_
 💝 *Спасибо за покупку!*
 ━━━━━━━━━━━━━━━━━━━━"""
 
-            BOT_TOKEN = os.getenv('BOT_TOKEN')
-            url = f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage'
             data = {
                 'chat_id': int(telegram_id),
                 'text': message,
@@ -1631,12 +3266,7 @@ def send_order_delivered_with_photo_notification(telegram_id, order_id, courier_
                 'reply_markup': json.dumps(keyboard)
             }
 
-            response = requests.post(url, json=data, timeout=10)
-
-            if response.status_code == 200:
-                return True
-            else:
-                return False
+            return telegram_client.call('sendMessage', data)['ok']
         else:
             return True
 
@@ -1658,8 +3288,7 @@ def admin_mark_order_ready(order_id):
         if order_dict.get('delivery_type') != 'pickup':
             return jsonify({'success': False, 'error': 'Это не заказ на самовывоз'}), 400
 
-        db.execute('UPDATE orders SET status = ? WHERE id = ?',
-                   ('ready_for_pickup', order_id))
+        transition_order(db, order_id, 'ready_for_pickup', 'admin')
         db.commit()
 
         send_order_notification(order_id, 'ready_for_pickup')
@@ -1675,8 +3304,7 @@ def admin_mark_order_ready(order_id):
 def send_chat_notification_to_telegram(telegram_id, order_id, message, sender_name, is_admin=False):
     """Отправить уведомление о новом сообщении в Telegram"""
     try:
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
-        if not BOT_TOKEN or not telegram_id:
+        if not telegram_client.token or not telegram_id:
             return False
 
         if is_admin:
@@ -1701,7 +3329,6 @@ def send_chat_notification_to_telegram(telegram_id, order_id, message, sender_na
             ]
         }
 
-        url = f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage'
         data = {
             'chat_id': int(telegram_id),
             'text': text,
@@ -1709,11 +3336,7 @@ def send_chat_notification_to_telegram(telegram_id, order_id, message, sender_na
             'reply_markup': json.dumps(keyboard)
         }
 
-        response = requests.post(url, json=data, timeout=10)
-        if response.status_code == 200:
-            return True
-        else:
-            return False
+        return telegram_client.call('sendMessage', data)['ok']
 
     except Exception as e:
         return False
@@ -1750,6 +3373,8 @@ def api_send_chat_message():
                             ''', (order_id, user_id, message, sender_type, file_url, file_type))
 
         message_id = cursor.lastrowid
+        record_order_event(db, order_id, ORDER_EVENT_CHAT_MESSAGE, f'{sender_type}:{user_id}',
+                           message_id=message_id, sender_type=sender_type, message=message)
 
         chat = db.execute('SELECT * FROM active_chats WHERE order_id = ?', (order_id,)).fetchone()
 
@@ -2085,32 +3710,32 @@ def api_get_chat_messages():
 
 def send_courier_order_notification(order_id):
     """Отправить уведомление курьерам"""
+    db = None
     try:
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
-        if not BOT_TOKEN:
-            return False
+        if not telegram_client.token:
+            return NotificationSkipped('BOT_TOKEN не задан')
 
         db = get_db()
         order = db.execute('''
                            SELECT o.*,
-                                  json_extract(o.delivery_address, '$.city')           as city,
-                                  json_extract(o.delivery_address, '$.street')         as street,
-                                  json_extract(o.delivery_address, '$.house')          as house,
-                                  json_extract(o.delivery_address, '$.building')       as building,
-                                  json_extract(o.delivery_address, '$.entrance')       as entrance,
-                                  json_extract(o.delivery_address, '$.apartment')      as apartment,
-                                  json_extract(o.delivery_address, '$.floor')          as floor,
-                                  json_extract(o.delivery_address, '$.doorcode')       as doorcode,
-                                  json_extract(o.delivery_address, '$.comment')        as address_comment,
-                                  json_extract(o.delivery_address, '$.recipient_name') as recipient_name_full,
-                                  json_extract(o.delivery_address, '$.phone')          as phone_full
+                                  o.address_city           as city,
+                                  o.address_street         as street,
+                                  o.address_house          as house,
+                                  o.address_building       as building,
+                                  o.address_entrance       as entrance,
+                                  o.address_apartment      as apartment,
+                                  o.address_floor          as floor,
+                                  o.address_doorcode       as doorcode,
+                                  o.address_comment        as address_comment,
+                                  o.address_recipient_name as recipient_name_full,
+                                  o.address_phone          as phone_full
                            FROM orders o
                            WHERE o.id = ?
                            ''', (order_id,)).fetchone()
 
         if not order:
             db.close()
-            return False
+            return NotificationSkipped('Заказ не найден')
 
         order_dict = dict(order)
 
@@ -2205,28 +3830,22 @@ def send_courier_order_notification(order_id):
 
         db.close()
 
-        success_count = 0
-        for courier in couriers:
-            try:
-                response = requests.post(
-                    f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage',
-                    json={
-                        'chat_id': int(courier['telegram_id']),
-                        'text': text,
-                        'parse_mode': 'Markdown',
-                        'reply_markup': json.dumps(keyboard)
-                    },
-                    timeout=10
-                )
-                if response.status_code == 200:
-                    success_count += 1
-            except:
-                pass
+        if not couriers:
+            return NotificationSkipped('Нет активных курьеров с Telegram')
+
+        results = telegram_fanout.send([courier['telegram_id'] for courier in couriers], {
+            'text': text,
+            'parse_mode': 'Markdown',
+            'reply_markup': json.dumps(keyboard)
+        })
 
-        return success_count > 0
+        return any(result['ok'] for result in results)
 
     except Exception as e:
         return False
+    finally:
+        if db:
+            db.close()
 
 
 @app.route('/api/courier/register-telegram', methods=['POST'])
@@ -2307,6 +3926,7 @@ def api_get_courier_telegram(courier_id):
 
 def send_order_ready_notification(order_id):
     """Отправить уведомление клиенту что заказ готов к выдаче"""
+    db = None
     try:
         db = get_db()
 
@@ -2352,8 +3972,7 @@ def send_order_ready_notification(order_id):
 
         db.close()
 
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
-        if not BOT_TOKEN:
+        if not telegram_client.token:
             return False
 
         message = f"""✅ *ВАШ ЗАКАЗ ГОТОВ К ВЫДАЧЕ!*
@@ -2383,7 +4002,6 @@ def send_order_ready_notification(order_id):
             ]
         }
 
-        url = f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage'
         data = {
             'chat_id': int(telegram_id),
             'text': message,
@@ -2391,15 +4009,13 @@ def send_order_ready_notification(order_id):
             'reply_markup': json.dumps(keyboard)
         }
 
-        response = requests.post(url, json=data, timeout=10)
-
-        if response.status_code == 200:
-            return True
-        else:
-            return False
+        return telegram_client.call('sendMessage', data)['ok']
 
     except Exception as e:
         return False
+    finally:
+        if db:
+            db.close()
 
 
 def assign_order_to_courier(order_id, delivery_type):
@@ -2420,6 +4036,7 @@ def assign_order_to_courier(order_id, delivery_type):
                    INSERT INTO order_assignments (order_id, courier_id, status)
                    VALUES (?, ?, 'assigned')
                    ''', (order_id, courier_id))
+        record_order_event(db, order_id, ORDER_EVENT_COURIER_ASSIGNED, 'system', courier_id=courier_id)
 
         db.commit()
 
@@ -2454,93 +4071,555 @@ def courier_panel():
     return render_template('courier.html')
 
 
+CATALOG_PRODUCT_COLUMNS = '''
+    p.id,
+    p.name,
+    p.description,
+    CASE
+        WHEN p.product_type = 'weight' AND p.price_per_kg > 0 THEN p.price_per_kg
+        ELSE p.price
+        END as price,
+    CASE
+        WHEN p.image_url IS NOT NULL AND p.image_url != '' THEN p.image_url
+        ELSE 'https://via.placeholder.com/300x200?text=No+Image'
+        END as image_url,
+    p.category,
+    CASE
+        WHEN p.product_type = 'weight' AND p.stock_weight > 0 THEN p.stock_weight
+        ELSE p.stock
+        END as stock,
+    p.product_type,
+    p.unit,
+    p.weight_unit,
+    p.price_per_kg,
+    p.min_weight,
+    p.max_weight,
+    p.step_weight,
+    p.stock_weight,
+    p.created_at
+'''
+
+
+def serialize_catalog_product(product):
+    product_dict = dict(product)
+
+    if product_dict.get('product_type') == 'weight':
+        product_dict['display_price'] = product_dict.get('price_per_kg', product_dict['price'])
+        product_dict['display_stock'] = product_dict.get('stock_weight', 0)
+        product_dict['is_weight'] = True
+        product_dict['price_per_kg'] = product_dict.get('price_per_kg', 0)
+    else:
+        product_dict['display_price'] = product_dict['price']
+        product_dict['display_stock'] = product_dict['stock']
+        product_dict['is_weight'] = False
+
+    return product_dict
+
+
+def build_catalog_products(db, category):
+    """Товары в наличии для витрины (тело ответа /api/products)"""
+    query = f"SELECT {CATALOG_PRODUCT_COLUMNS} FROM products p WHERE {PRODUCTS_IN_STOCK_SQL.format(p='p.')}"
+
+    params = []
+    if category and category != 'all':
+        query += ' AND p.category = ?'
+        params.append(category)
+
+    query += ' ORDER BY p.created_at DESC'
+
+    return [serialize_catalog_product(product) for product in db.execute(query, params).fetchall()]
+
+
+# ========== ПАГИНАЦИЯ ТОВАРОВ ==========
+PRODUCTS_PAGE_DEFAULT = 50
+PRODUCTS_PAGE_MAX = 200
+
+
+def encode_products_cursor(row):
+    raw = json.dumps([row['created_at'], row['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_products_cursor(cursor):
+    """Курсор -> (created_at, id); ValueError на мусор"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, product_id = json.loads(raw)
+        return str(created_at), int(product_id)
+    except (TypeError, ValueError, json.JSONDecodeError, UnicodeDecodeError):
+        raise ValueError('Неверный курсор')
+
+
+def get_category_subtree(db, category):
+    """id и названия категории и всех ее потомков (категорию можно передать названием или id)"""
+    rows = db.execute('''
+                      WITH RECURSIVE subtree(id, name) AS (SELECT id, name
+                                                           FROM product_categories
+                                                           WHERE name = ?
+                                                              OR id = ?
+                                                           UNION
+                                                           SELECT pc.id, pc.name
+                                                           FROM product_categories pc
+                                                                    JOIN subtree s ON pc.parent_id = s.id)
+                      SELECT id, name
+                      FROM subtree
+                      ''', (category, category)).fetchall()
+    ids = [row['id'] for row in rows]
+    names = [row['name'] for row in rows] or [category]
+    return ids, names
+
+
+def build_products_filters(db, args, in_stock=None):
+    """WHERE-условия по параметрам запроса: category (с подкатегориями), product_type,
+    min_price/max_price, in_stock. ValueError на неверные значения.
+
+    Возвращает (clauses, params, branches): branches - альтернативы условия на категорию
+    [(sql, params), ...], по одной на столбец, чтобы каждая шла по своему keyset-индексу
+    """
+    clauses, params, branches = [], [], []
+
+    category = args.get('category')
+    if category and category != 'all':
+        ids, names = get_category_subtree(db, category)
+        branches.append((f"p.category IN ({','.join('?' * len(names))})", names))
+        if ids:
+            branches.append((f"p.category_id IN ({','.join('?' * len(ids))})", ids))
+
+    product_type = args.get('product_type')
+    if product_type:
+        if product_type not in ('piece', 'weight'):
+            raise ValueError('Неверный тип товара')
+        clauses.append('p.product_type = ?')
+        params.append(product_type)
+
+    display_price = PRODUCTS_DISPLAY_PRICE_SQL.format(p='p.')
+    if args.get('min_price'):
+        clauses.append(f'{display_price} >= ?')
+        params.append(float(args['min_price']))
+    if args.get('max_price'):
+        clauses.append(f'{display_price} <= ?')
+        params.append(float(args['max_price']))
+
+    if in_stock is None:
+        in_stock = args.get('in_stock') in ('1', 'true')
+    if in_stock:
+        clauses.append(PRODUCTS_IN_STOCK_SQL.format(p='p.'))
+
+    return clauses, params, branches
+
+
+def paginate_products(db, select_sql, clauses, params, args, branches=()):
+    """Страница товаров по (created_at, id) от новых к старым: (строки, next_cursor).
+
+    С branches - отдельный keyset-запрос на каждую альтернативу (OR в одном запросе не идет
+    по индексу), результаты сливаются по (created_at, id) без повторов
+    """
+    limit = min(PRODUCTS_PAGE_MAX, max(1, int(args.get('limit') or PRODUCTS_PAGE_DEFAULT)))
+
+    clauses, params = list(clauses), list(params)
+    cursor = args.get('cursor')
+    if cursor:
+        created_at, product_id = decode_products_cursor(cursor)
+        clauses.append('(p.created_at, p.id) < (?, ?)')
+        params.extend([created_at, product_id])
+
+    rows = {}
+    for branch_sql, branch_params in branches or [(None, [])]:
+        branch_clauses = clauses + [branch_sql] if branch_sql else clauses
+        where = f" WHERE {' AND '.join(branch_clauses)}" if branch_clauses else ''
+        for row in db.execute(f'{select_sql}{where} ORDER BY p.created_at DESC, p.id DESC LIMIT ?',
+                              params + list(branch_params) + [limit + 1]).fetchall():
+            rows[row['id']] = row
+    rows = sorted(rows.values(), key=lambda row: (row['created_at'], row['id']), reverse=True)[:limit + 1]
+
+    next_cursor = encode_products_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def build_catalog_products_page(db, args):
+    """Страница витрины: только товары в наличии, фильтры и курсор из query"""
+    clauses, params, branches = build_products_filters(db, args, in_stock=True)
+    rows, next_cursor = paginate_products(db, f'SELECT {CATALOG_PRODUCT_COLUMNS} FROM products p',
+                                          clauses, params, args, branches)
+    return {
+        'items': [serialize_catalog_product(row) for row in rows],
+        'next_cursor': next_cursor,
+        'has_more': next_cursor is not None
+    }
+
+
 @app.route('/api/products')
+@http_cache('catalog')
 def get_products():
     """Получить товары для клиентского магазина"""
     db = get_db()
     try:
+        # С limit/cursor - страница {items, next_cursor}, без них - весь список, как раньше
+        if 'limit' in request.args or 'cursor' in request.args:
+            args = request.args.to_dict()
+            key = ('products_page',) + tuple(sorted(args.items()))
+            return catalog_cache.respond(db, key, lambda: build_catalog_products_page(db, args))
+
         category = request.args.get('category', 'all')
+        return catalog_cache.respond(db, ('products', category),
+                                     lambda: build_catalog_products(db, category))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify([]), 500
+    finally:
+        db.close()
 
-        query = '''
-                SELECT id, \
-                       name, \
-                       description,
-                       CASE
-                           WHEN product_type = 'weight' AND price_per_kg > 0 THEN price_per_kg
-                           ELSE price
-                           END as price,
-                       CASE
-                           WHEN image_url IS NOT NULL AND image_url != '' THEN image_url
-                           ELSE 'https://via.placeholder.com/300x200?text=No+Image'
-                           END as image_url,
-                       category,
-                       CASE
-                           WHEN product_type = 'weight' AND stock_weight > 0 THEN stock_weight
-                           ELSE stock
-                           END as stock,
-                       product_type,
-                       unit,
-                       weight_unit,
-                       price_per_kg,
-                       min_weight,
-                       max_weight,
-                       step_weight,
-                       stock_weight
-                FROM products
-                WHERE (
-                          (product_type = 'piece' AND stock > 0)
-                              OR
-                          (product_type = 'weight' AND stock_weight > 0)
-                          ) \
-                '''
-
-        params = []
-        if category and category != 'all':
-            query += ' AND category = ?'
-            params.append(category)
-
-        query += ' ORDER BY created_at DESC'
-
-        products = db.execute(query, params).fetchall()
 
-        result = []
-        for product in products:
-            product_dict = dict(product)
-
-            if product_dict.get('product_type') == 'weight':
-                product_dict['display_price'] = product_dict.get('price_per_kg', product_dict['price'])
-                product_dict['display_stock'] = product_dict.get('stock_weight', 0)
-                product_dict['is_weight'] = True
-                product_dict['price_per_kg'] = product_dict.get('price_per_kg', 0)
-            else:
-                product_dict['display_price'] = product_dict['price']
-                product_dict['display_stock'] = product_dict['stock']
-                product_dict['is_weight'] = False
+PRODUCT_DETAIL_COLUMNS = '''id, name, description, price, price_per_kg, image_url, category, stock, stock_weight,
+                            product_type, unit, min_weight, max_weight, step_weight'''
 
-            result.append(product_dict)
+# Лимит id в одном пакетном запросе (лимит параметров SQLite - 999)
+PRODUCTS_BATCH_LIMIT = 500
 
-        db.close()
-        return jsonify(result)
 
-    except Exception as e:
-        if db:
-            db.close()
-        return jsonify([])
+def serialize_product_detail(product):
+    """Товар в формате карточки webapp"""
+    product_dict = dict(product)
 
+    product_dict['display_price'] = product_dict['price']
+    product_dict['display_stock'] = product_dict['stock']
+
+    if product_dict['product_type'] == 'weight':
+        product_dict['is_weight'] = True
+        if product_dict['price_per_kg']:
+            product_dict['display_price'] = product_dict['price_per_kg']
+        product_dict['display_stock'] = product_dict.get('stock_weight', 0)
+        product_dict['weight_unit'] = product_dict.get('unit', 'кг')
+    else:
+        product_dict['is_weight'] = False
+        product_dict['weight_unit'] = None
+
+    if not product_dict.get('image_url'):
+        product_dict['image_url'] = 'https://via.placeholder.com/300x200?text=No+Image'
+
+    required_fields = ['stock', 'stock_weight', 'min_weight', 'max_weight', 'step_weight']
+    for field in required_fields:
+        if field not in product_dict:
+            product_dict[field] = 0 if field in ['min_weight', 'max_weight', 'step_weight'] else None
+
+    return product_dict
+
+
+def product_availability(product, quantity=None, weight=None):
+    """Наличие товара; если передано количество/вес - хватает ли остатка"""
+    if product['product_type'] == 'weight':
+        in_stock = product['stock_weight'] or 0
+        requested = weight
+        unit = 'кг'
+    else:
+        in_stock = product['stock'] or 0
+        requested = quantity
+        unit = 'шт'
+
+    result = {
+        'available': in_stock > 0,
+        'quantity': in_stock,
+        'unit': unit,
+        'product_type': product['product_type']
+    }
+    if requested is not None:
+        result['requested'] = requested
+        result['enough'] = 0 < float(requested) <= in_stock
+    return result
+
+
+def parse_batch_ids(values):
+    """Список id из query (?ids=1,2,3) или JSON; дубликаты и мусор отбрасываются"""
+    if isinstance(values, str):
+        values = values.split(',')
+    ids = []
+    for value in values or []:
+        try:
+            product_id = int(str(value).split('_')[0])
+        except (TypeError, ValueError):
+            continue
+        if product_id not in ids:
+            ids.append(product_id)
+    return ids
+
+
+def fetch_products_by_ids(db, ids, columns=PRODUCT_DETAIL_COLUMNS):
+    """Товары по списку id одним запросом по первичному ключу"""
+    if not ids:
+        return {}
+    placeholders = ','.join('?' * len(ids))
+    rows = db.execute(f'SELECT {columns} FROM products WHERE id IN ({placeholders})', ids).fetchall()
+    return {row['id']: row for row in rows}
+
+
+@app.route('/api/products/batch', methods=['GET', 'POST'])
+def api_products_batch():
+    """Детали и наличие нескольких товаров за один запрос (корзина webapp)"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        ids = parse_batch_ids(data.get('ids'))
+    else:
+        ids = parse_batch_ids(request.args.get('ids', ''))
+
+    if not ids:
+        return jsonify({'success': False, 'error': 'Не переданы id товаров'}), 400
+    if len(ids) > PRODUCTS_BATCH_LIMIT:
+        return jsonify({'success': False, 'error': f'Не больше {PRODUCTS_BATCH_LIMIT} товаров за запрос'}), 400
 
-@app.route('/api/products/<int:product_id>')
-def api_product_detail(product_id):
-    """Получить детали товара по ID для фронтенда"""
     db = get_db()
     try:
-        product = db.execute('''
-                             SELECT id,
-                                    name,
-                                    description,
-                                    price,
-                                    price_per_kg,
-                                    image_url,
-                                    category,
+        products = fetch_products_by_ids(db, ids)
+
+        result = {}
+        for product_id, product in products.items():
+            product_dict = serialize_product_detail(product)
+            product_dict.update(product_availability(product))
+            result[str(product_id)] = product_dict
+
+        return jsonify({
+            'success': True,
+            'products': result,
+            'missing': [product_id for product_id in ids if product_id not in products]
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        db.close()
+
+
+# ========== ПОИСК ТОВАРОВ ==========
+SEARCH_MAX_TERMS = 8
+SEARCH_MIN_TERM_LENGTH = 2
+SEARCH_MAX_PER_PAGE = 100
+# До скольких совпадений считаем bm25 по всем; для более широких запросов - новые товары первыми
+SEARCH_RANKED_LIMIT = 1000
+# Сколько совпадений просматриваем для фасетов широкого запроса
+SEARCH_FACET_SAMPLE = 500
+
+# Веса bm25 для колонок products_fts: название важнее категории, категория важнее описания
+SEARCH_COLUMN_WEIGHTS = (10.0, 1.0, 4.0)
+
+
+def build_search_match(query):
+    """Строка запроса -> выражение FTS5 MATCH: каждое слово ищется по префиксу"""
+    normalized = query.lower().replace('ё', 'е')
+    terms = [term for term in re.findall(r'\w+', normalized) if len(term) >= SEARCH_MIN_TERM_LENGTH]
+    return ' '.join(f'"{term}"*' for term in terms[:SEARCH_MAX_TERMS])
+
+
+def search_products(db, query, category=None, in_stock=True, page=1, per_page=20):
+    """Поиск по products_fts с фасетами по категориям.
+
+    Селективные запросы ранжируются bm25 и считаются точно. Для широких (больше
+    SEARCH_RANKED_LIMIT совпадений) bm25 по всем строкам дорог, поэтому выдача идет
+    от новых товаров, фасеты считаются по выборке, а total с фильтрами - до
+    SEARCH_RANKED_LIMIT + 1 строк; такой ответ помечается exact=False.
+    """
+    match = build_search_match(query)
+    if not match:
+        return {'items': [], 'total': 0, 'exact': True, 'mode': 'ranked', 'facets': {'categories': []}}
+
+    matches = db.execute('SELECT COUNT(*) FROM products_fts WHERE products_fts MATCH ?', (match,)).fetchone()[0]
+    ranked = matches <= SEARCH_RANKED_LIMIT
+
+    filters = f" AND {PRODUCTS_IN_STOCK_SQL.format(p='p.')}" if in_stock else ''
+    params = [match]
+
+    if ranked:
+        facets = db.execute(f'''
+                            SELECT p.category, COUNT(*) AS count
+                            FROM products_fts
+                                     JOIN products p ON p.id = products_fts.rowid
+                            WHERE products_fts MATCH ? {filters}
+                            GROUP BY p.category
+                            ORDER BY count DESC, p.category
+                            ''', params).fetchall()
+    else:
+        facets = db.execute(f'''
+                            SELECT category, COUNT(*) AS count
+                            FROM (SELECT p.category
+                                  FROM products_fts
+                                           JOIN products p ON p.id = products_fts.rowid
+                                  WHERE products_fts MATCH ? {filters}
+                                  ORDER BY products_fts.rowid DESC
+                                  LIMIT {SEARCH_FACET_SAMPLE})
+                            GROUP BY category
+                            ORDER BY count DESC, category
+                            ''', params).fetchall()
+
+    category = category if category != 'all' else None
+    if category:
+        filters += ' AND p.category = ?'
+        params.append(category)
+
+    if ranked:
+        total = sum(row['count'] for row in facets if not category or row['category'] == category)
+    elif filters:
+        # Полный COUNT(*) по join широкого запроса дороже самой страницы - считаем с потолком.
+        # CROSS JOIN держит products_fts внешней таблицей: иначе при фильтре по категории SQLite
+        # идет по idx_products_category_created и выполняет MATCH заново для каждой строки
+        total = db.execute(f'''
+                           SELECT COUNT(*)
+                           FROM (SELECT 1
+                                 FROM products_fts
+                                          CROSS JOIN products p ON p.id = products_fts.rowid
+                                 WHERE products_fts MATCH ? {filters}
+                                 LIMIT {SEARCH_RANKED_LIMIT + 1})
+                           ''', params).fetchone()[0]
+    else:
+        total = matches
+
+    if ranked:
+        weights = ', '.join(str(weight) for weight in SEARCH_COLUMN_WEIGHTS)
+        order_by = f'bm25(products_fts, {weights})'
+    else:
+        order_by = 'products_fts.rowid DESC'
+
+    rows = db.execute(f'''
+                      SELECT p.id,
+                             p.name,
+                             p.description,
+                             p.price,
+                             p.price_per_kg,
+                             p.image_url,
+                             p.category,
+                             p.stock,
+                             p.stock_weight,
+                             p.product_type,
+                             p.unit
+                      FROM products_fts
+                               CROSS JOIN products p ON p.id = products_fts.rowid
+                      WHERE products_fts MATCH ? {filters}
+                      ORDER BY {order_by}
+                      LIMIT ? OFFSET ?
+                      ''', params + [per_page, (page - 1) * per_page]).fetchall()
+
+    items = []
+    for row in rows:
+        item = dict(row)
+        item['is_weight'] = item['product_type'] == 'weight'
+        item['display_price'] = item['price_per_kg'] if item['is_weight'] and item['price_per_kg'] else item['price']
+        item['display_stock'] = item['stock_weight'] if item['is_weight'] else item['stock']
+        items.append(item)
+
+    return {
+        'items': items,
+        'total': total,
+        'exact': ranked,
+        'mode': 'ranked' if ranked else 'recent',
+        'facets': {'categories': [{'category': row['category'], 'count': row['count']} for row in facets]}
+    }
+
+
+search_cache = CatalogCache(max_entries=int(os.environ.get('SEARCH_CACHE_ENTRIES', 512)))
+
+
+@app.route('/api/products/search', methods=['GET'])
+@http_cache('catalog')
+def api_products_search():
+    """Поиск товаров: ?q=&category=&page=&per_page=&in_stock="""
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'success': False, 'error': 'Введите запрос'}), 400
+
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(SEARCH_MAX_PER_PAGE, max(1, int(request.args.get('per_page', 20))))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Неверные параметры страницы'}), 400
+
+    category = request.args.get('category') or 'all'
+    in_stock = request.args.get('in_stock', '1') != '0'
+
+    def build():
+        result = search_products(db, query, category=category, in_stock=in_stock, page=page, per_page=per_page)
+        result.update({
+            'success': True,
+            'query': query,
+            'page': page,
+            'per_page': per_page,
+            'pages': math.ceil(result['total'] / per_page) if result['total'] else 0
+        })
+        return result
+
+    db = get_db()
+    try:
+        # Ключ по исходной строке: ответ возвращает ее в 'query'
+        key = ('search', query, category, in_stock, page, per_page)
+        return search_cache.respond(db, key, build)
+    except sqlite3.OperationalError as e:
+        return jsonify({'success': False, 'error': f'Ошибка поиска: {e}'}), 400
+    finally:
+        db.close()
+
+
+@app.route('/api/products/availability', methods=['POST'])
+def check_products_availability():
+    """Проверить наличие списка позиций корзины: [{id, quantity, weight}]"""
+    data = request.get_json(silent=True) or {}
+    items = data.get('items') or []
+
+    if not items:
+        return jsonify({'success': False, 'error': 'Корзина пуста'}), 400
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify({'success': False, 'error': 'Неверный формат позиций'}), 400
+    if len(items) > PRODUCTS_BATCH_LIMIT:
+        return jsonify({'success': False, 'error': f'Не больше {PRODUCTS_BATCH_LIMIT} товаров за запрос'}), 400
+
+    db = get_db()
+    try:
+        products = fetch_products_by_ids(db, parse_batch_ids(parse_cart_product_id(item) for item in items),
+                                         'id, name, product_type, stock, stock_weight')
+
+        result = []
+        for item in items:
+            product_id = parse_cart_product_id(item)
+            product = products.get(product_id)
+            if not product:
+                result.append({'id': product_id, 'available': False, 'enough': False, 'error': 'Товар не найден'})
+                continue
+
+            is_weight = product['product_type'] == 'weight'
+            try:
+                quantity = None if is_weight else int(item.get('quantity') or 1)
+                weight = float(item.get('weight') or 0) if is_weight else None
+                if weight is not None and not math.isfinite(weight):
+                    raise ValueError(weight)
+            except (TypeError, ValueError):
+                # Битая позиция не роняет весь ответ: помечаем ее, как build_quote помечает неизвестные
+                result.append({'id': product_id, 'name': product['name'], 'available': False, 'enough': False,
+                               'error': 'Неверное количество'})
+                continue
+
+            entry = product_availability(product, quantity=quantity, weight=weight)
+            entry.update({'id': product_id, 'name': product['name']})
+            result.append(entry)
+
+        return jsonify({
+            'success': True,
+            'items': result,
+            'all_available': all(entry['enough'] for entry in result)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        db.close()
+
+
+@app.route('/api/products/<int:product_id>')
+def api_product_detail(product_id):
+    """Получить детали товара по ID для фронтенда"""
+    db = get_db()
+    try:
+        product = db.execute('''
+                             SELECT id,
+                                    name,
+                                    description,
+                                    price,
+                                    price_per_kg,
+                                    image_url,
+                                    category,
                                     stock,
                                     stock_weight,
                                     product_type,
@@ -2556,28 +4635,7 @@ def api_product_detail(product_id):
             db.close()
             return jsonify({'error': 'Товар не найден'}), 404
 
-        product_dict = dict(product)
-
-        product_dict['display_price'] = product_dict['price']
-        product_dict['display_stock'] = product_dict['stock']
-
-        if product_dict['product_type'] == 'weight':
-            product_dict['is_weight'] = True
-            if product_dict['price_per_kg']:
-                product_dict['display_price'] = product_dict['price_per_kg']
-            product_dict['display_stock'] = product_dict.get('stock_weight', 0)
-            product_dict['weight_unit'] = product_dict.get('unit', 'кг')
-        else:
-            product_dict['is_weight'] = False
-            product_dict['weight_unit'] = None
-
-        if not product_dict.get('image_url'):
-            product_dict['image_url'] = 'https://via.placeholder.com/300x200?text=No+Image'
-
-        required_fields = ['stock', 'stock_weight', 'min_weight', 'max_weight', 'step_weight']
-        for field in required_fields:
-            if field not in product_dict:
-                product_dict[field] = 0 if field in ['min_weight', 'max_weight', 'step_weight'] else None
+        product_dict = serialize_product_detail(product)
 
         db.close()
         return jsonify(product_dict)
@@ -2603,24 +4661,8 @@ def check_product_availability(product_id):
             db.close()
             return jsonify({'available': False, 'error': 'Товар не найден'})
 
-        product_data = dict(product)
-
-        if product_data['product_type'] == 'weight':
-            available = product_data['stock_weight'] > 0 if product_data['stock_weight'] is not None else False
-            quantity = product_data['stock_weight'] or 0
-            unit = 'кг'
-        else:
-            available = product_data['stock'] > 0 if product_data['stock'] is not None else False
-            quantity = product_data['stock'] or 0
-            unit = 'шт'
-
         db.close()
-        return jsonify({
-            'available': available,
-            'quantity': quantity,
-            'unit': unit,
-            'product_type': product_data['product_type']
-        })
+        return jsonify(product_availability(product))
 
     except Exception as e:
         if db:
@@ -2628,40 +4670,53 @@ def check_product_availability(product_id):
         return jsonify({'available': False, 'error': str(e)})
 
 
+def build_catalog_categories(db):
+    """Категории, в которых есть товары в наличии"""
+    categories = db.execute('''
+                            SELECT DISTINCT category
+                            FROM products
+                            WHERE category IS NOT NULL
+                              AND category != '' 
+          AND (
+            (product_type = 'piece' AND stock > 0) 
+            OR 
+            (product_type = 'weight' AND stock_weight > 0)
+          )
+                            ORDER BY category
+                            ''').fetchall()
+
+    category_list = [row['category'] for row in categories if row['category']]
+
+    return category_list
+
+
 @app.route('/api/categories')
+@http_cache('reference')
 def api_categories():
     """Получить список категорий"""
     db = get_db()
     try:
-        categories = db.execute('''
-                                SELECT DISTINCT category
-                                FROM products
-                                WHERE category IS NOT NULL
-                                  AND category != '' 
-              AND (
-                (product_type = 'piece' AND stock > 0) 
-                OR 
-                (product_type = 'weight' AND stock_weight > 0)
-              )
-                                ORDER BY category
-                                ''').fetchall()
+        return catalog_cache.respond(db, ('categories',), lambda: build_catalog_categories(db))
+    except Exception as e:
+        return jsonify([]), 500
+    finally:
+        db.close()
 
-        category_list = [row['category'] for row in categories if row['category']]
 
-        db.close()
-        return jsonify(category_list)
+class CategoryTreeCache:
+    """Дерево категорий с прямыми и суммарными по поддереву количествами товаров.
 
-    except Exception as e:
-        if db:
-            db.close()
-        return jsonify([])
+    Строится двумя запросами (категории + одна группировка товаров) и живет, пока не
+    изменились версии 'catalog' и 'discounts' (в дереве есть названия скидок).
+    """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._roots = []
+        self._nodes = {}
 
-@app.route('/api/categories/tree', methods=['GET'])
-def get_categories_tree():
-    """Получить дерево категорий"""
-    db = get_db()
-    try:
+    def _build(self, db):
         categories = db.execute('''
                                 SELECT pc.*, d.name as discount_name
                                 FROM product_categories pc
@@ -2669,36 +4724,92 @@ def get_categories_tree():
                                 ORDER BY pc.sort_order, pc.name
                                 ''').fetchall()
 
-        categories_dict = {}
-        root_categories = []
-
+        nodes = {}
+        by_name = {}
         for cat in categories:
-            cat_dict = dict(cat)
-            cat_dict['children'] = []
-            product_count = db.execute(
-                'SELECT COUNT(*) FROM products WHERE category = ? OR category_id = ?',
-                (cat_dict['name'], cat_dict['id'])
-            ).fetchone()[0]
-            cat_dict['product_count'] = product_count
-            cat_dict['has_products'] = product_count > 0
-            categories_dict[cat_dict['id']] = cat_dict
-
-        for cat_id, cat in categories_dict.items():
-            if cat['parent_id']:
-                if cat['parent_id'] in categories_dict:
-                    categories_dict[cat['parent_id']]['children'].append(cat)
-            else:
-                root_categories.append(cat)
+            node = dict(cat)
+            node['children'] = []
+            node['product_count'] = 0
+            nodes[node['id']] = node
+            by_name.setdefault(node['name'], node['id'])
+
+        # Товар относится к категории по category_id, а без него - по названию в products.category
+        for row in db.execute('''
+                              SELECT category_id, category, COUNT(*) AS count
+                              FROM products
+                              GROUP BY category_id, category
+                              ''').fetchall():
+            category_id = row['category_id'] if row['category_id'] in nodes else by_name.get(row['category'])
+            if category_id is not None:
+                nodes[category_id]['product_count'] += row['count']
+
+        roots = []
+        for node in nodes.values():
+            if node['parent_id'] and node['parent_id'] in nodes:
+                nodes[node['parent_id']]['children'].append(node)
+            elif not node['parent_id']:
+                roots.append(node)
+
+        def fill_subtree(node, path):
+            # path защищает от циклов parent_id в данных
+            total = node['product_count']
+            for child in node['children']:
+                if child['id'] not in path:
+                    total += fill_subtree(child, path | {child['id']})
+            node['subtree_product_count'] = total
+            node['has_products'] = node['product_count'] > 0
+            return total
+
+        for root in roots:
+            fill_subtree(root, {root['id']})
+        for node in nodes.values():
+            node.setdefault('subtree_product_count', node['product_count'])
+            node.setdefault('has_products', node['product_count'] > 0)
+
+        return roots, nodes
+
+    def _refresh(self, db):
+        version = (get_cache_version(db, 'catalog'), get_cache_version(db, 'discounts'))
+        with self._lock:
+            if version != self._version:
+                self._roots, self._nodes = self._build(db)
+                self._version = version
+            return self._roots, self._nodes
+
+    def roots(self, db):
+        """Корни дерева; структура общая для всех запросов - не изменять"""
+        return self._refresh(db)[0]
+
+    def node(self, db, category_id):
+        return self._refresh(db)[1].get(category_id)
+
+
+category_tree_cache = CategoryTreeCache()
+
+
+def build_catalog_categories_tree(db):
+    """Дерево категорий с количеством товаров"""
+    return category_tree_cache.roots(db)
 
-        db.close()
-        return jsonify(root_categories)
+
+@app.route('/api/categories/tree', methods=['GET'])
+@http_cache('reference')
+def get_categories_tree():
+    """Получить дерево категорий"""
+    db = get_db()
+    try:
+        # В дереве есть названия скидок, поэтому ключ учитывает и их версию
+        return catalog_cache.respond(db, ('categories_tree',), lambda: build_catalog_categories_tree(db),
+                                     extra_version=get_cache_version(db, 'discounts'))
     except Exception as e:
+        return jsonify([]), 500
+    finally:
         db.close()
-        return jsonify([])
 
 
 @app.route('/api/create-order', methods=['POST'])
 @rate_limit(max_requests=30, window=60)
+@idempotent('create-order', ignore_fields=('quote_token',))
 @validate_json_request
 def api_create_order():
     data = request.json
@@ -2724,84 +4835,30 @@ def api_create_order():
         if delivery_type == 'pickup' and not data.get('pickup_point'):
             return jsonify({'success': False, 'error': 'Для самовывоза выберите пункт выдачи'}), 400
 
-        discount_amount = 0.0
-        promo_code_id = None
-        promo_dict = None
-
-        if promo_code:
-            try:
-                promo_result = db.execute('''
-                                          SELECT id,
-                                                 discount_type,
-                                                 value,
-                                                 min_order_amount,
-                                                 usage_limit,
-                                                 used_count,
-                                                 exclude_sale_items,
-                                                 is_active
-                                          FROM promo_codes
-                                          WHERE code = ?
-                                            AND is_active = 1
-                                          ''', (promo_code.upper(),)).fetchone()
-
-                if promo_result:
-                    promo_dict = dict(promo_result)
-
-                    if promo_dict['usage_limit'] and promo_dict['used_count'] >= promo_dict['usage_limit']:
-                        pass
-                    else:
-                        items_total = 0.0
-                        for item in data['items']:
-                            price = float(item.get('price', 0))
-                            quantity = float(item.get('quantity', 1))
-
-                            if item.get('is_weight'):
-                                items_total += float(item.get('price', 0))
-                            else:
-                                items_total += price * quantity
-
-                        if promo_dict['min_order_amount'] and items_total < float(promo_dict['min_order_amount']):
-                            pass
-                        else:
-                            promo_code_id = promo_dict['id']
-
-                            if promo_dict['discount_type'] == 'percentage':
-                                discount_amount = items_total * (float(promo_dict['value']) / 100)
-                            elif promo_dict['discount_type'] == 'fixed':
-                                discount_amount = float(promo_dict['value'])
-                            elif promo_dict['discount_type'] == 'free_delivery':
-                                discount_amount = 0
-            except Exception as e:
-                discount_amount = 0.0
-
-        try:
-            order_total = 0.0
-
-            for item in data['items']:
-                if item.get('is_weight'):
-                    item_total = float(item.get('price', 0))
-                    order_total += item_total
-                else:
-                    price = float(item.get('price', 0))
-                    quantity = float(item.get('quantity', 1))
-                    item_total = price * quantity
-                    order_total += item_total
+        # Подписанный расчет из /api/quote принимаем без пересчета, иначе считаем по ценам из БД
+        quote = load_signed_quote(data.get('quote_token'))
+        if not quote or not quote_matches_cart(quote, data['items'], promo_code, delivery_type):
+            quote = build_quote(db, data['items'], promo_code, delivery_type)
 
-            if discount_amount > 0:
-                order_total = max(0, order_total - discount_amount)
+        if quote['unknown_items']:
+            return jsonify({'success': False, 'error': 'Некоторые товары больше не продаются'}), 400
 
-        except Exception as e:
-            order_total = 0.0
-
-        delivery_cost = 0.0
+        order_total = quote['order_total']
+        delivery_cost = quote['delivery_cost']
+        discount_amount = quote['promo_discount']
+        promo_code_id = quote['promo_code_id']
 
-        if delivery_type == 'courier':
-            if promo_code and promo_dict and promo_dict['discount_type'] == 'free_delivery':
-                pass
-            elif order_total < 1000.0:
-                delivery_cost = 100.0
-            else:
-                pass
+        quoted_items = {}
+        for quoted in quote['items']:
+            quoted_items.setdefault(quoted['id'], []).append(quoted)
+        for item in data['items']:
+            candidates = quoted_items.get(parse_cart_product_id(item))
+            if candidates:
+                quoted = candidates.pop(0)
+                item['price'] = quoted['price']
+                item['original_price'] = quoted['original_price']
+                if not item.get('name'):
+                    item['name'] = quoted['name']
 
         total_with_delivery = order_total + delivery_cost
 
@@ -2933,60 +4990,98 @@ def api_create_order():
                 import random
                 user_id = random.randint(100000000, 999999999)
 
-        cursor = db.execute('''
-                            INSERT INTO orders (user_id, username, items, total_price, delivery_cost, status,
-                                                delivery_type, delivery_address, pickup_point,
-                                                payment_method, recipient_name, phone_number,
-                                                cash_received, cash_change, cash_details,
-                                                promo_code_id, discount_amount)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            ''', (
-                                user_id,
-                                username,
-                                json.dumps(data['items'], ensure_ascii=False),
-                                order_total,
-                                delivery_cost,
-                                'pending',
-                                delivery_type,
-                                json.dumps(full_address_obj, ensure_ascii=False),
-                                data.get('pickup_point'),
-                                payment_method,
-                                recipient_name,
-                                phone_number,
-                                cash_received,
-                                cash_change,
-                                cash_details,
-                                promo_code_id,
-                                discount_amount
-                            ))
+        # Вся запись заказа - одна транзакция BEGIN IMMEDIATE: промокод и остатки списываются
+        # условными UPDATE, при исчерпанном лимите или нехватке товара заказ не создается
+        with stock_reservations.transaction(db):
+            promo = {'id': promo_code_id, 'code': quote['promo_code']}
+            promo_claimed, promo_exhausted = promo_redemptions.claim(db, promo) if promo_code_id else (True, False)
+            if not promo_claimed:
+                # Точная причина (исчерпан, истек, выключен) - из find_promo_code, он же ее закэширует
+                _, promo_error = find_promo_code(db, promo['code'])
+                return jsonify({'success': False, 'error': promo_error or PROMO_ERROR_EXHAUSTED}), 400
+
+            address_columns = order_address_columns(full_address_obj)
+            cursor = db.execute(f'''
+                                INSERT INTO orders (user_id, username, items, total_price, delivery_cost, status,
+                                                    delivery_type, delivery_address, pickup_point,
+                                                    payment_method, recipient_name, phone_number,
+                                                    cash_received, cash_change, cash_details,
+                                                    promo_code_id, discount_amount, {', '.join(address_columns)})
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?{', ?' * len(address_columns)})
+                                ''', (
+                                    user_id,
+                                    username,
+                                    json.dumps(data['items'], ensure_ascii=False),
+                                    order_total,
+                                    delivery_cost,
+                                    'pending',
+                                    delivery_type,
+                                    json.dumps(full_address_obj, ensure_ascii=False),
+                                    data.get('pickup_point'),
+                                    payment_method,
+                                    recipient_name,
+                                    phone_number,
+                                    cash_received,
+                                    cash_change,
+                                    cash_details,
+                                    promo_code_id,
+                                    discount_amount,
+                                    *address_columns.values()
+                                ))
 
-        if promo_code_id:
-            try:
-                db.execute('UPDATE promo_codes SET used_count = used_count + 1 WHERE id = ?',
-                           (promo_code_id,))
-            except Exception as e:
-                pass
+            order_id = cursor.lastrowid
 
-        order_id = cursor.lastrowid
+            shortfalls = stock_reservations.reserve(db, order_id, quote['items'])
+            if shortfalls:
+                return jsonify({'success': False, 'error': format_stock_shortfalls(shortfalls),
+                                'shortfalls': shortfalls}), 400
 
-        for item in data['items']:
-            try:
-                quantity = int(item.get('quantity', 1))
-                product_id = item.get('id')
-
-                if product_id:
-                    if item.get('is_weight'):
-                        weight = item.get('weight', 0)
-                        if weight > 0:
-                            db.execute('UPDATE products SET stock_weight = stock_weight - ? WHERE id = ?',
-                                       (weight, product_id))
-                    else:
-                        db.execute('UPDATE products SET stock = stock - ? WHERE id = ?',
-                                   (quantity, product_id))
-            except Exception as e:
-                pass
+            insert_order_items(db, order_id, data['items'])
+            record_order_event(db, order_id, ORDER_EVENT_CREATED, f'customer:{user_id}', to_status='pending',
+                               delivery_type=delivery_type, total_price=order_total)
 
-        db.commit()
+            bump_cache_version(db, 'catalog')
+
+            # Уведомления пишутся в outbox в той же транзакции, что и заказ;
+            # в Telegram их доставляет фоновый диспетчер уже после ответа клиенту
+            if delivery_type == 'pickup':
+                if user_id and user_id > 0:
+                    enqueue_notification(db, 'pickup_order', order_id, telegram_id=user_id,
+                                         items=data.get('items', []),
+                                         pickup_point=data.get('pickup_point', ''),
+                                         order_total=order_total,
+                                         discount_amount=discount_amount,
+                                         username=username,
+                                         total_with_delivery=total_with_delivery)
+
+                enqueue_notification(db, 'admin_pickup', order_id)
+
+            else:
+                if user_id and user_id > 0:
+                    enqueue_notification(db, 'order_details', order_id, telegram_id=user_id,
+                                         items=data.get('items', []),
+                                         status='created',
+                                         delivery_type=delivery_type)
+
+                enqueue_notification(db, 'admin_order', order_id)
+
+                if delivery_type == 'courier':
+                    enqueue_notification(db, 'courier_order', order_id)
+
+            result = {
+                'success': True,
+                'order_id': order_id,
+                'delivery_cost': delivery_cost,
+                'total_with_delivery': total_with_delivery,
+                'discount_amount': discount_amount,
+                'order_total': order_total
+            }
+            # Ответ для повторов с тем же Idempotency-Key фиксируется вместе с заказом
+            record_idempotent_response(db, result)
+            db.commit()
+        if promo_exhausted:
+            promo_redemptions.mark_exhausted(db, promo)
+        notification_dispatcher.wake()
 
         try:
             db.execute('INSERT OR IGNORE INTO active_chats (order_id, customer_id, status) VALUES (?, ?, "active")',
@@ -2995,65 +5090,12 @@ def api_create_order():
         except Exception as e:
             pass
 
-        if delivery_type == 'pickup':
-            if user_id and user_id > 0:
-                try:
-                    send_pickup_order_notification(
-                        telegram_id=user_id,
-                        order_id=order_id,
-                        items=data.get('items', []),
-                        pickup_point=data.get('pickup_point', ''),
-                        order_total=order_total,
-                        discount_amount=discount_amount,
-                        username=username,
-                        total_with_delivery=total_with_delivery
-                    )
-                except Exception as e:
-                    pass
-
-            try:
-                send_admin_pickup_notification(order_id)
-            except Exception as e:
-                pass
-
-        else:
-            if user_id and user_id > 0:
-                try:
-                    send_order_details_notification(
-                        telegram_id=user_id,
-                        order_id=order_id,
-                        items=data.get('items', []),
-                        status='created',
-                        delivery_type=delivery_type
-                    )
-                except Exception as e:
-                    pass
-
-            try:
-                send_admin_order_notification(order_id)
-            except Exception as e:
-                pass
-
-            if delivery_type == 'courier':
-                try:
-                    send_courier_order_notification(order_id)
-                except Exception as e:
-                    pass
-
-        return jsonify({
-            'success': True,
-            'order_id': order_id,
-            'delivery_cost': delivery_cost,
-            'total_with_delivery': total_with_delivery,
-            'discount_amount': discount_amount,
-            'order_total': order_total
-        })
+        return jsonify(result)
 
     except Exception as e:
+        # Заказ, списание промокода и остатки не закоммичены - откатываем их вместе
         try:
-            if order_id:
-                db.execute('DELETE FROM orders WHERE id = ?', (order_id,))
-                db.commit()
+            db.rollback()
         except:
             pass
 
@@ -3067,36 +5109,36 @@ def api_create_order():
 
 def send_admin_order_notification(order_id):
     """Отправить уведомление админу о новом заказе"""
+    db = None
     try:
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
         ADMIN_TELEGRAM_IDS = 7331765165
 
-        if not BOT_TOKEN:
-            return False
+        if not telegram_client.token:
+            return NotificationSkipped('BOT_TOKEN не задан')
 
         db = get_db()
         order = db.execute('''
                            SELECT o.*,
-                                  json_extract(o.delivery_address, '$.city')           as city,
-                                  json_extract(o.delivery_address, '$.street')         as street,
-                                  json_extract(o.delivery_address, '$.house')          as house,
-                                  json_extract(o.delivery_address, '$.building')       as building,
-                                  json_extract(o.delivery_address, '$.entrance')       as entrance,
-                                  json_extract(o.delivery_address, '$.apartment')      as apartment,
-                                  json_extract(o.delivery_address, '$.floor')          as floor,
-                                  json_extract(o.delivery_address, '$.doorcode')       as doorcode,
-                                  json_extract(o.delivery_address, '$.comment')        as address_comment,
-                                  json_extract(o.delivery_address, '$.recipient_name') as recipient_name_full,
-                                  json_extract(o.delivery_address, '$.phone')          as phone_full,
+                                  o.address_city           as city,
+                                  o.address_street         as street,
+                                  o.address_house          as house,
+                                  o.address_building       as building,
+                                  o.address_entrance       as entrance,
+                                  o.address_apartment      as apartment,
+                                  o.address_floor          as floor,
+                                  o.address_doorcode       as doorcode,
+                                  o.address_comment        as address_comment,
+                                  o.address_recipient_name as recipient_name_full,
+                                  o.address_phone          as phone_full,
                                   (o.total_price + COALESCE(o.delivery_cost, 0) -
-                                   COALESCE(o.discount_amount, 0))                     as total_amount
+                                   COALESCE(o.discount_amount, 0)) as total_amount
                            FROM orders o
                            WHERE o.id = ?
                            ''', (order_id,)).fetchone()
 
         if not order:
             db.close()
-            return False
+            return NotificationSkipped('Заказ не найден')
 
         order_data = dict(order)
         db.close()
@@ -3169,74 +5211,65 @@ def send_admin_order_notification(order_id):
         if isinstance(ADMIN_TELEGRAM_IDS, (int, float)):
             admin_ids = [int(ADMIN_TELEGRAM_IDS)]
 
-        success_count = 0
-        for admin_id in admin_ids:
-            try:
-                response = requests.post(
-                    f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage',
-                    json={
-                        'chat_id': int(admin_id),
-                        'text': text,
-                        'parse_mode': 'Markdown',
-                        'reply_markup': json.dumps(keyboard)
-                    },
-                    timeout=10
-                )
-                if response.status_code == 200:
-                    success_count += 1
-            except:
-                pass
+        results = telegram_fanout.send(admin_ids, {
+            'text': text,
+            'parse_mode': 'Markdown',
+            'reply_markup': json.dumps(keyboard)
+        })
 
-        return success_count > 0
+        return any(result['ok'] for result in results)
 
     except Exception as e:
         return False
+    finally:
+        if db:
+            db.close()
 
 
 def handle_order_ready_callback(call):
     """Обработчик нажатия на кнопку 'Заказ готов'"""
+    db = None
     try:
         order_id = int(call.data.replace('order_ready_', ''))
 
         db = get_db()
-        db.execute('UPDATE orders SET status = ? WHERE id = ?',
-                   ('ready_for_pickup', order_id))
+        transition_order(db, order_id, 'ready_for_pickup', 'telegram')
         db.commit()
         db.close()
 
         send_order_ready_notification(order_id)
 
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
-        if BOT_TOKEN:
-            url = f'https://api.telegram.org/bot{BOT_TOKEN}/answerCallbackQuery'
+        if telegram_client.token:
             data = {
                 'callback_query_id': call.id,
                 'text': f'✅ Заказ #{order_id} помечен как готовый. Клиент уведомлен!',
                 'show_alert': True
             }
-            requests.post(url, json=data)
+            telegram_client.call('answerCallbackQuery', data)
 
-            url = f'https://api.telegram.org/bot{BOT_TOKEN}/editMessageText'
             data = {
                 'chat_id': call.message.chat.id,
                 'message_id': call.message.message_id,
                 'text': f"✅ *ЗАКАЗ #{order_id} ГОТОВ*\n\nКлиент получил уведомление о готовности заказа.",
                 'parse_mode': 'Markdown'
             }
-            requests.post(url, json=data)
+            telegram_client.call('editMessageText', data)
 
     except Exception as e:
         pass
+    finally:
+        if db:
+            db.close()
 
 
 def send_admin_pickup_notification(order_id):
     """Отправить админу уведомление о заказе на самовывоз"""
+    db = None
     try:
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
         ADMIN_TELEGRAM_IDS = 7331765165
 
-        if not BOT_TOKEN:
-            return False
+        if not telegram_client.token:
+            return NotificationSkipped('BOT_TOKEN не задан')
 
         admin_ids = []
         if ADMIN_TELEGRAM_IDS:
@@ -3254,7 +5287,7 @@ def send_admin_pickup_notification(order_id):
                 return False
 
         if not admin_ids:
-            return False
+            return NotificationSkipped('Не заданы telegram_id админов')
 
         db = get_db()
 
@@ -3268,7 +5301,7 @@ def send_admin_pickup_notification(order_id):
 
         if not order:
             db.close()
-            return False
+            return NotificationSkipped('Заказ не найден')
 
         order_data = dict(order)
 
@@ -3341,45 +5374,33 @@ def send_admin_pickup_notification(order_id):
             ]
         }
 
-        success_count = 0
-        for admin_id in admin_ids:
-            try:
-                url = f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage'
-                data = {
-                    'chat_id': int(admin_id),
-                    'text': text,
-                    'parse_mode': 'Markdown',
-                    'reply_markup': json.dumps(keyboard)
-                }
-
-                response = requests.post(url, json=data, timeout=10)
-
-                if response.status_code == 200:
-                    success_count += 1
-                else:
-                    pass
-
-            except Exception as e:
-                pass
+        results = telegram_fanout.send(admin_ids, {
+            'text': text,
+            'parse_mode': 'Markdown',
+            'reply_markup': json.dumps(keyboard)
+        })
 
-        return success_count > 0
+        return any(result['ok'] for result in results)
 
     except Exception as e:
         return False
+    finally:
+        if db:
+            db.close()
 
 
 def send_pickup_order_notification(telegram_id, order_id, items, pickup_point, order_total, discount_amount, username,
                                    total_with_delivery):
     """Отправить специальное уведомление для заказа с самовывозом"""
+    db = None
     try:
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
         WEBAPP_URL = os.getenv('WEBAPP_URL', 'https://smof-shop.ru/')
 
         if not telegram_id or telegram_id == 0:
-            return False
+            return NotificationSkipped('Нет telegram_id получателя')
 
-        if not BOT_TOKEN:
-            return False
+        if not telegram_client.token:
+            return NotificationSkipped('BOT_TOKEN не задан')
 
         db = get_db()
         pickup_info = None
@@ -3461,7 +5482,6 @@ def send_pickup_order_notification(telegram_id, order_id, items, pickup_point, o
             ]
         }
 
-        url = f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage'
         data = {
             'chat_id': int(telegram_id),
             'text': message,
@@ -3470,19 +5490,18 @@ def send_pickup_order_notification(telegram_id, order_id, items, pickup_point, o
             'reply_markup': json.dumps(keyboard)
         }
 
-        response = requests.post(url, json=data, timeout=10)
-
-        if response.status_code == 200:
-            return True
-        else:
-            return False
+        return telegram_client.call('sendMessage', data)['ok']
 
     except Exception as e:
         return False
+    finally:
+        if db:
+            db.close()
 
 
 def send_order_ready_notification(order_id):
     """Отправить уведомление клиенту что заказ готов к выдаче"""
+    db = None
     try:
         db = get_db()
 
@@ -3528,8 +5547,7 @@ def send_order_ready_notification(order_id):
 
         db.close()
 
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
-        if not BOT_TOKEN:
+        if not telegram_client.token:
             return False
 
         message = f"""✅ *ВАШ ЗАКАЗ ГОТОВ К ВЫДАЧЕ!*
@@ -3549,21 +5567,18 @@ def send_order_ready_notification(order_id):
 
 🎉 *Спасибо за покупку!*"""
 
-        url = f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage'
         data = {
             'chat_id': int(telegram_id),
             'text': message,
             'parse_mode': 'Markdown'}
 
-        response = requests.post(url, json=data, timeout=10)
-
-        if response.status_code == 200:
-            return True
-        else:
-            return False
+        return telegram_client.call('sendMessage', data)['ok']
 
     except Exception as e:
         return False
+    finally:
+        if db:
+            db.close()
 
 
 @app.route('/api/admin/orders/<int:order_id>/ready-for-pickup', methods=['POST'])
@@ -3580,8 +5595,7 @@ def admin_mark_order_ready_for_pickup(order_id):
         if order_dict.get('delivery_type') != 'pickup':
             return jsonify({'success': False, 'error': 'Это не заказ на самовывоз'}), 400
 
-        db.execute('UPDATE orders SET status = ? WHERE id = ?',
-                   ('ready_for_pickup', order_id))
+        transition_order(db, order_id, 'ready_for_pickup', 'admin')
 
         db.commit()
 
@@ -3774,10 +5788,12 @@ def api_admin_send_message():
 
         order_dict = dict(order)
 
-        db.execute('''
-                   INSERT INTO chat_messages (order_id, user_id, message, sender_type)
-                   VALUES (?, 0, ?, 'admin')
-                   ''', (order_id, message))
+        cursor = db.execute('''
+                            INSERT INTO chat_messages (order_id, user_id, message, sender_type)
+                            VALUES (?, 0, ?, 'admin')
+                            ''', (order_id, message))
+        record_order_event(db, order_id, ORDER_EVENT_CHAT_MESSAGE, 'admin',
+                           message_id=cursor.lastrowid, sender_type='admin', message=message)
 
         db.execute('''
                    UPDATE active_chats
@@ -3809,11 +5825,13 @@ def api_admin_send_message():
 
 @app.route('/api/courier/available-orders', methods=['GET'])
 def get_available_orders():
-    """Получить список заказов, доступных для взятия курьером"""
+    """Получить список заказов, доступных для взятия курьером (?city= - только по одному городу)"""
     try:
+        city = request.args.get('city') or None
         db = get_db()
 
-        available_orders = db.execute('''
+        city_clause = 'AND o.address_city = ?' if city else ''
+        available_orders = db.execute(f'''
                                       SELECT o.id,
                                              o.username,
                                              o.items,
@@ -3834,17 +5852,16 @@ def get_available_orders():
                                         AND o.status = 'pending'
                                         AND a.id IS NULL
                                         AND DATE (o.created_at) = DATE ('now')
+                                        {city_clause}
                                       ORDER BY o.created_at DESC
-                                      ''').fetchall()
+                                      ''', (city,) if city else ()).fetchall()
+
+        order_items = load_order_items(db, available_orders)
 
         processed_orders = []
         for order in available_orders:
             order_dict = dict(order)
-
-            try:
-                order_dict['items_list'] = json.loads(order_dict['items'])
-            except:
-                order_dict['items_list'] = []
+            order_dict['items_list'] = order_items[order_dict['id']]
 
             if order_dict.get('delivery_address'):
                 try:
@@ -3891,8 +5908,10 @@ def courier_take_order():
                    INSERT INTO order_assignments (order_id, courier_id, status, assigned_at)
                    VALUES (?, ?, 'assigned', CURRENT_TIMESTAMP)
                    ''', (order_id, courier_id))
+        record_order_event(db, order_id, ORDER_EVENT_COURIER_ASSIGNED, f'courier:{courier_id}',
+                           courier_id=courier_id)
 
-        db.execute('UPDATE orders SET status = ? WHERE id = ?', ('processing', order_id))
+        transition_order(db, order_id, 'processing', f'courier:{courier_id}')
 
         db.commit()
         db.close()
@@ -4057,16 +6076,14 @@ def get_courier_orders():
                                   ORDER BY o.created_at DESC
                                   ''', (courier_id,)).fetchall()
 
+        order_items = load_order_items(db, list(active_orders) + list(completed_orders) + list(today_orders))
         db.close()
 
         def process_orders(orders):
             processed = []
             for order in orders:
                 order_dict = dict(order)
-                try:
-                    order_dict['items_list'] = json.loads(order_dict['items'])
-                except:
-                    order_dict['items_list'] = []
+                order_dict['items_list'] = order_items[order_dict['id']]
 
                 if order_dict.get('delivery_address'):
                     try:
@@ -4118,8 +6135,7 @@ def api_update_order_status():
                            AND courier_id = ?
                          ''', (photo_data, order_id, courier_id))
 
-            conn.execute('UPDATE orders SET status = ? WHERE id = ?',
-                         ('delivered', order_id))
+            transition_order(conn, order_id, 'delivered', f'courier:{courier_id}')
 
             conn.commit()
             conn.close()
@@ -4135,8 +6151,7 @@ def api_update_order_status():
                            AND courier_id = ?
                          ''', (order_id, courier_id))
 
-            conn.execute('UPDATE orders SET status = ? WHERE id = ?',
-                         ('picked_up', order_id))
+            transition_order(conn, order_id, 'picked_up', f'courier:{courier_id}')
 
             conn.commit()
             conn.close()
@@ -4151,8 +6166,7 @@ def api_update_order_status():
                            AND courier_id = ?
                          ''', (order_id, courier_id))
 
-            conn.execute('UPDATE orders SET status = ? WHERE id = ?',
-                         ('delivering', order_id))
+            transition_order(conn, order_id, 'delivering', f'courier:{courier_id}')
 
             conn.commit()
             conn.close()
@@ -4167,8 +6181,7 @@ def api_update_order_status():
                            AND courier_id = ?
                          ''', (status, order_id, courier_id))
 
-            conn.execute('UPDATE orders SET status = ? WHERE id = ?',
-                         (status, order_id))
+            transition_order(conn, order_id, status, f'courier:{courier_id}')
 
             conn.commit()
             conn.close()
@@ -4235,8 +6248,7 @@ def admin_update_order_status(order_id):
             db.close()
             return jsonify({'error': 'Некорректный статус'}), 400
 
-        db.execute('UPDATE orders SET status = ? WHERE id = ?',
-                   (new_status, order_id))
+        transition_order(db, order_id, new_status, 'admin')
         db.commit()
         db.close()
 
@@ -4262,8 +6274,7 @@ def admin_cancel_order(order_id):
             db.close()
             return jsonify({'error': 'Нельзя отменить завершенный заказ'}), 400
 
-        db.execute('UPDATE orders SET status = "cancelled" WHERE id = ?',
-                   (order_id,))
+        transition_order(db, order_id, 'cancelled', 'admin')
         db.commit()
         db.close()
 
@@ -4440,6 +6451,7 @@ def assign_courier():
                    INSERT INTO order_assignments (order_id, courier_id, status)
                    VALUES (?, ?, 'assigned')
                    ''', (order_id, courier['id']))
+        record_order_event(db, order_id, ORDER_EVENT_COURIER_ASSIGNED, 'admin', courier_id=courier['id'])
 
         db.commit()
         db.close()
@@ -4460,23 +6472,19 @@ def assign_courier():
 def admin_dashboard():
     db = get_db()
     try:
-        stats = db.execute('''
-                           SELECT (SELECT COUNT(*) FROM orders)                          as total_orders,
-                                  COALESCE(SUM(total_price), 0)                          as total_revenue,
-                                  (SELECT COUNT(*) FROM orders WHERE status = 'pending') as pending_orders,
-                                  (SELECT COUNT(*) FROM products)                        as total_products,
-                                  (SELECT COUNT(DISTINCT user_id) FROM orders)           as total_customers
-                           FROM orders
-                           ''').fetchone()
+        # Счетчики поддерживают триггеры на orders/products - чтение не зависит от размера истории
+        counters = {row['name']: row['value'] for row in db.execute('SELECT name, value FROM shop_counters').fetchall()}
 
         recent_orders = db.execute('SELECT * FROM orders ORDER BY created_at DESC LIMIT 10').fetchall()
 
         result = {
-            'total_orders': stats['total_orders'] if stats else 0,
-            'total_revenue': stats['total_revenue'] if stats else 0,
-            'pending_orders': stats['pending_orders'] if stats else 0,
-            'total_products': stats['total_products'] if stats else 0,
-            'total_customers': stats['total_customers'] if stats else 0,
+            'total_orders': int(counters.get('orders', 0)),
+            'total_revenue': round(counters.get('revenue', 0), 2),
+            'pending_orders': int(counters.get('status:pending', 0)),
+            'total_products': int(counters.get('products', 0)),
+            'total_customers': int(counters.get('customers', 0)),
+            'orders_by_status': {name[len('status:'):]: int(value) for name, value in counters.items()
+                                 if name.startswith('status:') and value},
             'recent_orders': [dict(row) for row in recent_orders]
         }
 
@@ -4490,26 +6498,269 @@ def admin_dashboard():
         })
 
 
-# ========== API ДЛЯ ВЕСОВЫХ ТОВАРОВ И СКИДОК ==========
-
-@app.route('/api/discounts', methods=['GET'])
-def get_discounts():
-    """Получить все активные скидки"""
+@app.cli.command('rebuild-shop-counters')
+def rebuild_shop_counters_command():
+    """Пересчитать счетчики дашборда по orders/products и показать расхождения"""
     db = get_db()
     try:
-        discounts = db.execute('''
-                               SELECT d.*,
-                                      (SELECT COUNT(*) FROM orders WHERE discount_id = d.id) as used_count
-                               FROM discounts d
-                               ORDER BY d.created_at DESC
-                               ''').fetchall()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            drift = rebuild_shop_counters(db)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        if not drift:
+            print('shop_counters: расхождений нет')
+        for name, (before, after) in drift.items():
+            print(f'{name}: {before} -> {after}')
+    finally:
+        db.close()
+
+
+# ========== АНАЛИТИКА ПРОДАЖ ==========
+SALES_BACKFILL_CHUNK = 1000
+SALES_GROUP_COLUMNS = ['delivery_type', 'payment_method', 'pickup_point']
+SALES_HOUR_RANGE_MAX_DAYS = 93
+
+
+def backfill_sales_rollups_chunk(db, chunk_size=SALES_BACKFILL_CHUNK):
+    """Добавить в роллапы следующую порцию исторических заказов; возвращает (учтено заказов, готово)"""
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        progress = {row['name']: row['last_id'] for row in db.execute('''
+            SELECT name, last_id
+            FROM backfill_progress
+            WHERE name IN ('sales_rollups', 'sales_rollups_target')
+            ''').fetchall()}
+        last_id = progress.get('sales_rollups', 0)
+        target = progress.get('sales_rollups_target', 0)
+
+        bucket_columns = ', '.join(f"{bucket.format(created_at='created_at')} as bucket_{grain}"
+                                   for grain, bucket in SALES_ROLLUP_GRAINS.items())
+        orders = db.execute(f'''
+                            SELECT id, items, delivery_type, payment_method, pickup_point, total_price,
+                                   discount_amount, {bucket_columns}
+                            FROM orders
+                            WHERE id > ?
+                              AND id <= ?
+                              AND COALESCE(status, '') != 'cancelled'
+                            ORDER BY id
+                            LIMIT ?
+                            ''', (last_id, target, chunk_size)).fetchall()
+
+        totals = {}
+        for order in orders:
+            dimensions = tuple(order[column] or '' for column in SALES_GROUP_COLUMNS)
+            for grain in SALES_ROLLUP_GRAINS:
+                entry = totals.setdefault((grain, order[f'bucket_{grain}']) + dimensions, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += order['total_price'] or 0
+                entry[2] += order['discount_amount'] or 0
+
+        # Позиции берутся из order_items, как и в триггерах: заказы, которые backfill-order-items
+        # еще не перенес, переносятся здесь же, иначе отмена такого заказа не вычла бы его категории
+        buckets = {order['id']: order for order in orders}
+        item_rows = []
+        order_ids = list(buckets)
+        for start in range(0, len(order_ids), ORDER_ITEMS_READ_CHUNK):
+            chunk = order_ids[start:start + ORDER_ITEMS_READ_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            migrated = {row['order_id'] for row in db.execute(f'''
+                SELECT DISTINCT order_id FROM order_items WHERE order_id IN ({placeholders})
+                ''', chunk)}
+            for order_id in chunk:
+                if order_id not in migrated:
+                    insert_order_items(db, order_id, load_order_items(db, [buckets[order_id]])[order_id])
+            item_rows.extend(db.execute(f'''
+                                        SELECT oi.order_id,
+                                               COALESCE(p.category, '') as category,
+                                               oi.quantity,
+                                               oi.weight,
+                                               oi.is_weight,
+                                               oi.line_total
+                                        FROM order_items oi
+                                                 LEFT JOIN products p ON p.id = oi.product_id
+                                        WHERE oi.order_id IN ({placeholders})
+                                        ''', chunk).fetchall())
+
+        category_totals = {}
+        for row in item_rows:
+            order = buckets[row['order_id']]
+            for grain in SALES_ROLLUP_GRAINS:
+                entry = category_totals.setdefault((grain, order[f'bucket_{grain}'], row['category']),
+                                                   [0, 0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += 0 if row['is_weight'] else row['quantity']
+                entry[2] += (row['weight'] or 0) * row['quantity'] if row['is_weight'] else 0
+                entry[3] += row['line_total']
+
+        db.executemany('''
+                       INSERT INTO sales_rollups (grain, bucket, delivery_type, payment_method, pickup_point,
+                                                  orders, revenue, discount)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(grain, bucket, delivery_type, payment_method, pickup_point)
+                           DO UPDATE SET orders   = orders + excluded.orders,
+                                         revenue  = revenue + excluded.revenue,
+                                         discount = discount + excluded.discount
+                       ''', [key + tuple(values) for key, values in totals.items()])
+        db.executemany('''
+                       INSERT INTO category_sales_rollups (grain, bucket, category, lines, quantity, weight, revenue)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(grain, bucket, category)
+                           DO UPDATE SET lines    = lines + excluded.lines,
+                                         quantity = quantity + excluded.quantity,
+                                         weight   = weight + excluded.weight,
+                                         revenue  = revenue + excluded.revenue
+                       ''', [key + tuple(values) for key, values in category_totals.items()])
+
+        done = len(orders) < chunk_size
+        db.execute('''
+                   UPDATE backfill_progress
+                   SET last_id    = ?,
+                       done       = ?,
+                       updated_at = CURRENT_TIMESTAMP
+                   WHERE name = 'sales_rollups'
+                   ''', (target if done else orders[-1]['id'], 1 if done else 0))
+        db.commit()
+        return len(orders), done
+    except Exception:
+        db.rollback()
+        raise
+
+
+@app.cli.command('backfill-sales-rollups')
+@click.option('--chunk', default=SALES_BACKFILL_CHUNK, help='Заказов в одной транзакции')
+@click.option('--pause', default=0.05, help='Пауза между порциями, сек')
+def backfill_sales_rollups_command(chunk, pause):
+    """Построить роллапы продаж по истории заказов (прерывается и продолжается с места остановки)"""
+    db = get_db()
+    try:
+        counted = 0
+        while True:
+            orders, done = backfill_sales_rollups_chunk(db, chunk)
+            counted += orders
+            print(f'counted {counted} orders')
+            if done:
+                break
+            time.sleep(pause)
+    finally:
+        db.close()
+
+
+def parse_analytics_bound(value, default):
+    if not value:
+        return default
+    return parse_db_datetime(value)
+
+
+@app.route('/api/admin/analytics/timeseries', methods=['GET'])
+def api_analytics_timeseries():
+    """Временной ряд продаж из роллапов: ?grain=hour|day&from=&to=&group_by= (время - UTC, как created_at)"""
+    grain = request.args.get('grain', 'day')
+    if grain not in SALES_ROLLUP_GRAINS:
+        return jsonify({'success': False, 'error': 'grain должен быть hour или day'}), 400
+
+    group_by = request.args.get('group_by') or None
+    if group_by and group_by not in SALES_GROUP_COLUMNS + ['category']:
+        return jsonify({'success': False, 'error': 'Неверное поле группировки'}), 400
+
+    now = datetime.utcnow()
+    date_to = parse_analytics_bound(request.args.get('to'), now)
+    date_from = parse_analytics_bound(request.args.get('from'),
+                                      date_to - (timedelta(days=30) if grain == 'day' else timedelta(hours=48)))
+    if date_from is None or date_to is None or date_from > date_to:
+        return jsonify({'success': False, 'error': 'Неверный период'}), 400
+    if grain == 'hour' and date_to - date_from > timedelta(days=SALES_HOUR_RANGE_MAX_DAYS):
+        return jsonify({'success': False,
+                        'error': f'Почасовой ряд - не больше {SALES_HOUR_RANGE_MAX_DAYS} дней'}), 400
+
+    bucket_format = '%Y-%m-%d %H:00:00' if grain == 'hour' else '%Y-%m-%d'
+    bounds = (grain, date_from.strftime(bucket_format), date_to.strftime(bucket_format))
+
+    db = get_db()
+    try:
+        if group_by == 'category':
+            rows = db.execute('''
+                              SELECT bucket, category, lines, quantity, weight, revenue
+                              FROM category_sales_rollups
+                              WHERE grain = ?
+                                AND bucket BETWEEN ? AND ?
+                              ORDER BY bucket, category
+                              ''', bounds).fetchall()
+            series = [{
+                'bucket': row['bucket'],
+                'category': row['category'],
+                'lines': row['lines'],
+                'quantity': row['quantity'],
+                'weight': round(row['weight'], 3),
+                'revenue': round(row['revenue'], 2)
+            } for row in rows if row['lines']]
+        else:
+            key_column = f', {group_by}' if group_by else ''
+            rows = db.execute(f'''
+                              SELECT bucket{key_column},
+                                     SUM(orders)   as orders,
+                                     SUM(revenue)  as revenue,
+                                     SUM(discount) as discount
+                              FROM sales_rollups
+                              WHERE grain = ?
+                                AND bucket BETWEEN ? AND ?
+                              GROUP BY bucket{key_column}
+                              ORDER BY bucket{key_column}
+                              ''', bounds).fetchall()
+            series = []
+            for row in rows:
+                if not row['orders']:
+                    continue
+                point = {
+                    'bucket': row['bucket'],
+                    'orders': row['orders'],
+                    'revenue': round(row['revenue'], 2),
+                    'discount': round(row['discount'], 2),
+                    'avg_basket': round(row['revenue'] / row['orders'], 2)
+                }
+                if group_by:
+                    point[group_by] = row[group_by]
+                series.append(point)
+
+        backfill = db.execute("SELECT done FROM backfill_progress WHERE name = 'sales_rollups'").fetchone()
+        return jsonify({
+            'success': True,
+            'grain': grain,
+            'from': bounds[1],
+            'to': bounds[2],
+            'group_by': group_by,
+            'history_complete': bool(backfill and backfill['done']),
+            'series': series
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        db.close()
+
+
+# ========== API ДЛЯ ВЕСОВЫХ ТОВАРОВ И СКИДОК ==========
+
+@app.route('/api/discounts', methods=['GET'])
+@http_cache('reference')
+def get_discounts():
+    """Получить все активные скидки"""
+    db = get_db()
+    try:
+        discounts = db.execute('''
+                               SELECT d.*,
+                                      (SELECT COUNT(*) FROM orders WHERE discount_id = d.id) as used_count
+                               FROM discounts d
+                               ORDER BY d.created_at DESC
+                               ''').fetchall()
 
         result = [dict(discount) for discount in discounts]
         db.close()
         return jsonify(result)
     except Exception as e:
         db.close()
-        return jsonify([])
+        return jsonify([]), 500
 
 
 @app.route('/api/admin/discounts', methods=['GET', 'POST'])
@@ -4561,7 +6812,9 @@ def admin_discounts():
                                 ))
 
             discount_id = cursor.lastrowid
+            discount_engine.invalidate(db, data)
             db.commit()
+            product_price_scheduler.wake()
 
             return jsonify({'success': True, 'id': discount_id})
 
@@ -4592,7 +6845,7 @@ def admin_discount_detail(id):
         elif request.method == 'PUT':
             data = request.json
 
-            discount = db.execute('SELECT id FROM discounts WHERE id = ?', (id,)).fetchone()
+            discount = db.execute('SELECT * FROM discounts WHERE id = ?', (id,)).fetchone()
             if not discount:
                 return jsonify({'success': False, 'error': 'Скидка не найдена'}), 404
 
@@ -4635,11 +6888,13 @@ def admin_discount_detail(id):
                            id
                        ))
 
+            discount_engine.invalidate(db, dict(discount), data)
             db.commit()
+            product_price_scheduler.wake()
             return jsonify({'success': True})
 
         elif request.method == 'DELETE':
-            discount = db.execute('SELECT id FROM discounts WHERE id = ?', (id,)).fetchone()
+            discount = db.execute('SELECT * FROM discounts WHERE id = ?', (id,)).fetchone()
             if not discount:
                 return jsonify({'success': False, 'error': 'Скидка не найдена'}), 404
 
@@ -4649,7 +6904,9 @@ def admin_discount_detail(id):
                     {'success': False, 'error': 'Нельзя удалить скидку, которая уже использовалась в заказах'}), 400
 
             db.execute('DELETE FROM discounts WHERE id = ?', (id,))
+            discount_engine.invalidate(db, dict(discount))
             db.commit()
+            product_price_scheduler.wake()
 
             return jsonify({'success': True})
 
@@ -4670,12 +6927,14 @@ def admin_discount_status(id):
         if is_active is None:
             return jsonify({'success': False, 'error': 'Не указан статус'}), 400
 
-        discount = db.execute('SELECT id FROM discounts WHERE id = ?', (id,)).fetchone()
+        discount = db.execute('SELECT * FROM discounts WHERE id = ?', (id,)).fetchone()
         if not discount:
             return jsonify({'success': False, 'error': 'Скидка не найдена'}), 404
 
         db.execute('UPDATE discounts SET is_active = ? WHERE id = ?', (is_active, id))
+        discount_engine.invalidate(db, dict(discount))
         db.commit()
+        product_price_scheduler.wake()
 
         return jsonify({'success': True})
 
@@ -4753,6 +7012,7 @@ def admin_update_product():
                            data.get('stock', 0)
                        ))
 
+        bump_cache_version(db, 'catalog')
         db.commit()
         return jsonify({'success': True})
 
@@ -4798,11 +7058,8 @@ def api_complete_delivery():
 
         conn = get_db_connection()
 
-        conn.execute('''
-                     UPDATE orders
-                     SET status = 'delivered'
-                     WHERE id = ?
-                     ''', (order_id,))
+        transition_order(conn, order_id, 'delivered', f'courier:{courier_id}',
+                         photo_proof=photo_url, delivery_notes=delivery_notes)
 
         conn.execute('''
                      UPDATE order_assignments
@@ -4905,6 +7162,7 @@ def create_weight_product():
                             ))
 
         product_id = cursor.lastrowid
+        bump_cache_version(db, 'catalog')
         db.commit()
 
         return jsonify({'success': True, 'id': product_id})
@@ -4953,6 +7211,7 @@ def update_weight_product(product_id):
                        product_id
                    ))
 
+        bump_cache_version(db, 'catalog')
         db.commit()
         return jsonify({'success': True})
 
@@ -5012,6 +7271,7 @@ def admin_create_product():
                                 ))
 
         product_id = cursor.lastrowid
+        bump_cache_version(db, 'catalog')
         db.commit()
 
         return jsonify({'success': True, 'id': product_id})
@@ -5022,8 +7282,22 @@ def admin_create_product():
         db.close()
 
 
+# Поле формы редактирования заказа -> колонка orders
+ORDER_EDIT_COLUMNS = {
+    'total': 'total_price',
+    'delivery_type': 'delivery_type',
+    'payment_method': 'payment_method',
+    'recipient_name': 'recipient_name',
+    'phone_number': 'phone_number',
+    'promo_discount': 'discount_amount',
+    'delivery_cost': 'delivery_cost',
+}
+
+
 @app.route('/api/admin/orders/<int:order_id>', methods=['PUT'])
 def update_order(order_id):
+    """Редактирование заказа в админке; смена статуса - через transition_order"""
+    db = get_db()
     try:
         data = request.json
 
@@ -5032,20 +7306,31 @@ def update_order(order_id):
             if field not in data:
                 return jsonify({'success': False, 'error': f'Поле {field} обязательно'}), 400
 
-        db.update_order(order_id, data)
+        if not db.execute('SELECT 1 FROM orders WHERE id = ?', (order_id,)).fetchone():
+            return jsonify({'success': False, 'error': 'Заказ не найден'}), 404
 
-        if 'status' in data:
-            order = db.get_order(order_id)
-            if order and order.user_id:
-                send_telegram_notification(
-                    order.user_id,
-                    f'📦 Статус вашего заказа #{order_id} изменен на: {get_status_name(data["status"])}'
-                )
+        updates = {column: data[field] for field, column in ORDER_EDIT_COLUMNS.items() if field in data}
+        if data.get('delivery_address') is not None:
+            updates['delivery_address'] = json.dumps(data['delivery_address'], ensure_ascii=False)
+            updates.update(order_address_columns(data['delivery_address']))
+
+        db.execute(f"UPDATE orders SET {', '.join(f'{column} = ?' for column in updates)} WHERE id = ?",
+                   list(updates.values()) + [order_id])
+        record_order_event(db, order_id, ORDER_EVENT_UPDATED, 'admin', fields=sorted(updates))
+
+        previous_status = transition_order(db, order_id, data['status'], 'admin')
+        db.commit()
+
+        if previous_status is not None:
+            send_order_notification(order_id, data['status'])
 
         return jsonify({'success': True})
 
     except Exception as e:
+        db.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        db.close()
 
 
 def get_status_name(status):
@@ -5101,6 +7386,7 @@ def create_promo_code():
                             ))
 
         promo_id = cursor.lastrowid
+        bump_cache_version(db, 'promo_codes')
         db.commit()
 
         return jsonify({
@@ -5132,6 +7418,7 @@ def delete_promo_code(promo_id):
             }), 400
 
         db.execute('DELETE FROM promo_codes WHERE id = ?', (promo_id,))
+        bump_cache_version(db, 'promo_codes')
         db.commit()
 
         return jsonify({"success": True, "message": "Промокод удален"})
@@ -5142,6 +7429,260 @@ def delete_promo_code(promo_id):
         db.close()
 
 
+# ========== МАССОВАЯ ГЕНЕРАЦИЯ ПРОМОКОДОВ ==========
+PROMO_BULK_MAX = 500000
+PROMO_BULK_CHUNK = 5000
+PROMO_BULK_DEFAULT_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+PROMO_BULK_MAX_STALLS = 5
+PROMO_BULK_PAGE_DEFAULT = 100
+PROMO_BULK_PAGE_MAX = 1000
+PROMO_BULK_DISCOUNT_TYPES = ('percentage', 'fixed', 'free_delivery')
+
+
+def generate_promo_code_chunk(prefix, alphabet, length, count):
+    """Порция уникальных кодов; совпадения с уже существующими отсеет UNIQUE при вставке"""
+    rng = secrets.SystemRandom()
+    codes = set()
+    while len(codes) < count:
+        codes.add(prefix + ''.join(rng.choices(alphabet, k=length)))
+    return codes
+
+
+def parse_promo_bulk_request(data):
+    """Проверить параметры пакета: (параметры, ошибка)"""
+    if not data:
+        return None, 'Нет данных'
+
+    for field in ('count', 'discount_type', 'value'):
+        if field not in data:
+            return None, f'Отсутствует поле: {field}'
+
+    try:
+        count = int(data['count'])
+        value = float(data['value'])
+        length = int(data.get('length', 8))
+        usage_limit = int(data.get('usage_limit', 1) or 0)
+    except (TypeError, ValueError):
+        return None, 'Неверный формат числовых полей'
+
+    if data['discount_type'] not in PROMO_BULK_DISCOUNT_TYPES:
+        return None, 'Неверный тип скидки'
+    if not 1 <= count <= PROMO_BULK_MAX:
+        return None, f'Количество кодов должно быть от 1 до {PROMO_BULK_MAX}'
+    if not 4 <= length <= 32:
+        return None, 'Длина кода должна быть от 4 до 32 символов'
+
+    # Коды сравниваются в верхнем регистре, поэтому и алфавит, и префикс приводим к нему
+    alphabet = ''.join(dict.fromkeys(str(data.get('alphabet') or PROMO_BULK_DEFAULT_ALPHABET).upper()))
+    if len(alphabet) < 2 or not re.fullmatch(r'[A-Z0-9]+', alphabet):
+        return None, 'Алфавит должен состоять минимум из двух латинских букв или цифр'
+
+    prefix = str(data.get('prefix') or '').strip().upper()
+    if not re.fullmatch(r'[A-Z0-9_-]{0,16}', prefix):
+        return None, 'Префикс может содержать только латинские буквы, цифры, "-" и "_" (до 16 символов)'
+
+    # Пространство кодов с запасом, чтобы случайные коллизии оставались редкими
+    if len(alphabet) ** length < count * 100:
+        return None, 'Слишком мало возможных кодов: увеличьте длину или алфавит'
+
+    return {
+        'count': count,
+        'prefix': prefix,
+        'alphabet': alphabet,
+        'length': length,
+        'discount_type': data['discount_type'],
+        'value': value,
+        'usage_limit': usage_limit or None,
+        'min_order_amount': data.get('min_order_amount', 0),
+        'start_date': data.get('start_date'),
+        'end_date': data.get('end_date')
+    }, None
+
+
+def run_promo_bulk_batch(batch_id, params):
+    """Вставка пакета порциями по PROMO_BULK_CHUNK в отдельных транзакциях; отдает строки прогресса"""
+    db = get_db()
+    created = 0
+    collisions = 0
+    stalls = 0
+    status = 'interrupted'
+    started = time.monotonic()
+    try:
+        while created < params['count']:
+            chunk = generate_promo_code_chunk(params['prefix'], params['alphabet'], params['length'],
+                                              min(PROMO_BULK_CHUNK, params['count'] - created))
+
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                before = db.total_changes
+                db.executemany('''
+                               INSERT OR IGNORE INTO promo_codes (code, discount_type, value, usage_limit, used_count,
+                                                                  min_order_amount, start_date, end_date,
+                                                                  is_active, batch_id)
+                               VALUES (?, ?, ?, ?, 0, ?, ?, ?, 1, ?)
+                               ''', [(code, params['discount_type'], params['value'], params['usage_limit'],
+                                      params['min_order_amount'], params['start_date'], params['end_date'],
+                                      batch_id) for code in chunk])
+                inserted = db.total_changes - before
+                db.execute('UPDATE promo_code_batches SET created = created + ? WHERE id = ?', (inserted, batch_id))
+                bump_cache_version(db, 'promo_codes')
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+            created += inserted
+            collisions += len(chunk) - inserted
+            stalls = stalls + 1 if inserted == 0 else 0
+            if stalls >= PROMO_BULK_MAX_STALLS:
+                status = 'failed'
+                yield json.dumps({'batch_id': batch_id, 'error': 'Не удается сгенерировать новые уникальные коды',
+                                  'created': created}, ensure_ascii=False) + '\n'
+                return
+
+            yield json.dumps({'batch_id': batch_id, 'created': created, 'total': params['count'],
+                              'collisions': collisions}) + '\n'
+
+        status = 'done'
+        yield json.dumps({'batch_id': batch_id, 'done': True, 'created': created, 'collisions': collisions,
+                          'elapsed_ms': round((time.monotonic() - started) * 1000),
+                          'csv_url': f'/api/admin/promo-codes/bulk/{batch_id}/csv'}) + '\n'
+    finally:
+        # Клиент мог закрыть соединение посреди генерации - уже вставленные порции остаются в пакете
+        db.execute('UPDATE promo_code_batches SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?',
+                   (status, batch_id))
+        db.commit()
+        db.close()
+
+
+@app.route('/api/admin/promo-codes/bulk', methods=['POST'])
+def create_promo_codes_bulk():
+    """Массовая генерация промокодов; прогресс отдается потоком NDJSON"""
+    params, error = parse_promo_bulk_request(request.json)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+
+    db = get_db()
+    try:
+        cursor = db.execute('''
+                            INSERT INTO promo_code_batches (prefix, alphabet, code_length, requested, discount_type,
+                                                            value, usage_limit, min_order_amount, start_date,
+                                                            end_date)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                            ''', (params['prefix'], params['alphabet'], params['length'], params['count'],
+                                  params['discount_type'], params['value'], params['usage_limit'],
+                                  params['min_order_amount'], params['start_date'], params['end_date']))
+        batch_id = cursor.lastrowid
+        db.commit()
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        db.close()
+
+    response = app.response_class(run_promo_bulk_batch(batch_id, params), mimetype='application/x-ndjson')
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/api/admin/promo-codes/bulk', methods=['GET'])
+def list_promo_codes_bulk():
+    """Пакеты промокодов - по строке на пакет вместо всех его кодов"""
+    db = get_db()
+    try:
+        batches = db.execute('SELECT * FROM promo_code_batches ORDER BY id DESC').fetchall()
+        return jsonify({'success': True, 'batches': [dict(batch) for batch in batches]})
+    finally:
+        db.close()
+
+
+@app.route('/api/admin/promo-codes/bulk/<int:batch_id>/codes', methods=['GET'])
+def list_promo_codes_bulk_members(batch_id):
+    """Коды пакета страницами по id: ?after=<id>&limit="""
+    db = get_db()
+    try:
+        after = request.args.get('after', 0, type=int)
+        limit = min(PROMO_BULK_PAGE_MAX, max(1, request.args.get('limit', PROMO_BULK_PAGE_DEFAULT, type=int)))
+        rows = db.execute('''
+                          SELECT id, code, usage_limit, used_count, is_active, start_date, end_date
+                          FROM promo_codes
+                          WHERE batch_id = ?
+                            AND id > ?
+                          ORDER BY id
+                          LIMIT ?
+                          ''', (batch_id, after, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return jsonify({
+            'success': True,
+            'items': [dict(row) for row in rows],
+            'next_after': rows[-1]['id'] if has_more else None,
+            'has_more': has_more
+        })
+    finally:
+        db.close()
+
+
+@app.route('/api/admin/promo-codes/bulk/<int:batch_id>', methods=['GET'])
+def get_promo_codes_bulk(batch_id):
+    """Состояние пакета промокодов"""
+    db = get_db()
+    try:
+        batch = db.execute('SELECT * FROM promo_code_batches WHERE id = ?', (batch_id,)).fetchone()
+        if not batch:
+            return jsonify({'success': False, 'error': 'Пакет не найден'}), 404
+        return jsonify({'success': True, 'batch': dict(batch)})
+    finally:
+        db.close()
+
+
+def stream_promo_batch_csv(batch_id):
+    """CSV пакета порциями по id, не загружая весь пакет в память"""
+    db = get_db()
+    try:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['code', 'discount_type', 'value', 'usage_limit', 'start_date', 'end_date'])
+
+        last_id = 0
+        while True:
+            rows = db.execute('''
+                              SELECT id, code, discount_type, value, usage_limit, start_date, end_date
+                              FROM promo_codes
+                              WHERE batch_id = ?
+                                AND id > ?
+                              ORDER BY id
+                              LIMIT ?
+                              ''', (batch_id, last_id, PROMO_BULK_CHUNK)).fetchall()
+            for row in rows:
+                writer.writerow([row['code'], row['discount_type'], row['value'], row['usage_limit'],
+                                 row['start_date'] or '', row['end_date'] or ''])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+            if len(rows) < PROMO_BULK_CHUNK:
+                break
+            last_id = rows[-1]['id']
+    finally:
+        db.close()
+
+
+@app.route('/api/admin/promo-codes/bulk/<int:batch_id>/csv', methods=['GET'])
+def download_promo_codes_bulk(batch_id):
+    """Выгрузка пакета промокодов в CSV"""
+    db = get_db()
+    try:
+        batch = db.execute('SELECT id FROM promo_code_batches WHERE id = ?', (batch_id,)).fetchone()
+    finally:
+        db.close()
+    if not batch:
+        return jsonify({'success': False, 'error': 'Пакет не найден'}), 404
+
+    response = app.response_class(stream_promo_batch_csv(batch_id), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename=promo-codes-batch-{batch_id}.csv'
+    return response
+
+
 @app.route('/api/admin/promo-codes', methods=['GET'])
 def get_promo_codes_admin():
     """Получить все промокоды для админки"""
@@ -5154,6 +7695,7 @@ def get_promo_codes_admin():
                                         d.value
                                  FROM promo_codes pc
                                           LEFT JOIN discounts d ON pc.discount_id = d.id
+                                 WHERE pc.batch_id IS NULL
                                  ORDER BY pc.created_at DESC
                                  ''').fetchall()
 
@@ -5185,106 +7727,1479 @@ def admin_categories_tree():
     db = get_db()
     try:
         if request.method == 'GET':
-            categories = db.execute('''
-                                    SELECT pc.*, d.name as discount_name
-                                    FROM product_categories pc
-                                             LEFT JOIN discounts d ON pc.discount_id = d.id
-                                    ORDER BY pc.sort_order, pc.name
-                                    ''').fetchall()
-
-            categories_dict = {}
-            root_categories = []
-
-            for cat in categories:
-                cat_dict = dict(cat)
-
-                cat_dict['children'] = []
-                categories_dict[cat_dict['id']] = cat_dict
-
-            for cat_id, cat in categories_dict.items():
-                if cat['parent_id']:
-                    if cat['parent_id'] in categories_dict:
-                        categories_dict[cat['parent_id']]['children'].append(cat)
-                else:
-                    root_categories.append(cat)
-
-            return jsonify(root_categories)
+            return jsonify(category_tree_cache.roots(db))
 
         elif request.method == 'POST':
             data = request.json
 
-            if not data.get('name'):
-                return jsonify({'success': False, 'error': 'Введите название категории'}), 400
+            if not data.get('name'):
+                return jsonify({'success': False, 'error': 'Введите название категории'}), 400
+
+            cursor = db.execute('''
+                                INSERT INTO product_categories (name, parent_id, discount_id, sort_order)
+                                VALUES (?, ?, ?, ?)
+                                ''', (
+                                    data['name'],
+                                    data.get('parent_id'),
+                                    data.get('discount_id'),
+                                    data.get('sort_order', 0)
+                                ))
+
+            bump_cache_version(db, 'catalog')
+            db.commit()
+            return jsonify({'success': True, 'id': cursor.lastrowid})
+
+        elif request.method == 'PUT':
+            category_id = request.args.get('id')
+            data = request.json
+
+            if not category_id:
+                return jsonify({'success': False, 'error': 'Не указан ID категории'}), 400
+
+            db.execute('''
+                       UPDATE product_categories
+                       SET name        = ?,
+                           parent_id   = ?,
+                           discount_id = ?,
+                           sort_order  = ?
+                       WHERE id = ?
+                       ''', (
+                           data.get('name'),
+                           data.get('parent_id'),
+                           data.get('discount_id'),
+                           data.get('sort_order', 0),
+                           category_id
+                       ))
+
+            bump_cache_version(db, 'catalog')
+            db.commit()
+            return jsonify({'success': True})
+
+        elif request.method == 'DELETE':
+            category_id = request.args.get('id')
+
+            if not category_id:
+                return jsonify({'success': False, 'error': 'Не указан ID категории'}), 400
+
+            products_count = db.execute(
+                'SELECT COUNT(*) FROM products WHERE category = (SELECT name FROM product_categories WHERE id = ?)',
+                (category_id,)
+            ).fetchone()[0]
+
+            if products_count > 0:
+                return jsonify({'success': False, 'error': 'Нельзя удалить категорию с товарами'}), 400
+
+            children_count = db.execute(
+                'SELECT COUNT(*) FROM product_categories WHERE parent_id = ?',
+                (category_id,)
+            ).fetchone()[0]
+
+            if children_count > 0:
+                return jsonify({'success': False, 'error': 'Нельзя удалить категорию с подкатегориями'}), 400
+
+            db.execute('DELETE FROM product_categories WHERE id = ?', (category_id,))
+            bump_cache_version(db, 'catalog')
+            db.commit()
+            return jsonify({'success': True})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        db.close()
+
+# ========== ДВИЖОК СКИДОК ==========
+def parse_db_datetime(value):
+    """Разобрать дату из БД/админки ('2024-01-31', '2024-01-31 10:00:00', '2024-01-31T10:00')"""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).strip().replace('Z', '')).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+class DiscountEngine:
+    """Активные скидки, загруженные один раз и разложенные по товару, категории и 'all'"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._valid_until = None
+        self._by_product = {}
+        self._by_category = {}
+        self._for_all = []
+
+    def _load(self, db, now):
+        rules = db.execute('SELECT * FROM discounts WHERE is_active = 1').fetchall()
+
+        by_product, by_category, for_all = {}, {}, []
+        valid_until = None
+        for row in rules:
+            rule = dict(row)
+            if rule['discount_type'] not in ('percentage', 'fixed'):
+                continue
+
+            start = parse_db_datetime(rule.get('start_date'))
+            end = parse_db_datetime(rule.get('end_date'))
+            if (rule.get('start_date') and start is None) or (rule.get('end_date') and end is None):
+                continue
+
+            # Ближайшая граница start_date/end_date - момент, когда индекс устареет
+            for boundary in (start, end):
+                if boundary and boundary > now and (valid_until is None or boundary < valid_until):
+                    valid_until = boundary
+
+            if (start and start > now) or (end and end < now):
+                continue
+
+            rule['value'] = float(rule['value'] or 0)
+            if rule['apply_to'] == 'product' and rule.get('target_product_id') is not None:
+                by_product.setdefault(int(rule['target_product_id']), []).append(rule)
+            elif rule['apply_to'] == 'category' and rule.get('target_category'):
+                by_category.setdefault(rule['target_category'], []).append(rule)
+            elif rule['apply_to'] == 'all':
+                for_all.append(rule)
+
+        self._by_product, self._by_category, self._for_all = by_product, by_category, for_all
+        self._valid_until = valid_until
+
+    def refresh(self, db):
+        """Перестроить индекс, если скидки изменились или наступила граница периода действия"""
+        version = get_cache_version(db, 'discounts')
+        now = datetime.now()
+        if version == self._version and (self._valid_until is None or now < self._valid_until):
+            return
+        with self._lock:
+            if version != self._version or (self._valid_until is not None and now >= self._valid_until):
+                self._load(db, now)
+                self._version = version
+
+    def invalidate(self, db, *rules):
+        """Сбросить индекс у всех воркеров и пометить устаревшими цены товаров, затронутых правилами"""
+        bump_cache_version(db, 'discounts')
+        for rule in rules:
+            if rule:
+                mark_product_prices_stale(db, rule)
+
+    @property
+    def state(self):
+        """Версия загруженного индекса: меняется при правке скидок и на границах их действия"""
+        return self._version, self._valid_until
+
+    @property
+    def has_category_rules(self):
+        return bool(self._by_category)
+
+    def best_discount(self, product_id, category, unit_price, quantity=1):
+        """Лучшая скидка на строку корзины: (сумма скидки, правило)"""
+        candidates = self._for_all + self._by_product.get(product_id, [])
+        if category:
+            candidates = candidates + self._by_category.get(category, [])
+
+        line_total = unit_price * quantity
+        best_value, best_rule = 0, None
+        for rule in candidates:
+            if rule['discount_type'] == 'percentage':
+                value = line_total * (rule['value'] / 100)
+            else:
+                value = rule['value'] * quantity
+            value = min(value, line_total)
+            if value > best_value:
+                best_value, best_rule = value, rule
+        return best_value, best_rule
+
+    def fetch_categories(self, db, product_ids):
+        """Категории товаров одним запросом (нужны только при наличии скидок на категории)"""
+        ids = sorted({int(pid) for pid in product_ids if str(pid).isdigit()})
+        if not ids or not self.has_category_rules:
+            return {}
+        placeholders = ','.join('?' * len(ids))
+        rows = db.execute(f'SELECT id, category FROM products WHERE id IN ({placeholders})', ids).fetchall()
+        return {row['id']: row['category'] for row in rows}
+
+    def resolve_cart(self, db, items):
+        """Скидки для всех позиций корзины за один проход"""
+        self.refresh(db)
+        categories = self.fetch_categories(db, [item.get('id') for item in items])
+
+        resolved = []
+        for item in items:
+            product_id = item.get('id')
+            try:
+                product_id = int(product_id)
+            except (TypeError, ValueError):
+                pass
+            price = float(item.get('price', 0) or 0)
+            quantity = item.get('quantity', 1) or 1
+
+            discount, rule = self.best_discount(product_id, categories.get(product_id), price, quantity)
+            resolved.append({
+                'id': product_id,
+                'name': item.get('name'),
+                'original_price': price,
+                'discounted_price': price - (discount / quantity) if discount > 0 else price,
+                'quantity': quantity,
+                'discount': discount,
+                'discount_info': rule
+            })
+        return resolved
+
+
+discount_engine = DiscountEngine()
+
+
+# ========== МАТЕРИАЛИЗОВАННЫЕ ЦЕНЫ ==========
+PRODUCT_PRICES_CHUNK = 500
+PRODUCT_PRICES_MAX_SLEEP = 60.0
+
+
+def product_prices_scope_sql(rule):
+    """Условие на product_prices для товаров, к которым применимо правило скидки: (sql, params)"""
+    apply_to = rule.get('apply_to')
+    if apply_to == 'product':
+        try:
+            return 'product_id = ?', [int(rule.get('target_product_id'))]
+        except (TypeError, ValueError):
+            return None, []
+    if apply_to == 'category':
+        if not rule.get('target_category'):
+            return None, []
+        return 'product_id IN (SELECT id FROM products WHERE category = ?)', [rule['target_category']]
+    if apply_to == 'all':
+        return '1 = 1', []
+    return None, []
+
+
+def mark_product_prices_stale(db, rule, computed_before=None):
+    """Пометить устаревшими цены товаров из области действия правила (в транзакции вызывающего)"""
+    scope, params = product_prices_scope_sql(rule)
+    if scope is None:
+        return 0
+    query = f'UPDATE product_prices SET stale = 1 WHERE stale = 0 AND {scope}'
+    if computed_before is not None:
+        query += ' AND computed_at < ?'
+        params = params + [computed_before]
+    return db.execute(query, params).rowcount
+
+
+def compute_product_price(product):
+    """Итоговая цена товара за единицу (шт. или кг) с лучшей из действующих скидок"""
+    if product['product_type'] == 'weight' and (product['price_per_kg'] or 0) > 0:
+        base_price = float(product['price_per_kg'])
+    else:
+        base_price = float(product['price'] or 0)
+
+    discount, rule = discount_engine.best_discount(product['id'], product['category'], base_price)
+    if discount <= 0:
+        return base_price, base_price, 0, 0, None
+    percentage = round(discount / base_price * 100, 1) if base_price else 0
+    return base_price, max(0, base_price - discount), discount, percentage, rule['id']
+
+
+def refresh_stale_product_prices(db):
+    """Пересчитать устаревшие строки product_prices порциями; возвращает число пересчитанных"""
+    if not db.execute('SELECT 1 FROM product_prices WHERE stale = 1 LIMIT 1').fetchone():
+        return 0
+
+    refreshed = 0
+    while True:
+        # Чтение и запись порции в одной транзакции: пометка stale от параллельной правки не потеряется
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            discount_engine.refresh(db)
+            products = db.execute('''
+                                  SELECT p.id, p.category, p.product_type, p.price, p.price_per_kg
+                                  FROM product_prices pp
+                                           JOIN products p ON p.id = pp.product_id
+                                  WHERE pp.stale = 1
+                                  LIMIT ?
+                                  ''', (PRODUCT_PRICES_CHUNK,)).fetchall()
+            if not products:
+                db.commit()
+                break
+
+            now = time.time()
+            db.executemany('''
+                           UPDATE product_prices
+                           SET base_price          = ?,
+                               final_price         = ?,
+                               discount_amount     = ?,
+                               discount_percentage = ?,
+                               discount_id         = ?,
+                               stale               = 0,
+                               computed_at         = ?
+                           WHERE product_id = ?
+                           ''', [compute_product_price(product) + (now, product['id']) for product in products])
+            bump_cache_version(db, 'prices')
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        refreshed += len(products)
+        if len(products) < PRODUCT_PRICES_CHUNK:
+            break
+    return refreshed
+
+
+class ProductPriceScheduler:
+    """Фоновый поток: пересчитывает цены на границах start_date/end_date скидок"""
+
+    def __init__(self, max_sleep=PRODUCT_PRICES_MAX_SLEEP):
+        self.max_sleep = max_sleep
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._checked_until = None
+        self._next_boundary = None
+        self._last_run = None
+
+    def start(self):
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='product-price-scheduler', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self.start()
+        self._event.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                self._next_boundary = None
+            timeout = self.max_sleep
+            if self._next_boundary is not None:
+                timeout = min(timeout, max(0.0, (self._next_boundary - datetime.now()).total_seconds()) + 0.5)
+            self._event.wait(timeout)
+            self._event.clear()
+
+    def run_once(self):
+        """Пометить цены, у которых прошла граница действия скидки, и пересчитать устаревшие"""
+        now = datetime.now()
+        db = get_db()
+        try:
+            rules = db.execute('''
+                               SELECT id, apply_to, target_category, target_product_id, start_date, end_date
+                               FROM discounts
+                               WHERE is_active = 1
+                                 AND (start_date IS NOT NULL OR end_date IS NOT NULL)
+                               ''').fetchall()
+
+            next_boundary = None
+            due = []
+            for row in rules:
+                rule = dict(row)
+                for boundary in (parse_db_datetime(rule['start_date']), parse_db_datetime(rule['end_date'])):
+                    if boundary is None:
+                        continue
+                    if boundary > now:
+                        if next_boundary is None or boundary < next_boundary:
+                            next_boundary = boundary
+                    elif self._checked_until is None or boundary > self._checked_until:
+                        due.append((rule, boundary))
+
+            if due:
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    for rule, boundary in due:
+                        # Строки, посчитанные уже после границы, актуальны
+                        mark_product_prices_stale(db, rule, computed_before=boundary.timestamp())
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    raise
+
+            refresh_stale_product_prices(db)
+            self._checked_until = now
+            self._next_boundary = next_boundary
+            self._last_run = time.time()
+        finally:
+            db.close()
+
+    def stats(self, db):
+        return {
+            'stale_rows': db.execute('SELECT COUNT(*) FROM product_prices WHERE stale = 1').fetchone()[0],
+            'prices_version': get_cache_version(db, 'prices'),
+            'next_boundary': self._next_boundary.isoformat() if self._next_boundary else None,
+            'last_run_age_seconds': round(time.time() - self._last_run, 3) if self._last_run else None,
+            'scheduler_alive': bool(self._thread and self._thread.is_alive() and self._pid == os.getpid())
+        }
+
+
+product_price_scheduler = ProductPriceScheduler()
+
+
+@app.before_request
+def start_product_price_scheduler():
+    product_price_scheduler.start()
+
+
+# ========== РАСЧЕТ СТОИМОСТИ (QUOTE) ==========
+def parse_cart_product_id(item):
+    """ID товара из позиции корзины ('12', 12 или '12_weight_1700000000' у весовых)"""
+    raw = item.get('original_product_id') or item.get('product_id') or item.get('id')
+    try:
+        return int(str(raw).split('_')[0])
+    except (TypeError, ValueError):
+        return None
+
+
+# ========== ПОЗИЦИИ ЗАКАЗОВ ==========
+ORDER_ITEMS_BACKFILL_CHUNK = 500
+ORDER_ITEMS_READ_CHUNK = 500
+
+
+def build_order_item_rows(order_id, items):
+    """Строки order_items из позиций заказа в формате корзины (price - за штуку или за весь вес)"""
+    rows = []
+    for position, item in enumerate(items or []):
+        if not isinstance(item, dict):
+            continue
+        try:
+            quantity = max(1, int(item.get('quantity') or 1))
+        except (TypeError, ValueError):
+            quantity = 1
+        try:
+            price = float(item.get('price') or 0)
+        except (TypeError, ValueError):
+            price = 0.0
+        try:
+            original_price = float(item['original_price']) if item.get('original_price') is not None else None
+        except (TypeError, ValueError):
+            original_price = None
+        try:
+            weight = float(item['weight']) if item.get('weight') else None
+        except (TypeError, ValueError):
+            weight = None
+
+        product_id = parse_cart_product_id(item)
+        # id позиции корзины храним, только если он не совпадает с товаром ('12_weight_...')
+        cart_id = item.get('id')
+        cart_id = str(cart_id) if cart_id is not None and str(cart_id) != str(product_id) else None
+        discount_info = item.get('discount_info')
+        discount_info = json.dumps(discount_info, ensure_ascii=False) if discount_info is not None else None
+
+        rows.append((order_id, position, product_id, item.get('name'), quantity, weight,
+                     1 if item.get('is_weight') else 0, price, original_price, round(price * quantity, 2),
+                     discount_info, cart_id))
+    return rows
+
+
+def insert_order_items(db, order_id, items):
+    db.executemany('''
+                   INSERT INTO order_items (order_id, position, product_id, name, quantity, weight, is_weight,
+                                            unit_price, original_price, line_total, discount_info, cart_id)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ''', build_order_item_rows(order_id, items))
+
+
+def serialize_order_item(row):
+    """Позиция order_items в формате позиции из orders.items (id - id позиции корзины)"""
+    try:
+        discount_info = json.loads(row['discount_info']) if row['discount_info'] else None
+    except ValueError:
+        discount_info = None
+    return {
+        'id': row['cart_id'] or row['product_id'],
+        'product_id': row['product_id'],
+        'name': row['name'],
+        'quantity': row['quantity'],
+        'weight': row['weight'],
+        'is_weight': bool(row['is_weight']),
+        'price': row['unit_price'],
+        'original_price': row['original_price'],
+        'line_total': row['line_total'],
+        'discount_info': discount_info
+    }
+
+
+def load_order_items(db, orders):
+    """Позиции для списка заказов: {order_id: [позиции]} запросом по order_items.
+
+    Заказы, которые backfill еще не перенес, разбираются из JSON orders.items
+    """
+    order_ids = [order['id'] for order in orders]
+    result = {}
+    for start in range(0, len(order_ids), ORDER_ITEMS_READ_CHUNK):
+        chunk = order_ids[start:start + ORDER_ITEMS_READ_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        rows = db.execute(f'''
+                          SELECT *
+                          FROM order_items
+                          WHERE order_id IN ({placeholders})
+                          ORDER BY order_id, position
+                          ''', chunk).fetchall()
+        for row in rows:
+            result.setdefault(row['order_id'], []).append(serialize_order_item(row))
+
+    for order in orders:
+        if order['id'] in result:
+            continue
+        try:
+            items = json.loads(order['items']) if order['items'] else []
+        except (TypeError, ValueError):
+            items = []
+        result[order['id']] = items if isinstance(items, list) else []
+    return result
+
+
+def backfill_order_items_chunk(db, chunk_size=ORDER_ITEMS_BACKFILL_CHUNK):
+    """Перенести в order_items следующую порцию заказов; позиция сохраняется в backfill_progress.
+
+    Возвращает (просмотрено заказов, перенесено заказов, готово)
+    """
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        progress = db.execute("SELECT last_id FROM backfill_progress WHERE name = 'order_items'").fetchone()
+        last_id = progress['last_id'] if progress else 0
+
+        orders = db.execute('''
+                            SELECT o.id,
+                                   o.items,
+                                   EXISTS (SELECT 1 FROM order_items oi WHERE oi.order_id = o.id) as migrated
+                            FROM orders o
+                            WHERE o.id > ?
+                            ORDER BY o.id
+                            LIMIT ?
+                            ''', (last_id, chunk_size)).fetchall()
+
+        migrated = 0
+        for order in orders:
+            if order['migrated']:
+                continue
+            try:
+                items = json.loads(order['items']) if order['items'] else []
+            except (TypeError, ValueError):
+                items = []
+            if isinstance(items, list) and items:
+                insert_order_items(db, order['id'], items)
+                migrated += 1
+
+        done = len(orders) < chunk_size
+        db.execute('''
+                   INSERT INTO backfill_progress (name, last_id, done, updated_at)
+                   VALUES ('order_items', ?, ?, CURRENT_TIMESTAMP)
+                   ON CONFLICT(name) DO UPDATE SET last_id    = excluded.last_id,
+                                                   done       = excluded.done,
+                                                   updated_at = CURRENT_TIMESTAMP
+                   ''', (orders[-1]['id'] if orders else last_id, 1 if done else 0))
+        db.commit()
+        return len(orders), migrated, done
+    except Exception:
+        db.rollback()
+        raise
+
+
+@app.cli.command('backfill-order-items')
+@click.option('--chunk', default=ORDER_ITEMS_BACKFILL_CHUNK, help='Заказов в одной транзакции')
+@click.option('--pause', default=0.05, help='Пауза между порциями, сек')
+def backfill_order_items_command(chunk, pause):
+    """Перенести позиции старых заказов из orders.items в order_items (можно прерывать и запускать снова)"""
+    db = get_db()
+    try:
+        scanned_total = migrated_total = 0
+        while True:
+            scanned, migrated, done = backfill_order_items_chunk(db, chunk)
+            scanned_total += scanned
+            migrated_total += migrated
+            print(f'scanned {scanned_total}, migrated {migrated_total}')
+            if done:
+                break
+            # Короткая пауза между транзакциями, чтобы не задерживать оформление заказов
+            time.sleep(pause)
+    finally:
+        db.close()
+
+
+# ========== ЖУРНАЛ СОБЫТИЙ ЗАКАЗОВ ==========
+ORDER_EVENT_CREATED = 'order_created'
+ORDER_EVENT_STATUS_CHANGED = 'status_changed'
+ORDER_EVENT_COURIER_ASSIGNED = 'courier_assigned'
+ORDER_EVENT_UPDATED = 'order_updated'
+ORDER_EVENT_CHAT_MESSAGE = 'chat_message'
+
+ORDER_CHANGES_PAGE_DEFAULT = 100
+ORDER_CHANGES_PAGE_MAX = 500
+
+
+def record_order_event(db, order_id, event, actor, from_status=None, to_status=None, **payload):
+    """Добавить событие в order_events. Коммит делает вызывающий код вместе с самим изменением"""
+    cursor = db.execute('''
+                        INSERT INTO order_events (order_id, event, from_status, to_status, actor, payload)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ''', (order_id, event, from_status, to_status, actor,
+                              json.dumps(payload, ensure_ascii=False) if payload else None))
+    return cursor.lastrowid
+
+
+def transition_order(db, order_id, status, actor, allowed_from=None, **payload):
+    """Единственное место, где меняется orders.status: статус и событие status_changed пишутся вместе.
+
+    allowed_from - статусы, из которых переход разрешен. Возвращает прежний статус или None,
+    если заказа нет, статус уже такой или переход не разрешен. Коммит делает вызывающий код
+    """
+    clauses, params = ['id = ?', 'status IS NOT ?'], [order_id, status]
+    if allowed_from:
+        clauses.append(f"status IN ({','.join('?' * len(allowed_from))})")
+        params.extend(allowed_from)
+
+    # Прежний статус читается той же пишущей командой, что создает событие, - без гонки с другим переходом
+    row = db.execute(f'''
+                     INSERT INTO order_events (order_id, event, from_status, to_status, actor, payload)
+                     SELECT id, ?, status, ?, ?, ?
+                     FROM orders
+                     WHERE {' AND '.join(clauses)}
+                     RETURNING from_status
+                     ''', [ORDER_EVENT_STATUS_CHANGED, status, actor,
+                            json.dumps(payload, ensure_ascii=False) if payload else None] + params).fetchone()
+    if row is None:
+        return None
+
+    db.execute('UPDATE orders SET status = ? WHERE id = ?', (status, order_id))
+    return row['from_status'] or ''
+
+
+def serialize_order_event(row):
+    return {
+        'id': row['id'],
+        'order_id': row['order_id'],
+        'event': row['event'],
+        'from_status': row['from_status'],
+        'to_status': row['to_status'],
+        'actor': row['actor'],
+        'payload': json.loads(row['payload']) if row['payload'] else {},
+        'created_at': row['created_at']
+    }
+
+
+def load_order_changes(db, since, head, limit, user_id=None, courier_id=None):
+    """События в (since, head]: (события, снимки затронутых заказов, есть ли еще)"""
+    clauses, params = ['e.id > ?', 'e.id <= ?'], [since, head]
+    if user_id is not None:
+        clauses.append('o.user_id = ?')
+        params.append(user_id)
+    if courier_id is not None:
+        # Курьеру - его заказы и еще не назначенные (доступные для взятия)
+        clauses.append('(a.courier_id = ? OR a.order_id IS NULL)')
+        params.append(courier_id)
+
+    rows = db.execute(f'''
+                      SELECT e.*
+                      FROM order_events e
+                               JOIN orders o ON o.id = e.order_id
+                               LEFT JOIN order_assignments a ON a.order_id = e.order_id
+                      WHERE {' AND '.join(clauses)}
+                      ORDER BY e.id
+                      LIMIT ?
+                      ''', params + [limit + 1]).fetchall()
+    has_more = len(rows) > limit
+    events = [serialize_order_event(row) for row in rows[:limit]]
+
+    orders = {}
+    order_ids = sorted({event['order_id'] for event in events})
+    for start in range(0, len(order_ids), ORDER_ITEMS_READ_CHUNK):
+        chunk = order_ids[start:start + ORDER_ITEMS_READ_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        for row in db.execute(f'''
+                              SELECT o.id, o.status, o.delivery_type, o.total_price, o.created_at,
+                                     o.updated_at, a.courier_id, a.status as assignment_status
+                              FROM orders o
+                                       LEFT JOIN order_assignments a ON a.order_id = o.id
+                              WHERE o.id IN ({placeholders})
+                              ''', chunk):
+            orders[str(row['id'])] = dict(row)
+    return events, orders, has_more
+
+
+@app.route('/api/orders/changes', methods=['GET'])
+def api_order_changes():
+    """Лента изменений заказов: ?since=<id события>&limit=, фильтры user_id (бот) и courier_id.
+
+    Без since отдает только last_event_id - с него клиент начинает синхронизацию
+    """
+    db = get_db()
+    try:
+        user_id = request.args.get('user_id', type=int)
+        courier_id = request.args.get('courier_id', type=int)
+        since = request.args.get('since', type=int)
+        limit = min(ORDER_CHANGES_PAGE_MAX,
+                    max(1, request.args.get('limit', ORDER_CHANGES_PAGE_DEFAULT, type=int)))
+
+        # Коммиты в SQLite идут по одному, поэтому все события до head уже видны
+        head = db.execute('SELECT COALESCE(MAX(id), 0) FROM order_events').fetchone()[0]
+        if since is None:
+            return jsonify({'success': True, 'events': [], 'orders': {}, 'last_event_id': head,
+                            'has_more': False})
+
+        events, orders, has_more = load_order_changes(db, since, head, limit, user_id, courier_id)
+        # Без фильтруемого хвоста курсор сразу двигается к head, чтобы не сканировать чужие события снова
+        last_event_id = events[-1]['id'] if has_more else max(since, head)
+
+        return jsonify({
+            'success': True,
+            'events': events,
+            'orders': orders,
+            'last_event_id': last_event_id,
+            'has_more': has_more
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        db.close()
+
+
+# ========== ПОТОК СОБЫТИЙ (SSE) ==========
+SSE_HEARTBEAT_SECONDS = 15
+SSE_RETRY_MS = 3000
+ORDER_EVENT_BUFFER_SIZE = 1000
+ORDER_EVENT_READ_CHUNK = 500
+
+
+def load_stream_events(db, after, limit=ORDER_EVENT_READ_CHUNK):
+    """События после id after вместе с текущим курьером и типом доставки заказа (для фильтров потоков)"""
+    rows = db.execute('''
+                      SELECT e.*, o.delivery_type, a.courier_id
+                      FROM order_events e
+                               LEFT JOIN orders o ON o.id = e.order_id
+                               LEFT JOIN order_assignments a ON a.order_id = e.order_id
+                      WHERE e.id > ?
+                      ORDER BY e.id
+                      LIMIT ?
+                      ''', (after, limit)).fetchall()
+    events = []
+    for row in rows:
+        event = serialize_order_event(row)
+        event['delivery_type'] = row['delivery_type']
+        event['courier_id'] = row['courier_id']
+        events.append(event)
+    return events
+
+
+class OrderEventBroadcaster:
+    """Раздает новые события order_events открытым SSE-соединениям воркера.
+
+    Общая шина для воркеров gunicorn - сама таблица order_events: в каждом процессе один поток
+    читает ее раз в poll_interval, пока есть подписчики, и будит все свои соединения разом
+    """
+
+    def __init__(self, poll_interval=0.5, buffer_size=ORDER_EVENT_BUFFER_SIZE):
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._buffer = collections.deque(maxlen=buffer_size)
+        # В буфере лежат все события из (_floor, _last_id]
+        self._floor = None
+        self._last_id = None
+        self._subscribers = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._polls = 0
+        self._delivered = 0
+
+    def start(self):
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='order-event-broadcaster', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            if self._subscribers:
+                try:
+                    self.poll_once()
+                except Exception:
+                    pass
+            time.sleep(self.poll_interval)
+
+    def poll_once(self):
+        db = get_db()
+        try:
+            if self._last_id is None:
+                head = db.execute('SELECT COALESCE(MAX(id), 0) FROM order_events').fetchone()[0]
+                events = []
+            else:
+                events = load_stream_events(db, self._last_id)
+        finally:
+            db.close()
+
+        with self._condition:
+            self._polls += 1
+            if self._last_id is None:
+                self._floor = self._last_id = head
+            for event in events:
+                if len(self._buffer) == self._buffer.maxlen:
+                    self._floor = self._buffer[0]['id']
+                self._buffer.append(event)
+                self._last_id = event['id']
+            self._condition.notify_all()
+
+    @contextmanager
+    def subscription(self):
+        self.start()
+        with self._condition:
+            self._subscribers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._subscribers -= 1
+
+    def wait(self, last_id, timeout):
+        """События после last_id, ожидая новых не дольше timeout.
+
+        None - last_id старше буфера, такие события подписчик дочитывает из БД сам
+        """
+        with self._condition:
+            if self._last_id is None:
+                self._condition.wait(timeout)
+                return []
+            if last_id < self._floor:
+                return None
+            self._condition.wait_for(lambda: self._last_id > last_id, timeout)
+            if last_id < self._floor:
+                return None
+            events = [event for event in self._buffer if event['id'] > last_id]
+            self._delivered += len(events)
+            return events
+
+    def stats(self):
+        with self._condition:
+            return {
+                'subscribers': self._subscribers,
+                'last_event_id': self._last_id,
+                'buffered': len(self._buffer),
+                'polls': self._polls,
+                'delivered': self._delivered,
+                'pid': os.getpid(),
+                'broadcaster_alive': bool(self._thread and self._thread.is_alive() and self._pid == os.getpid())
+            }
+
+
+order_event_broadcaster = OrderEventBroadcaster()
+
+
+def format_sse_event(event):
+    data = json.dumps(event, ensure_ascii=False)
+    return f"id: {event['id']}\nevent: {event['event'].replace('_', '-')}\ndata: {data}\n\n"
+
+
+def order_event_stream(last_id, visible):
+    """Генератор SSE: события после last_id, прошедшие фильтр visible, и keepalive раз в SSE_HEARTBEAT_SECONDS"""
+    with order_event_broadcaster.subscription():
+        yield f'retry: {SSE_RETRY_MS}\n\n'
+        last_sent = time.monotonic()
+        while True:
+            events = order_event_broadcaster.wait(last_id, SSE_HEARTBEAT_SECONDS)
+            if events is None:
+                # Клиент вернулся после долгого перерыва - догоняем из order_events
+                db = get_db()
+                try:
+                    events = load_stream_events(db, last_id)
+                finally:
+                    db.close()
+
+            for event in events:
+                last_id = event['id']
+                if visible(event):
+                    yield format_sse_event(event)
+                    last_sent = time.monotonic()
+
+            if time.monotonic() - last_sent >= SSE_HEARTBEAT_SECONDS:
+                yield ': keepalive\n\n'
+                last_sent = time.monotonic()
+
+
+def sse_response(visible):
+    """Ответ text/event-stream; продолжение с Last-Event-ID (или ?last_event_id=), иначе - с текущих событий"""
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('last_event_id', type=int)
+    if last_id is None:
+        db = get_db()
+        try:
+            last_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM order_events').fetchone()[0]
+        finally:
+            db.close()
+
+    response = app.response_class(order_event_stream(max(0, last_id), visible), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/api/stream/admin', methods=['GET'])
+def api_stream_admin():
+    """SSE для админки: все события заказов и сообщения чатов"""
+    return sse_response(lambda event: True)
+
+
+@app.route('/api/stream/courier', methods=['GET'])
+def api_stream_courier():
+    """SSE для курьера: его заказы, новые курьерские заказы без курьера и назначения (чтобы убрать взятые)"""
+    courier_id = request.args.get('courier_id', type=int)
+    if not courier_id:
+        return jsonify({'success': False, 'error': 'Не указан ID курьера'}), 400
+
+    def visible(event):
+        if event['courier_id'] == courier_id:
+            return True
+        if event['event'] == ORDER_EVENT_COURIER_ASSIGNED:
+            return True
+        return (event['courier_id'] is None and event['delivery_type'] == 'courier'
+                and event['event'] != ORDER_EVENT_CHAT_MESSAGE)
+
+    return sse_response(visible)
+
+
+@app.route('/api/admin/stream/stats', methods=['GET'])
+def api_stream_stats():
+    """Подписчики SSE и состояние раздачи событий в этом воркере"""
+    return jsonify({'success': True, 'stream': order_event_broadcaster.stats()})
+
+
+# ========== РЕЗЕРВИРОВАНИЕ ОСТАТКОВ ==========
+STOCK_BEGIN_RETRIES = 3
+
+
+class StockReservations:
+    """Списание остатков корзины условными UPDATE в одной транзакции BEGIN IMMEDIATE с записью в журнал"""
+
+    def __init__(self, begin_retries=STOCK_BEGIN_RETRIES):
+        self.begin_retries = begin_retries
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._counters = {'reservations': 0, 'rejected_orders': 0, 'shortfall_items': 0, 'busy_retries': 0}
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def begin(self, db):
+        """Взять блокировку на запись сразу; после busy_timeout - ограниченное число повторов"""
+        for attempt in range(self.begin_retries + 1):
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as e:
+                if ('locked' not in str(e) and 'busy' not in str(e)) or attempt == self.begin_retries:
+                    raise
+                self._count('busy_retries')
+                time.sleep(0.05 * (2 ** attempt))
+
+    @contextmanager
+    def transaction(self, db):
+        """Транзакция оформления заказа; незакоммиченное при выходе откатывается.
+
+        Потоки одного воркера встают в очередь на threading.Lock, а не на busy-обработчик SQLite
+        с его задержками до 100 мс; между процессами порядок по-прежнему задает BEGIN IMMEDIATE.
+        """
+        with self._write_lock:
+            self.begin(db)
+            try:
+                yield
+            finally:
+                if db.in_transaction:
+                    db.rollback()
+
+    def reserve(self, db, order_id, items):
+        """Списать остатки по позициям расчета; возвращает список нехваток (пустой - все списано)"""
+        pieces, weights, names = {}, {}, {}
+        for item in items:
+            names[item['id']] = item.get('name')
+            if item.get('is_weight'):
+                weights[item['id']] = weights.get(item['id'], 0) + float(item.get('weight') or 0)
+            else:
+                pieces[item['id']] = pieces.get(item['id'], 0) + int(item.get('quantity') or 1)
+
+        shortfalls = []
+        ledger = []
+        for product_id, quantity in sorted(pieces.items()):
+            row = db.execute('''
+                             UPDATE products
+                             SET stock = stock - ?
+                             WHERE id = ?
+                               AND stock >= ?
+                             RETURNING id
+                             ''', (quantity, product_id, quantity)).fetchone()
+            if row:
+                ledger.append((order_id, product_id, 'hold', quantity, 'piece'))
+            else:
+                shortfalls.append(self._shortfall(db, product_id, names.get(product_id), quantity, 'piece'))
+
+        for product_id, weight in sorted(weights.items()):
+            row = db.execute('''
+                             UPDATE products
+                             SET stock_weight = stock_weight - ?
+                             WHERE id = ?
+                               AND stock_weight >= ?
+                             RETURNING id
+                             ''', (weight, product_id, weight)).fetchone()
+            if row and weight > 0:
+                ledger.append((order_id, product_id, 'hold', weight, 'kg'))
+            elif not row:
+                shortfalls.append(self._shortfall(db, product_id, names.get(product_id), weight, 'kg'))
+
+        if shortfalls:
+            # Частично выполненные списания откатит вызывающий код вместе с заказом
+            self._count('rejected_orders')
+            self._count('shortfall_items', len(shortfalls))
+            return shortfalls
+
+        db.executemany('''
+                       INSERT INTO inventory_ledger (order_id, product_id, kind, quantity, unit)
+                       VALUES (?, ?, ?, ?, ?)
+                       ''', ledger)
+        self._count('reservations')
+        return []
+
+    def _shortfall(self, db, product_id, name, requested, unit):
+        column = 'stock_weight' if unit == 'kg' else 'stock'
+        row = db.execute(f'SELECT name, {column} as available FROM products WHERE id = ?', (product_id,)).fetchone()
+        return {
+            'id': product_id,
+            'name': row['name'] if row else name,
+            'requested': requested,
+            'available': max(0, row['available'] or 0) if row else 0,
+            'unit': unit
+        }
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+stock_reservations = StockReservations()
+
+
+def format_stock_shortfalls(shortfalls):
+    parts = []
+    for item in shortfalls:
+        unit = 'кг' if item['unit'] == 'kg' else 'шт.'
+        parts.append(f"{item['name']}: доступно {item['available']:g} {unit}")
+    return 'Недостаточно товара на складе: ' + '; '.join(parts)
+
+
+@app.cli.command('checkout-bench')
+@click.option('--orders', default=300, help='Заказов на каждый уровень параллельности')
+@click.option('--clients', default='1,8,32', help='Уровни параллельности через запятую')
+def checkout_bench_command(orders, clients):
+    """Пропускная способность /api/create-order на копии БД и проверка отсутствия перепродажи"""
+    levels = [int(level) for level in clients.split(',') if level.strip()]
+    source = app.config['DATABASE']
+    pool_size = app.config['DB_POOL_SIZE']
+    workdir = tempfile.mkdtemp(prefix='checkout-bench-')
+    bench_db = os.path.join(workdir, 'bench.db')
+
+    src_conn, dst_conn = sqlite3.connect(source), sqlite3.connect(bench_db)
+    try:
+        src_conn.backup(dst_conn)
+    finally:
+        src_conn.close()
+        dst_conn.close()
+
+    notification_dispatcher.enabled = False
+    app.config['DATABASE'] = bench_db
+    app.config['DB_POOL_SIZE'] = max(pool_size, max(levels))
+    try:
+        db = get_db()
+        try:
+            product = db.execute("SELECT id FROM products WHERE product_type = 'piece' ORDER BY id LIMIT 1").fetchone()
+            if not product:
+                print('Нет штучных товаров для теста')
+                return
+            product_id = product['id']
+            db.execute('UPDATE products SET stock = ? WHERE id = ?', (orders * len(levels) * 10, product_id))
+            db.commit()
+        finally:
+            db.close()
+
+        payload = {
+            'items': [{'id': product_id, 'quantity': 1}],
+            'delivery_type': 'pickup',
+            'pickup_point': 'checkout-bench',
+            'recipient_name': 'Benchmark',
+            'user_id': 1
+        }
+
+        def checkout(number):
+            # Разные адреса клиентов, чтобы тест не упирался в rate_limit по IP
+            remote_addr = f'10.{number // 65536 % 256}.{number // 256 % 256}.{number % 256}'
+            started = time.perf_counter()
+            response = app.test_client().post('/api/create-order', json=payload,
+                                              environ_overrides={'REMOTE_ADDR': remote_addr})
+            return time.perf_counter() - started, response.status_code
+
+        print(f'{"clients":>8} {"orders/s":>10} {"p50 ms":>8} {"p95 ms":>8} {"errors":>7}')
+        for level in levels:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=level) as executor:
+                results = list(executor.map(checkout, range(orders)))
+            elapsed = time.perf_counter() - started
+
+            latencies = sorted(latency for latency, _ in results)
+            errors = sum(1 for _, status in results if status != 200)
+            print(f'{level:>8} {orders / elapsed:>10.1f} {latencies[len(latencies) // 2] * 1000:>8.1f} '
+                  f'{latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000:>8.1f} {errors:>7}')
+
+        # Остаток меньше числа покупателей: успешных заказов должно быть ровно столько, сколько было товара
+        limited = max(1, orders // 4)
+        db = get_db()
+        try:
+            db.execute('UPDATE products SET stock = ? WHERE id = ?', (limited, product_id))
+            db.commit()
+        finally:
+            db.close()
+        with ThreadPoolExecutor(max_workers=max(levels)) as executor:
+            results = list(executor.map(checkout, range(orders)))
+        db = get_db()
+        try:
+            left = db.execute('SELECT stock FROM products WHERE id = ?', (product_id,)).fetchone()['stock']
+        finally:
+            db.close()
+        succeeded = sum(1 for _, status in results if status == 200)
+        print(f'oversell check: stock {limited}, orders {orders}, succeeded {succeeded}, stock left {left}')
+        print(f'reservations: {stock_reservations.stats()}')
+    finally:
+        app.config['DATABASE'] = source
+        app.config['DB_POOL_SIZE'] = pool_size
+        get_db_pool()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+PROMO_NEGATIVE_TTL = 60.0
+# Как часто перечитывать версию 'promo_codes' из cache_versions; между опросами кэш отказов не ходит в БД
+PROMO_VERSION_POLL_SECONDS = 2.0
+PROMO_CLAIM_RETRIES = 3
+PROMO_ERROR_NOT_FOUND = 'Промокод не найден'
+PROMO_ERROR_EXHAUSTED = 'Промокод закончился'
+PROMO_ERROR_EXPIRED = 'Срок действия промокода истек'
+
+
+class PromoCodeRedemptions:
+    """Атомарное списание использований промокода и негативный кэш несуществующих/исчерпанных кодов.
+
+    Записи кэша привязаны к версии 'promo_codes' в cache_versions: админские правки промокодов
+    увеличивают ее в своей транзакции, и отказы устаревают во всех воркерах. Версию воркер
+    перечитывает не чаще раза в PROMO_VERSION_POLL_SECONDS, так что попадание в кэш обходится без БД
+    """
+
+    def __init__(self, negative_ttl=PROMO_NEGATIVE_TTL, max_entries=10000,
+                 version_poll=PROMO_VERSION_POLL_SECONDS):
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.version_poll = version_poll
+        self._lock = threading.Lock()
+        self._negative = {}
+        self._version = None
+        self._version_checked = 0.0
+        self._counters = {'claims': 0, 'rejections': 0, 'contention_retries': 0,
+                          'negative_hits': 0, 'negative_misses': 0}
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def version(self, db):
+        """Версия 'promo_codes', которую видел этот воркер не раньше version_poll секунд назад"""
+        now = time.monotonic()
+        with self._lock:
+            if self._version is not None and now - self._version_checked < self.version_poll:
+                return self._version
+        version = get_cache_version(db, 'promo_codes')
+        with self._lock:
+            self._version = version
+            self._version_checked = now
+        return version
+
+    def rejected(self, code, version):
+        """Закэшированный отказ по коду при текущей версии промокодов: (promo_dict, ошибка) или None"""
+        with self._lock:
+            entry = self._negative.get(code)
+            if entry and entry[0] > time.monotonic() and entry[1] == version:
+                self._counters['negative_hits'] += 1
+                return entry[2], entry[3]
+            if entry:
+                del self._negative[code]
+            self._counters['negative_misses'] += 1
+            return None
+
+    def reject(self, code, version, promo_dict, error):
+        with self._lock:
+            if len(self._negative) >= self.max_entries:
+                self._negative.clear()
+            self._negative[code] = (time.monotonic() + self.negative_ttl, version, promo_dict, error)
+
+    def claim(self, db, promo):
+        """Списать одно использование в транзакции заказа: (списано, это было последнее использование).
+
+        Исчерпанным код кэшируется только после коммита заказа (mark_exhausted): при откате
+        последнее использование остается доступным. Сроки действия проверяются здесь же -
+        подписанный расчет живет дольше, чем может оставаться до end_date.
+        """
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        for attempt in range(PROMO_CLAIM_RETRIES + 1):
+            try:
+                row = db.execute('''
+                                 UPDATE promo_codes
+                                 SET used_count = COALESCE(used_count, 0) + 1
+                                 WHERE id = ?
+                                   AND is_active = 1
+                                   AND (COALESCE(usage_limit, 0) = 0 OR COALESCE(used_count, 0) < usage_limit)
+                                   AND COALESCE(datetime(start_date) <= ?, 1)
+                                   AND COALESCE(datetime(end_date) >= ?, 1)
+                                 RETURNING used_count, usage_limit
+                                 ''', (promo['id'], now, now)).fetchone()
+                break
+            except sqlite3.OperationalError as e:
+                # Списание - первая запись в транзакции заказа, повтор после busy ничего не дублирует
+                # (внутри BEGIN IMMEDIATE заказа busy уже не возникает)
+                if 'locked' not in str(e) or attempt == PROMO_CLAIM_RETRIES:
+                    raise
+                self._count('contention_retries')
+                time.sleep(0.01 * (2 ** attempt))
+
+        if not row:
+            self._count('rejections')
+            return False, False
+
+        self._count('claims')
+        return True, bool(row['usage_limit'] and row['used_count'] >= row['usage_limit'])
+
+    def mark_exhausted(self, db, promo):
+        """Закэшировать код как исчерпанный - после коммита заказа, забравшего последнее использование"""
+        self.reject(promo['code'], self.version(db), promo, PROMO_ERROR_EXHAUSTED)
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._counters)
+            result['negative_cache_size'] = len(self._negative)
+        return result
+
+
+promo_redemptions = PromoCodeRedemptions()
+
+
+def find_promo_code(db, code):
+    """Активный промокод по коду: (promo_dict, ошибка)"""
+    code = (code or '').strip().upper()
+    if not code:
+        return None, 'Введите промокод'
+
+    version = promo_redemptions.version(db)
+    cached = promo_redemptions.rejected(code, version)
+    if cached:
+        return cached
+
+    promo = db.execute('SELECT * FROM promo_codes WHERE code = ? AND is_active = 1', (code,)).fetchone()
+    if not promo:
+        promo_redemptions.reject(code, version, None, PROMO_ERROR_NOT_FOUND)
+        return None, PROMO_ERROR_NOT_FOUND
+
+    promo_dict = dict(promo)
+    now = datetime.now()
+
+    end_date = parse_db_datetime(promo_dict.get('end_date'))
+    if end_date and end_date < now:
+        promo_redemptions.reject(code, version, promo_dict, PROMO_ERROR_EXPIRED)
+        return promo_dict, PROMO_ERROR_EXPIRED
+
+    if promo_dict.get('usage_limit') and (promo_dict.get('used_count') or 0) >= promo_dict['usage_limit']:
+        promo_redemptions.reject(code, version, promo_dict, PROMO_ERROR_EXHAUSTED)
+        return promo_dict, PROMO_ERROR_EXHAUSTED
+
+    start_date = parse_db_datetime(promo_dict.get('start_date'))
+    if start_date and start_date > now:
+        return promo_dict, 'Промокод еще не активен'
+
+    return promo_dict, None
+
+
+def build_quote(db, items, promo_code=None, delivery_type=None):
+    """Расчет корзины по ценам из БД: скидки, промокод, весовые товары и доставка за один проход"""
+    product_ids = sorted({pid for pid in (parse_cart_product_id(item) for item in items) if pid is not None})
+    products = {}
+    if product_ids:
+        placeholders = ','.join('?' * len(product_ids))
+        rows = db.execute(f'''
+                          SELECT id, name, price, category, stock, product_type, price_per_kg, stock_weight
+                          FROM products
+                          WHERE id IN ({placeholders})
+                          ''', product_ids).fetchall()
+        products = {row['id']: dict(row) for row in rows}
+
+    discount_engine.refresh(db)
+
+    quote_items = []
+    unknown_items = []
+    subtotal = 0.0
+    items_discount = 0.0
+    sale_free_total = 0.0
+
+    for item in items:
+        product_id = parse_cart_product_id(item)
+        product = products.get(product_id)
+        if not product:
+            unknown_items.append(item.get('id'))
+            continue
+
+        is_weight = product['product_type'] == 'weight'
+        if is_weight:
+            # Весовой товар - одна позиция, цена за весь вес (как считает корзина webapp)
+            weight = float(item.get('weight') or 0)
+            quantity = 1
+            unit_price = float(product['price_per_kg'] or product['price'] or 0)
+            line_total = float(math.floor(weight * unit_price))
+            available = float(product['stock_weight'] or 0) >= weight > 0
+        else:
+            weight = None
+            quantity = max(1, int(item.get('quantity') or 1))
+            unit_price = float(product['price'] or 0)
+            line_total = unit_price * quantity
+            available = (product['stock'] or 0) >= quantity
+
+        discount, rule = discount_engine.best_discount(product_id, product['category'], line_total / quantity,
+                                                       quantity)
+        discounted_total = line_total - discount
+
+        quote_items.append({
+            'id': product_id,
+            'name': product['name'],
+            'is_weight': is_weight,
+            'weight': weight,
+            'quantity': quantity,
+            'unit_price': unit_price,
+            # price/original_price в формате корзины: за штуку у штучных, за весь вес у весовых
+            'original_price': round(line_total / quantity, 2),
+            'price': round(discounted_total / quantity, 2),
+            'line_total': round(discounted_total, 2),
+            'discount': round(discount, 2),
+            'discount_id': rule['id'] if rule else None,
+            'available': available
+        })
+
+        subtotal += line_total
+        items_discount += discount
+        if not discount:
+            sale_free_total += discounted_total
+
+    discounted_subtotal = subtotal - items_discount
+
+    promo_dict, promo_error = (None, None)
+    promo_discount = 0.0
+    free_delivery = False
+    if promo_code:
+        promo_dict, promo_error = find_promo_code(db, promo_code)
+        if not promo_error:
+            min_amount = float(promo_dict.get('min_order_amount') or 0)
+            if min_amount and discounted_subtotal < min_amount:
+                promo_error = f'Минимальная сумма заказа для промокода: {min_amount:.0f} ₽'
+            else:
+                base = sale_free_total if promo_dict.get('exclude_sale_items') else discounted_subtotal
+                value = float(promo_dict.get('value') or 0)
+                if promo_dict['discount_type'] == 'percentage':
+                    promo_discount = base * (value / 100)
+                elif promo_dict['discount_type'] == 'fixed':
+                    promo_discount = min(value, base)
+                elif promo_dict['discount_type'] == 'free_delivery':
+                    free_delivery = True
+
+    order_total = max(0.0, discounted_subtotal - promo_discount)
+
+    delivery_cost = 0.0
+    if delivery_type == 'courier' and not free_delivery and order_total < app.config['FREE_DELIVERY_THRESHOLD']:
+        delivery_cost = app.config['DELIVERY_COST']
+
+    return {
+        'items': quote_items,
+        'unknown_items': unknown_items,
+        'all_available': not unknown_items and all(item['available'] for item in quote_items),
+        'subtotal': round(subtotal, 2),
+        'items_discount': round(items_discount, 2),
+        'discounted_subtotal': round(discounted_subtotal, 2),
+        'promo_code': promo_dict['code'] if promo_dict and not promo_error else None,
+        'promo_code_id': promo_dict['id'] if promo_dict and not promo_error else None,
+        'promo_type': promo_dict['discount_type'] if promo_dict and not promo_error else None,
+        'promo_value': float(promo_dict.get('value') or 0) if promo_dict and not promo_error else None,
+        'promo_discount': round(promo_discount, 2),
+        'promo_error': promo_error,
+        'delivery_type': delivery_type,
+        'delivery_cost': delivery_cost,
+        'order_total': round(order_total, 2),
+        'total': round(order_total + delivery_cost, 2)
+    }
 
-            cursor = db.execute('''
-                                INSERT INTO product_categories (name, parent_id, discount_id, sort_order)
-                                VALUES (?, ?, ?, ?)
-                                ''', (
-                                    data['name'],
-                                    data.get('parent_id'),
-                                    data.get('discount_id'),
-                                    data.get('sort_order', 0)
-                                ))
 
-            db.commit()
-            return jsonify({'success': True, 'id': cursor.lastrowid})
+def get_quote_serializer():
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='order-quote')
 
-        elif request.method == 'PUT':
-            category_id = request.args.get('id')
-            data = request.json
 
-            if not category_id:
-                return jsonify({'success': False, 'error': 'Не указан ID категории'}), 400
+def sign_quote(quote):
+    return get_quote_serializer().dumps(quote)
 
-            db.execute('''
-                       UPDATE product_categories
-                       SET name        = ?,
-                           parent_id   = ?,
-                           discount_id = ?,
-                           sort_order  = ?
-                       WHERE id = ?
-                       ''', (
-                           data.get('name'),
-                           data.get('parent_id'),
-                           data.get('discount_id'),
-                           data.get('sort_order', 0),
-                           category_id
-                       ))
 
-            db.commit()
-            return jsonify({'success': True})
+def load_signed_quote(token):
+    """Проверить подпись и срок действия расчета; None если расчету доверять нельзя"""
+    if not token:
+        return None
+    try:
+        return get_quote_serializer().loads(token, max_age=app.config['QUOTE_TTL_SECONDS'])
+    except (BadSignature, SignatureExpired):
+        return None
 
-        elif request.method == 'DELETE':
-            category_id = request.args.get('id')
 
-            if not category_id:
-                return jsonify({'success': False, 'error': 'Не указан ID категории'}), 400
+def quote_matches_cart(quote, items, promo_code, delivery_type):
+    """Расчет сделан именно для этой корзины, промокода и способа доставки"""
+    if quote.get('delivery_type') != delivery_type:
+        return False
+    if (quote.get('promo_code') or None) != ((promo_code or '').strip().upper() or None):
+        return False
 
-            products_count = db.execute(
-                'SELECT COUNT(*) FROM products WHERE category = (SELECT name FROM product_categories WHERE id = ?)',
-                (category_id,)
-            ).fetchone()[0]
+    def fingerprint(entries):
+        return sorted(
+            (parse_cart_product_id(entry) or 0,
+             int(entry.get('quantity') or 1) if not entry.get('is_weight') else 1,
+             round(float(entry.get('weight') or 0), 3) if entry.get('is_weight') else 0)
+            for entry in entries)
 
-            if products_count > 0:
-                return jsonify({'success': False, 'error': 'Нельзя удалить категорию с товарами'}), 400
+    return fingerprint(quote.get('items', [])) == fingerprint(items)
 
-            children_count = db.execute(
-                'SELECT COUNT(*) FROM product_categories WHERE parent_id = ?',
-                (category_id,)
-            ).fetchone()[0]
 
-            if children_count > 0:
-                return jsonify({'success': False, 'error': 'Нельзя удалить категорию с подкатегориями'}), 400
+@app.route('/api/quote', methods=['POST'])
+@rate_limit(max_requests=60, window=60)
+@validate_json_request
+def api_quote():
+    """Расчет стоимости корзины с подписью, которой доверяет оформление заказа"""
+    data = request.json or {}
+    items = data.get('items') or []
 
-            db.execute('DELETE FROM product_categories WHERE id = ?', (category_id,))
-            db.commit()
-            return jsonify({'success': True})
+    if not items:
+        return jsonify({'success': False, 'error': 'Корзина пуста'}), 400
 
+    db = get_db()
+    try:
+        quote = build_quote(db, items, data.get('promo_code'), data.get('delivery_type'))
+        quote['expires_in'] = app.config['QUOTE_TTL_SECONDS']
+        return jsonify({'success': True, 'quote': quote, 'quote_token': sign_quote(quote)})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
     finally:
         db.close()
 
+
 @app.route('/api/check-discount', methods=['POST'])
 def check_discount():
     """Проверить скидки для товаров в корзине"""
@@ -5296,57 +9211,10 @@ def check_discount():
             return jsonify({'discounts': [], 'total_discount': 0})
 
         db = get_db()
+        resolved = discount_engine.resolve_cart(db, items)
 
-        discounts = db.execute('''
-                               SELECT d.*, da.product_id, da.category, da.apply_to_all
-                               FROM discounts d
-                                        LEFT JOIN discount_applications da ON d.id = da.discount_id
-                               WHERE d.is_active = 1
-                                 AND (d.start_date IS NULL OR d.start_date <= CURRENT_TIMESTAMP)
-                                 AND (d.end_date IS NULL OR d.end_date >= CURRENT_TIMESTAMP)
-                               ''').fetchall()
-
-        item_discounts = []
-        total_discount = 0
-
-        for item in items:
-            product_id = item.get('id')
-            quantity = item.get('quantity', 1)
-            price = item.get('price', 0)
-
-            item_discount = 0
-
-            for discount in discounts:
-                discount_dict = dict(discount)
-
-                applies = False
-
-                if discount_dict['apply_to_all']:
-                    applies = True
-                elif discount_dict['product_id'] and discount_dict['product_id'] == product_id:
-                    applies = True
-                elif discount_dict['category']:
-                    product = db.execute('SELECT category FROM products WHERE id = ?', (product_id,)).fetchone()
-                    if product and product['category'] == discount_dict['category']:
-                        applies = True
-
-                if applies:
-                    discount_value = 0
-                    if discount_dict['discount_type'] == 'percentage':
-                        discount_value = price * quantity * (discount_dict['value'] / 100)
-                        if discount_dict['max_discount']:
-                            discount_value = min(discount_value, discount_dict['max_discount'])
-                    elif discount_dict['discount_type'] == 'fixed':
-                        discount_value = discount_dict['value'] * quantity
-
-                    item_discount += discount_value
-
-            item_discounts.append({
-                'product_id': product_id,
-                'discount': item_discount
-            })
-
-            total_discount += item_discount
+        item_discounts = [{'product_id': item['id'], 'discount': item['discount']} for item in resolved]
+        total_discount = sum(item['discount'] for item in resolved)
 
         db.close()
 
@@ -5376,37 +9244,9 @@ def check_promo_code():
 
         db = get_db()
 
-        promo = db.execute('''
-                           SELECT *
-                           FROM promo_codes
-                           WHERE code = ?
-                             AND is_active = 1
-                           ''', (code,)).fetchone()
-
-        if not promo:
-            return jsonify({'success': False, 'error': 'Промокод не найден'}), 404
-
-        promo_dict = dict(promo)
-
-        now = datetime.now()
-        if promo_dict.get('end_date'):
-            try:
-                end_date = datetime.strptime(promo_dict['end_date'], '%Y-%m-%d %H:%M:%S')
-                if end_date < now:
-                    return jsonify({'success': False, 'error': 'Срок действия промокода истек'}), 400
-            except Exception as e:
-                pass
-
-        if promo_dict.get('usage_limit') and promo_dict.get('used_count', 0) >= promo_dict['usage_limit']:
-            return jsonify({'success': False, 'error': 'Промокод закончился'}), 400
-
-        if promo_dict.get('start_date'):
-            try:
-                start_date = datetime.strptime(promo_dict['start_date'], '%Y-%m-%d %H:%M:%S')
-                if start_date > now:
-                    return jsonify({'success': False, 'error': 'Промокод еще не активен'}), 400
-            except Exception as e:
-                pass
+        promo_dict, error = find_promo_code(db, code)
+        if error:
+            return jsonify({'success': False, 'error': error}), 404 if promo_dict is None else 400
 
         promo_dict['value'] = float(promo_dict.get('value', 0)) if promo_dict.get('value') else 0
         promo_dict['min_order_amount'] = float(promo_dict.get('min_order_amount', 0)) if promo_dict.get(
@@ -5427,95 +9267,87 @@ def check_promo_code():
 
 
 @app.route('/api/promo-codes', methods=['GET'])
+@http_cache('private')
 def get_promo_codes():
     """Получить все промокоды"""
     db = get_db()
     try:
-        promo_codes = db.execute('SELECT * FROM promo_codes ORDER BY created_at DESC').fetchall()
+        # Коды массовых пакетов одноразовые и раздаются адресно - в публичный список они не попадают
+        promo_codes = db.execute('SELECT * FROM promo_codes WHERE batch_id IS NULL ORDER BY created_at DESC').fetchall()
         result = [dict(pc) for pc in promo_codes]
         db.close()
         return jsonify(result)
     except Exception as e:
         db.close()
-        return jsonify([])
+        return jsonify([]), 500
+
+
+def build_catalog_products_with_discounts(db, category):
+    """Товары с примененными скидками (тело ответа /api/products/with-discounts) из product_prices"""
+    query = '''
+            SELECT p.*,
+                   pp.base_price,
+                   pp.final_price,
+                   pp.discount_amount,
+                   pp.discount_percentage,
+                   pp.discount_id,
+                   pp.stale
+            FROM products p
+                     LEFT JOIN product_prices pp ON pp.product_id = p.id
+            WHERE p.stock > 0
+            '''
+    params = []
+    if category and category != 'all':
+        query += ' AND p.category = ?'
+        params.append(category)
+    query += ' ORDER BY p.created_at DESC'
+
+    result = []
+    stale_found = False
+    for product in db.execute(query, params).fetchall():
+        product_dict = dict(product)
+        base_price = product_dict.pop('base_price')
+        final_price = product_dict.pop('final_price')
+        discount = product_dict.pop('discount_amount') or 0
+        discount_percentage = product_dict.pop('discount_percentage')
+        discount_id = product_dict.pop('discount_id')
+
+        if product_dict.pop('stale') != 0:
+            # Строку еще не пересчитал планировщик: считаем цену в памяти, без записи в product_prices
+            stale_found = True
+            base_price, final_price, discount, discount_percentage, discount_id = compute_product_price(product_dict)
+
+        if final_price is None:
+            final_price = product_dict['price']
+        if discount > 0:
+            product_dict['original_price'] = base_price
+            product_dict['discount'] = discount
+            product_dict['discount_percentage'] = discount_percentage
+            product_dict['discount_id'] = discount_id
+
+        product_dict['final_price'] = final_price
+        result.append(product_dict)
+
+    if stale_found:
+        product_price_scheduler.wake()
+    return result
 
 
 @app.route('/api/products/with-discounts', methods=['GET'])
+@http_cache('catalog')
 def get_products_with_discounts():
     """Получить товары со скидками"""
     db = get_db()
     try:
         category = request.args.get('category', 'all')
-
-        if category and category != 'all':
-            products = db.execute('''
-                                  SELECT *
-                                  FROM products
-                                  WHERE stock > 0
-                                    AND category = ?
-                                  ORDER BY created_at DESC
-                                  ''', (category,)).fetchall()
-        else:
-            products = db.execute('''
-                                  SELECT *
-                                  FROM products
-                                  WHERE stock > 0
-                                  ORDER BY created_at DESC
-                                  ''').fetchall()
-
-        discounts = db.execute('''
-                               SELECT d.*, da.product_id, da.category, da.apply_to_all
-                               FROM discounts d
-                                        LEFT JOIN discount_applications da ON d.id = da.discount_id
-                               WHERE d.is_active = 1
-                                 AND (d.start_date IS NULL OR d.start_date <= CURRENT_TIMESTAMP)
-                                 AND (d.end_date IS NULL OR d.end_date >= CURRENT_TIMESTAMP)
-                               ''').fetchall()
-
-        result = []
-
-        for product in products:
-            product_dict = dict(product)
-
-            product_discount = 0
-            discounted_price = product_dict['price']
-
-            for discount in discounts:
-                discount_dict = dict(discount)
-
-                applies = False
-
-                if discount_dict['apply_to_all']:
-                    applies = True
-                elif discount_dict['product_id'] and discount_dict['product_id'] == product_dict['id']:
-                    applies = True
-                elif discount_dict['category'] and product_dict['category'] == discount_dict['category']:
-                    applies = True
-
-                if applies:
-                    if discount_dict['discount_type'] == 'percentage':
-                        discount_amount = product_dict['price'] * (discount_dict['value'] / 100)
-                        if discount_dict['max_discount']:
-                            discount_amount = min(discount_amount, discount_dict['max_discount'])
-                        product_discount += discount_amount
-                    elif discount_dict['discount_type'] == 'fixed':
-                        product_discount += discount_dict['value']
-
-            if product_discount > 0:
-                discounted_price = max(0, product_dict['price'] - product_discount)
-                product_dict['original_price'] = product_dict['price']
-                product_dict['discount'] = product_discount
-                product_dict['discount_percentage'] = round((product_discount / product_dict['price']) * 100, 1)
-
-            product_dict['final_price'] = discounted_price
-            result.append(product_dict)
-
-        return jsonify(result)
-
+        # Пересчет product_prices - дело ProductPriceScheduler и админских правок скидок;
+        # чтение не берет блокировку записи, устаревшие строки досчитываются в памяти
+        discount_engine.refresh(db)
+        return catalog_cache.respond(db, ('products_with_discounts', category),
+                                     lambda: build_catalog_products_with_discounts(db, category),
+                                     extra_version=(get_cache_version(db, 'prices'), discount_engine.state))
     except Exception as e:
-        if 'products' in locals():
-            return jsonify([dict(p) for p in products])
-        return jsonify([])
+        return jsonify({'success': False, 'error': str(e)}), 500
     finally:
         db.close()
 
@@ -5525,21 +9357,38 @@ def admin_products():
     db = get_db()
     try:
         if request.method == 'GET':
-            products = db.execute('''
-                                  SELECT p.*,
-                                         pc.name as category_name,
-                                         CASE
-                                             WHEN p.product_type = 'weight' AND p.stock_weight > 0 THEN p.stock_weight
-                                             ELSE p.stock
-                                             END as display_stock,
-                                         CASE
-                                             WHEN p.product_type = 'weight' AND p.price_per_kg > 0 THEN p.price_per_kg
-                                             ELSE p.price
-                                             END as display_price
-                                  FROM products p
-                                           LEFT JOIN product_categories pc ON p.category_id = pc.id
-                                  ORDER BY p.created_at DESC
-                                  ''').fetchall()
+            select_sql = '''
+                         SELECT p.*,
+                                pc.name as category_name,
+                                CASE
+                                    WHEN p.product_type = 'weight' AND p.stock_weight > 0 THEN p.stock_weight
+                                    ELSE p.stock
+                                    END as display_stock,
+                                CASE
+                                    WHEN p.product_type = 'weight' AND p.price_per_kg > 0 THEN p.price_per_kg
+                                    ELSE p.price
+                                    END as display_price
+                         FROM products p
+                                  LEFT JOIN product_categories pc ON p.category_id = pc.id
+                         '''
+
+            # Постраничный режим: ?limit=&cursor= плюс фильтры category, product_type, min_price, max_price, in_stock
+            if 'limit' in request.args or 'cursor' in request.args:
+                try:
+                    clauses, params, branches = build_products_filters(db, request.args)
+                    products, next_cursor = paginate_products(db, select_sql, clauses, params, request.args,
+                                                              branches)
+                except ValueError as e:
+                    return jsonify({'success': False, 'error': str(e)}), 400
+
+                return jsonify({
+                    'success': True,
+                    'products': [dict(product) for product in products],
+                    'next_cursor': next_cursor,
+                    'has_more': next_cursor is not None
+                })
+
+            products = db.execute(select_sql + ' ORDER BY p.created_at DESC').fetchall()
 
             return jsonify([dict(product) for product in products])
         if request.method == 'GET':
@@ -5598,8 +9447,10 @@ def admin_products():
                      data.get('step_weight', 0.1),
                      stock_weight))
 
-            db.commit()
+            # id берем до записи версии каталога: UPSERT в cache_versions меняет last_insert_rowid()
             product_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+            bump_cache_version(db, 'catalog')
+            db.commit()
             return jsonify({'success': True, 'id': product_id})
 
         elif request.method == 'PUT':
@@ -5669,6 +9520,7 @@ def admin_products():
                      stock_weight,
                      product_id))
 
+            bump_cache_version(db, 'catalog')
             db.commit()
             return jsonify({'success': True})
 
@@ -5678,6 +9530,7 @@ def admin_products():
                 return jsonify({'success': False, 'error': 'Не указан ID товара'}), 400
 
             db.execute('DELETE FROM products WHERE id = ?', (product_id,))
+            bump_cache_version(db, 'catalog')
             db.commit()
             return jsonify({'success': True})
     except Exception as e:
@@ -5686,61 +9539,250 @@ def admin_products():
         db.close()
 
 
+ADMIN_ORDERS_PAGE_DEFAULT = 50
+ADMIN_ORDERS_PAGE_MAX = 200
+ADMIN_ORDERS_LEGACY_LIMIT = 100
+
+# Поле списка заказов в админке -> выражение SQL (для ?fields=)
+ADMIN_ORDER_FIELDS = {
+    'id': 'o.id',
+    'user_id': 'o.user_id',
+    'username': 'o.username',
+    'status': 'o.status',
+    'total_price': 'o.total_price',
+    'delivery_cost': 'o.delivery_cost',
+    'discount_amount': 'o.discount_amount',
+    'delivery_type': 'o.delivery_type',
+    'pickup_point': 'o.pickup_point',
+    'payment_method': 'o.payment_method',
+    'recipient_name': 'o.recipient_name',
+    'phone_number': 'o.phone_number',
+    'created_at': 'o.created_at',
+    'updated_at': 'o.updated_at',
+    'address_city': 'o.address_city',
+    'address_street': 'o.address_street',
+    'address_house': 'o.address_house',
+    'assignment_status': 'a.status',
+    'courier_name': 'c.full_name',
+    'courier_phone': 'c.phone',
+    'promo_code': 'pc.code',
+    'total_with_discount': '(o.total_price + COALESCE(o.delivery_cost, 0) - COALESCE(o.discount_amount, 0))',
+    # Тяжелые JSON-поля: разбираются только если их запросили
+    'items': 'o.items',
+    'delivery_address': 'o.delivery_address',
+}
+
+ADMIN_ORDERS_FROM_SQL = '''
+    FROM orders o
+             LEFT JOIN order_assignments a ON o.id = a.order_id
+             LEFT JOIN couriers c ON a.courier_id = c.id
+             LEFT JOIN promo_codes pc ON o.promo_code_id = pc.id
+'''
+
+ORDER_PHONE_SEARCH_RE = re.compile(r'[\d+\-() ]+')
+
+
+def encode_orders_cursor(value, order_id):
+    raw = json.dumps([value, order_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_orders_cursor(cursor):
+    """Курсор -> (значение ключа сортировки, id заказа); ValueError на мусор"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, order_id = json.loads(raw)
+        return str(value), int(order_id)
+    except (TypeError, ValueError, json.JSONDecodeError, UnicodeDecodeError):
+        raise ValueError('Неверный курсор')
+
+
+def parse_admin_order_fields(value):
+    """?fields=id,status,... -> список полей (id всегда); None - все поля, как раньше"""
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in ADMIN_ORDER_FIELDS]
+    if unknown:
+        raise ValueError(f"Неизвестные поля: {', '.join(unknown)}")
+    return ['id'] + [field for field in fields if field != 'id']
+
+
+def build_admin_orders_filters(args):
+    """WHERE-условия списка заказов: status (через запятую), delivery_type, courier_id,
+    date_from/date_to (по created_at), q - телефон или имя по началу строки. ValueError на неверные значения"""
+    clauses, params = [], []
+
+    statuses = [status for status in (args.get('status') or '').split(',') if status]
+    if statuses:
+        clauses.append(f"o.status IN ({','.join('?' * len(statuses))})")
+        params.extend(statuses)
+
+    if args.get('delivery_type'):
+        clauses.append('o.delivery_type = ?')
+        params.append(args['delivery_type'])
+
+    if args.get('courier_id'):
+        clauses.append('a.courier_id = ?')
+        params.append(int(args['courier_id']))
+
+    for name, operator in (('date_from', '>='), ('date_to', '<=')):
+        value = args.get(name)
+        if not value:
+            continue
+        moment = parse_db_datetime(value)
+        if moment is None:
+            raise ValueError(f'Неверная дата {name}')
+        # Дата без времени в date_to - весь этот день
+        if name == 'date_to' and len(value.strip()) == 10:
+            moment, operator = moment + timedelta(days=1), '<'
+        clauses.append(f'o.created_at {operator} ?')
+        params.append(moment.strftime('%Y-%m-%d %H:%M:%S'))
+
+    search = (args.get('q') or '').strip()
+    if search:
+        # Поиск по началу строки, чтобы работали индексы по телефону и именам
+        if ORDER_PHONE_SEARCH_RE.fullmatch(search):
+            clauses.append('o.phone_number GLOB ?')
+            params.append(search + '*')
+        else:
+            pattern = re.sub(r'([\\%_])', r'\\\1', search) + '%'
+            clauses.append("(o.recipient_name LIKE ? ESCAPE '\\' OR o.username LIKE ? ESCAPE '\\')")
+            params.extend([pattern, pattern])
+
+    return clauses, params
+
+
+def serialize_admin_order(order, items=None):
+    order_dict = dict(order)
+    if items is not None:
+        order_dict['items'] = items
+
+    if order_dict.get('delivery_address'):
+        try:
+            order_dict['delivery_address'] = json.loads(order_dict['delivery_address'])
+        except (TypeError, ValueError):
+            order_dict['delivery_address'] = {}
+
+    if order_dict.get('created_at'):
+        try:
+            dt = datetime.strptime(order_dict['created_at'], '%Y-%m-%d %H:%M:%S')
+            order_dict['created_at_formatted'] = dt.strftime('%d.%m.%Y %H:%M')
+        except ValueError:
+            order_dict['created_at_formatted'] = order_dict['created_at'][:16]
+
+    return order_dict
+
+
+def query_admin_orders(db, args, paged):
+    """Заказы для админки: (строки, next_cursor, updated_until, поля).
+
+    Обычно - от новых к старым по (created_at, id); с updated_since (токен updated_until или дата) -
+    измененные после этой позиции по (updated_at, id), чтобы админка догружала только изменения
+    """
+    fields = parse_admin_order_fields(args.get('fields'))
+    if fields is None:
+        columns = 'o.*, ' + ', '.join(f'{ADMIN_ORDER_FIELDS[field]} as {field}'
+                                      for field in ('assignment_status', 'courier_name', 'courier_phone',
+                                                    'promo_code', 'total_with_discount'))
+    else:
+        columns = ', '.join(f'{ADMIN_ORDER_FIELDS[field]} as {field}' for field in fields)
+
+    clauses, params = build_admin_orders_filters(args)
+
+    updated_since = args.get('updated_since')
+    head = None
+    if updated_since:
+        key, direction, comparison = 'o.updated_at', 'ASC', '>'
+        moment = parse_db_datetime(updated_since)
+        if moment is not None:
+            # Формат orders.updated_at - с миллисекундами, сравнение строковое
+            clauses.append('o.updated_at > ?')
+            params.append(moment.strftime('%Y-%m-%d %H:%M:%S.') + f'{moment.microsecond // 1000:03d}')
+        else:
+            # Токен updated_until из прошлого ответа: позиция (updated_at, id), чтобы не терять
+            # заказы с тем же updated_at, что у последней отданной строки
+            clauses.append('(o.updated_at, o.id) > (?, ?)')
+            params.extend(decode_orders_cursor(updated_since))
+    else:
+        key, direction, comparison = 'o.created_at', 'DESC', '<'
+        # Отметка для последующих запросов с updated_since; читается до страницы, поэтому
+        # изменения, попавшие между запросами, придут еще раз, но не потеряются
+        head = db.execute('SELECT updated_at, id FROM orders ORDER BY updated_at DESC, id DESC LIMIT 1').fetchone()
+
+    if paged:
+        limit = min(ADMIN_ORDERS_PAGE_MAX, max(1, int(args.get('limit') or ADMIN_ORDERS_PAGE_DEFAULT)))
+    else:
+        limit = ADMIN_ORDERS_LEGACY_LIMIT
+
+    if args.get('cursor'):
+        value, order_id = decode_orders_cursor(args['cursor'])
+        clauses.append(f'({key}, o.id) {comparison} (?, ?)')
+        params.extend([value, order_id])
+
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+    rows = db.execute(f'''
+                      SELECT {columns}, {key} as keyset_value
+                      {ADMIN_ORDERS_FROM_SQL}{where}
+                      ORDER BY {key} {direction}, o.id {direction}
+                      LIMIT ?
+                      ''', params + [limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_orders_cursor(rows[-1]['keyset_value'], rows[-1]['id'])
+
+    if updated_since:
+        updated_until = encode_orders_cursor(rows[-1]['keyset_value'], rows[-1]['id']) if rows else updated_since
+    else:
+        updated_until = encode_orders_cursor(head['updated_at'], head['id']) if head else None
+    return rows, next_cursor, updated_until, fields
+
+
 @app.route('/api/admin/orders', methods=['GET'])
 @rate_limit(max_requests=30)
 def api_admin_orders():
-    """API для админки - получение заказов"""
+    """API для админки - получение заказов.
+
+    Без limit/cursor/updated_since - последние 100 заказов списком, как раньше; с ними - страница
+    {items, next_cursor, has_more}. Фильтры (status, delivery_type, courier_id, date_from, date_to, q)
+    и проекция fields=id,status,... работают в обоих режимах
+    """
+    paged = any(name in request.args for name in ('limit', 'cursor', 'updated_since'))
     try:
         db = get_db()
 
-        orders = db.execute('''
-                            SELECT o.*,
-                                   a.status                                                                        as assignment_status,
-                                   c.full_name                                                                     as courier_name,
-                                   c.phone                                                                         as courier_phone,
-                                   pc.code                                                                         as promo_code,
-                                   (o.total_price + COALESCE(o.delivery_cost, 0) -
-                                    COALESCE(o.discount_amount, 0))                                                as total_with_discount
-                            FROM orders o
-                                     LEFT JOIN order_assignments a ON o.id = a.order_id
-                                     LEFT JOIN couriers c ON a.courier_id = c.id
-                                     LEFT JOIN promo_codes pc ON o.promo_code_id = pc.id
-                            ORDER BY o.created_at DESC LIMIT 100
-                            ''').fetchall()
+        rows, next_cursor, updated_until, fields = query_admin_orders(db, request.args, paged)
 
-        if not orders:
-            return jsonify([])
+        order_items = None
+        if rows and (fields is None or 'items' in fields):
+            order_items = load_order_items(db, rows)
 
         orders_list = []
-        for order in orders:
-            order_dict = dict(order)
-
-            try:
-                if order_dict.get('items'):
-                    order_dict['items'] = json.loads(order_dict['items'])
-                else:
-                    order_dict['items'] = []
-            except:
-                order_dict['items'] = []
-
-            if order_dict.get('delivery_address'):
-                try:
-                    order_dict['delivery_address'] = json.loads(order_dict['delivery_address'])
-                except:
-                    order_dict['delivery_address'] = {}
-
-            if order_dict.get('created_at'):
-                try:
-                    dt = datetime.strptime(order_dict['created_at'], '%Y-%m-%d %H:%M:%S')
-                    order_dict['created_at_formatted'] = dt.strftime('%d.%m.%Y %H:%M')
-                except:
-                    order_dict['created_at_formatted'] = order_dict['created_at'][:16]
-
+        for row in rows:
+            order_dict = serialize_admin_order(row, order_items[row['id']] if order_items is not None else None)
+            del order_dict['keyset_value']
             orders_list.append(order_dict)
 
-        return jsonify(orders_list)
+        if not paged:
+            return jsonify(orders_list)
+
+        page = {
+            'success': True,
+            'items': orders_list,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }
+        if updated_until is not None:
+            page['updated_until'] = updated_until
+        return jsonify(page)
 
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
+        if paged:
+            return jsonify({'success': False, 'error': str(e)}), 500
         return jsonify([])
     finally:
         if 'db' in locals():
@@ -5772,6 +9814,7 @@ def admin_manage_categories():
                 'INSERT INTO products (name, description, price, image_url, category, stock) VALUES (?, ?, ?, ?, ?, ?)',
                 (f'Товар категории {new_category}', f'Автоматически созданный товар', 1000,
                  'https://via.placeholder.com/300x200', new_category, 10))
+            bump_cache_version(db, 'catalog')
             db.commit()
             return jsonify({'success': True, 'message': f'Категория "{new_category}" создана'})
 
@@ -5781,6 +9824,7 @@ def admin_manage_categories():
                 return jsonify({'success': False, 'error': 'Не указана категория'}), 400
 
             db.execute('UPDATE products SET category = "" WHERE LOWER(category) = LOWER(?)', (category_name,))
+            bump_cache_version(db, 'catalog')
             db.commit()
             return jsonify({'success': True, 'message': f'Категория "{category_name}" удалена'})
     except Exception as e:
@@ -5791,13 +9835,14 @@ def admin_manage_categories():
 
 # ========== ДОПОЛНИТЕЛЬНЫЕ ЭНДПОИНТЫ ==========
 @app.route('/api/pickup-points', methods=['GET'])
+@http_cache('pickup_points')
 def get_pickup_points():
     db = get_db()
     try:
         points = db.execute('SELECT * FROM pickup_points WHERE is_active = 1 ORDER BY name').fetchall()
         return jsonify([dict(point) for point in points])
     except Exception as e:
-        return jsonify([])
+        return jsonify([]), 500
     finally:
         db.close()
 
@@ -5982,6 +10027,44 @@ def test():
     return jsonify({'status': 'OK', 'message': 'Сервер работает'})
 
 
+@app.route('/api/admin/telegram/stats', methods=['GET'])
+def api_telegram_client_stats():
+    """Задержка и ошибки вызовов Bot API по методам"""
+    return jsonify({'success': True, 'methods': telegram_client.stats()})
+
+
+@app.route('/api/admin/cache/catalog', methods=['GET'])
+def api_catalog_cache_stats():
+    """Попадания/промахи кэша каталога и время пересборки ответов"""
+    db = get_db()
+    try:
+        stats = catalog_cache.stats()
+        stats['catalog_version'] = get_cache_version(db, 'catalog')
+        stats['search'] = search_cache.stats()
+        stats['prices'] = product_price_scheduler.stats(db)
+        return jsonify({'success': True, 'cache': stats})
+    finally:
+        db.close()
+
+
+@app.route('/api/admin/inventory/reservations', methods=['GET'])
+def api_stock_reservation_stats():
+    """Списания остатков при оформлении, отказы по нехватке и повторы при занятой БД"""
+    return jsonify({'success': True, 'reservations': stock_reservations.stats()})
+
+
+@app.route('/api/admin/promo-codes/redemptions', methods=['GET'])
+def api_promo_redemption_stats():
+    """Списания промокодов, отказы по лимиту, повторы при конкуренции и негативный кэш"""
+    return jsonify({'success': True, 'redemptions': promo_redemptions.stats()})
+
+
+@app.route('/api/admin/db/pool', methods=['GET'])
+def api_db_pool_stats():
+    """Загрузка пула соединений и время ожидания"""
+    return jsonify({'success': True, 'pool': get_db_pool().stats()})
+
+
 @app.route('/api/upload-image', methods=['POST'])
 def upload_image():
     if 'image' not in request.files:
@@ -6074,6 +10157,7 @@ def admin_promo_code_detail(id):
                            id
                        ))
 
+            bump_cache_version(db, 'promo_codes')
             db.commit()
             return jsonify({'success': True})
 
@@ -6088,6 +10172,7 @@ def admin_promo_code_detail(id):
                     {'success': False, 'error': 'Нельзя удалить промокод, который уже использовался в заказах'}), 400
 
             db.execute('DELETE FROM promo_codes WHERE id = ?', (id,))
+            bump_cache_version(db, 'promo_codes')
             db.commit()
 
             return jsonify({'success': True})
@@ -6114,6 +10199,7 @@ def admin_promo_code_status_api(id):
             return jsonify({'success': False, 'error': 'Промокод не найден'}), 404
 
         db.execute('UPDATE promo_codes SET is_active = ? WHERE id = ?', (is_active, id))
+        bump_cache_version(db, 'promo_codes')
         db.commit()
 
         return jsonify({'success': True})
@@ -6132,36 +10218,7 @@ def admin_categories_tree_api():
     db = get_db()
     try:
         if request.method == 'GET':
-            categories = db.execute('''
-                                    SELECT pc.*,
-                                           d.name as discount_name
-                                    FROM product_categories pc
-                                             LEFT JOIN discounts d ON pc.discount_id = d.id
-                                    ORDER BY pc.sort_order, pc.name
-                                    ''').fetchall()
-
-            categories_dict = {}
-            root_categories = []
-
-            for cat in categories:
-                cat_dict = dict(cat)
-                cat_dict['children'] = []
-                product_count = db.execute(
-                    'SELECT COUNT(*) FROM products WHERE category = ? OR category_id = ?',
-                    (cat_dict['name'], cat_dict['id'])
-                ).fetchone()[0]
-                cat_dict['product_count'] = product_count
-                cat_dict['has_products'] = product_count > 0
-                categories_dict[cat_dict['id']] = cat_dict
-
-            for cat_id, cat in categories_dict.items():
-                if cat['parent_id']:
-                    if cat['parent_id'] in categories_dict:
-                        categories_dict[cat['parent_id']]['children'].append(cat)
-                else:
-                    root_categories.append(cat)
-
-            return jsonify(root_categories)
+            return jsonify(category_tree_cache.roots(db))
 
         elif request.method == 'POST':
             data = request.json
@@ -6196,6 +10253,7 @@ def admin_categories_tree_api():
                                 ))
 
             category_id = cursor.lastrowid
+            bump_cache_version(db, 'catalog')
             db.commit()
 
             return jsonify({'success': True, 'id': category_id})
@@ -6212,46 +10270,12 @@ def admin_category_tree_detail_api(id):
     db = get_db()
     try:
         if request.method == 'GET':
-            category = db.execute('''
-                                  SELECT pc.*,
-                                         d.name as discount_name
-                                  FROM product_categories pc
-                                           LEFT JOIN discounts d ON pc.discount_id = d.id
-                                  WHERE pc.id = ?
-                                  ''', (id,)).fetchone()
+            category = category_tree_cache.node(db, id)
 
             if not category:
                 return jsonify({'success': False, 'error': 'Категория не найдена'}), 404
 
-            category_dict = dict(category)
-            product_count = db.execute(
-                'SELECT COUNT(*) FROM products WHERE category = ? OR category_id = ?',
-                (category_dict['name'], id)
-            ).fetchone()[0]
-            category_dict['product_count'] = product_count
-            category_dict['has_products'] = product_count > 0
-
-            children = db.execute('''
-                                  SELECT pc.*,
-                                         d.name as discount_name
-                                  FROM product_categories pc
-                                           LEFT JOIN discounts d ON pc.discount_id = d.id
-                                  WHERE pc.parent_id = ?
-                                  ORDER BY pc.sort_order, pc.name
-                                  ''', (id,)).fetchall()
-
-            for child in children:
-                child_dict = dict(child)
-                child_product_count = db.execute(
-                    'SELECT COUNT(*) FROM products WHERE category = ? OR category_id = ?',
-                    (child_dict['name'], child_dict['id'])
-                ).fetchone()[0]
-                child_dict['product_count'] = child_product_count
-                child_dict['has_products'] = child_product_count > 0
-
-            category_dict['children'] = [dict(child) for child in children]
-
-            return jsonify(category_dict)
+            return jsonify(category)
 
         elif request.method == 'PUT':
             data = request.json
@@ -6298,19 +10322,16 @@ def admin_category_tree_detail_api(id):
                            id
                        ))
 
+            bump_cache_version(db, 'catalog')
             db.commit()
             return jsonify({'success': True})
 
         elif request.method == 'DELETE':
-            category = db.execute('SELECT id FROM product_categories WHERE id = ?', (id,)).fetchone()
+            category = category_tree_cache.node(db, id)
             if not category:
                 return jsonify({'success': False, 'error': 'Категория не найдена'}), 404
 
-            product_count = db.execute(
-                'SELECT COUNT(*) FROM products WHERE category = ? OR category_id = ?',
-                (category['name'], id)
-            ).fetchone()[0]
-            if product_count > 0:
+            if category['product_count'] > 0:
                 return jsonify({'success': False, 'error': 'Нельзя удалить категорию с товарами'}), 400
 
             children_count = db.execute(
@@ -6321,6 +10342,7 @@ def admin_category_tree_detail_api(id):
                 return jsonify({'success': False, 'error': 'Нельзя удалить категорию с подкатегориями'}), 400
 
             db.execute('DELETE FROM product_categories WHERE id = ?', (id,))
+            bump_cache_version(db, 'catalog')
             db.commit()
 
             return jsonify({'success': True})
@@ -6343,68 +10365,9 @@ def apply_discounts():
 
         db = get_db()
 
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        discounts = db.execute('''
-                               SELECT *
-                               FROM discounts
-                               WHERE is_active = 1
-                                 AND (start_date IS NULL OR start_date <= ?)
-                                 AND (end_date IS NULL OR end_date >= ?)
-                               ''', (now, now)).fetchall()
-
-        discounted_items = []
-        total_discount = 0
-        original_total = 0
-
-        for item in items:
-            product_id = item.get('id')
-            quantity = item.get('quantity', 1)
-            price = item.get('price', 0)
-
-            best_discount = None
-            best_discount_value = 0
-
-            for discount in discounts:
-                discount_dict = dict(discount)
-
-                applies = False
-
-                if discount_dict['apply_to'] == 'all':
-                    applies = True
-                elif discount_dict['apply_to'] == 'category':
-                    product = db.execute('SELECT category FROM products WHERE id = ?', (product_id,)).fetchone()
-                    if product and product['category'] == discount_dict['target_category']:
-                        applies = True
-                elif discount_dict['apply_to'] == 'product':
-                    if product_id == discount_dict['target_product_id']:
-                        applies = True
-
-                if applies:
-                    discount_value = 0
-                    if discount_dict['discount_type'] == 'percentage':
-                        discount_value = price * quantity * (discount_dict['value'] / 100)
-                    elif discount_dict['discount_type'] == 'fixed':
-                        discount_value = discount_dict['value'] * quantity
-
-                    if discount_value > best_discount_value:
-                        best_discount_value = discount_value
-                        best_discount = discount_dict
-
-            discounted_price = price - (best_discount_value / quantity) if best_discount_value > 0 else price
-            item_discount = best_discount_value
-
-            discounted_items.append({
-                'id': product_id,
-                'name': item.get('name'),
-                'original_price': price,
-                'discounted_price': discounted_price,
-                'quantity': quantity,
-                'discount': item_discount,
-                'discount_info': best_discount
-            })
-
-            total_discount += item_discount
-            original_total += price * quantity
+        discounted_items = discount_engine.resolve_cart(db, items)
+        total_discount = sum(item['discount'] for item in discounted_items)
+        original_total = sum(item['original_price'] * item['quantity'] for item in discounted_items)
 
         final_total = original_total - total_discount
 
@@ -6452,12 +10415,12 @@ def clear_failed_logins():
 
 def handle_order_completed_callback_webhook(call):
     """Обработка кнопки 'Заказ выдан' через вебхук"""
+    db = None
     try:
         order_id = int(call['data'].replace('order_completed_', ''))
 
         db = get_db()
-        db.execute('UPDATE orders SET status = ? WHERE id = ?',
-                   ('completed', order_id))
+        transition_order(db, order_id, 'completed', 'telegram')
         db.commit()
 
         order = db.execute('''
@@ -6471,31 +10434,26 @@ def handle_order_completed_callback_webhook(call):
         if order:
             telegram_id = order['user_id']
             if telegram_id:
-                BOT_TOKEN = os.getenv('BOT_TOKEN', '8325707242:AAHklanhfvOEUN9EaD9XyB4mB7AMPNZZnsM')
-                if BOT_TOKEN:
+                if telegram_client.token:
                     message = f"✅ *ЗАКАЗ #{order_id} ВЫДАН*\n\n" \
                               f"Ваш заказ был успешно выдан. Спасибо за покупку!\n\n" \
                               f"Если у вас есть вопросы, свяжитесь с нами."
 
-                    url = f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage'
-                    requests.post(url, json={
+                    telegram_client.call('sendMessage', {
                         'chat_id': int(telegram_id),
                         'text': message,
                         'parse_mode': 'Markdown'
                     }, timeout=5)
 
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
-        if BOT_TOKEN:
-            answer_url = f'https://api.telegram.org/bot{BOT_TOKEN}/answerCallbackQuery'
-            requests.post(answer_url, json={
+        if telegram_client.token:
+            telegram_client.call('answerCallbackQuery', {
                 'callback_query_id': call['id'],
                 'text': f'✅ Заказ #{order_id} помечен как выданный.',
                 'show_alert': True
             }, timeout=5)
 
             message = call['message']
-            edit_url = f'https://api.telegram.org/bot{BOT_TOKEN}/editMessageText'
-            requests.post(edit_url, json={
+            telegram_client.call('editMessageText', {
                 'chat_id': message['chat']['id'],
                 'message_id': message['message_id'],
                 'text': f"✅ *ЗАКАЗ #{order_id} ЗАВЕРШЕН*\n\nЗаказ был выдан клиенту.",
@@ -6506,32 +10464,32 @@ def handle_order_completed_callback_webhook(call):
 
     except Exception as e:
         return jsonify({'ok': False, 'error': str(e)})
+    finally:
+        if db:
+            db.close()
 
 
 def handle_order_ready_callback_webhook(call):
     """Обработка кнопки 'Заказ готов' через вебхук"""
+    db = None
     try:
         order_id = int(call['data'].replace('order_ready_', ''))
 
         db = get_db()
-        db.execute('UPDATE orders SET status = ? WHERE id = ?',
-                   ('ready_for_pickup', order_id))
+        transition_order(db, order_id, 'ready_for_pickup', 'telegram')
         db.commit()
 
         send_order_ready_notification(order_id)
 
-        BOT_TOKEN = os.getenv('BOT_TOKEN')
-        if BOT_TOKEN:
-            answer_url = f'https://api.telegram.org/bot{BOT_TOKEN}/answerCallbackQuery'
-            requests.post(answer_url, json={
+        if telegram_client.token:
+            telegram_client.call('answerCallbackQuery', {
                 'callback_query_id': call['id'],
                 'text': f'✅ Заказ #{order_id} помечен как готовый. Клиент уведомлен!',
                 'show_alert': True
             }, timeout=5)
 
             message = call['message']
-            edit_url = f'https://api.telegram.org/bot{BOT_TOKEN}/editMessageText'
-            requests.post(edit_url, json={
+            telegram_client.call('editMessageText', {
                 'chat_id': message['chat']['id'],
                 'message_id': message['message_id'],
                 'text': f"✅ *ЗАКАЗ #{order_id} ГОТОВ К ВЫДАЧЕ*\n\nКлиент получил уведомление о готовности заказа.\n\nНажмите '✅ ВЫДАН' когда клиент заберет заказ.",
@@ -6553,6 +10511,240 @@ def handle_order_ready_callback_webhook(call):
 
     except Exception as e:
         return jsonify({'ok': False, 'error': str(e)})
+    finally:
+        if db:
+            db.close()
+
+
+# ========== ОЧЕРЕДЬ УВЕДОМЛЕНИЙ (OUTBOX) ==========
+NOTIFICATION_PENDING = 0
+NOTIFICATION_SENT = 1
+NOTIFICATION_IN_FLIGHT = 2
+NOTIFICATION_FAILED = 3
+# Отправка не нужна или невозможна (NotificationSkipped) - задача закрыта без повторов
+NOTIFICATION_SKIPPED = 4
+
+
+def _notify_pickup_order(job):
+    return send_pickup_order_notification(telegram_id=job['telegram_id'], order_id=job['order_id'],
+                                          **job['payload'])
+
+
+def _notify_order_details(job):
+    return send_order_details_notification(telegram_id=job['telegram_id'], order_id=job['order_id'],
+                                           **job['payload'])
+
+
+NOTIFICATION_HANDLERS = {
+    'pickup_order': _notify_pickup_order,
+    'admin_pickup': lambda job: send_admin_pickup_notification(job['order_id']),
+    'order_details': _notify_order_details,
+    'admin_order': lambda job: send_admin_order_notification(job['order_id']),
+    'courier_order': lambda job: send_courier_order_notification(job['order_id']),
+}
+
+
+def enqueue_notification(db, kind, order_id, telegram_id=0, **payload):
+    """Поставить уведомление в outbox. Коммит делает вызывающий код вместе с заказом"""
+    now = time.time()
+    db.execute('''
+               INSERT INTO pending_notifications (telegram_id, order_id, status, kind, payload,
+                                                  attempts, enqueued_at, available_at, sent)
+               VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)
+               ''', (telegram_id or 0, order_id, payload.get('status', kind), kind,
+                     json.dumps(payload, ensure_ascii=False), now, now, NOTIFICATION_PENDING))
+
+
+class NotificationDispatcher:
+    """Фоновый воркер, доставляющий уведомления из outbox с повторами"""
+
+    def __init__(self, batch_size=20, poll_interval=1.0, max_attempts=6, retry_base=5.0,
+                 retry_max=600.0, stale_after=300.0):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.stale_after = stale_after
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._latencies = collections.deque(maxlen=1000)
+        self._counters = {'delivered': 0, 'retried': 0, 'failed': 0, 'skipped': 0}
+        # Выключается только в служебных командах (checkout-bench), чтобы не слать тестовые заказы в Telegram
+        self.enabled = True
+
+    def start(self):
+        if not self.enabled:
+            return
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='notification-dispatcher', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self.start()
+        self._event.set()
+
+    def _run(self):
+        while True:
+            try:
+                processed = self.dispatch_batch()
+            except Exception:
+                processed = 0
+            if not processed:
+                self._event.wait(self.poll_interval)
+                self._event.clear()
+
+    def _claim(self):
+        now = time.time()
+        db = get_db()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('''
+                       UPDATE pending_notifications
+                       SET sent = ?
+                       WHERE sent = ?
+                         AND claimed_at < ?
+                       ''', (NOTIFICATION_PENDING, NOTIFICATION_IN_FLIGHT, now - self.stale_after))
+            jobs = db.execute('''
+                              UPDATE pending_notifications
+                              SET sent       = ?,
+                                  claimed_at = ?,
+                                  attempts   = attempts + 1
+                              WHERE id IN (SELECT id
+                                           FROM pending_notifications
+                                           WHERE sent = ?
+                                             AND kind IS NOT NULL
+                                             AND available_at <= ?
+                                           ORDER BY available_at, id LIMIT ?)
+                              RETURNING id, kind, order_id, telegram_id, payload, attempts, enqueued_at
+                              ''', (NOTIFICATION_IN_FLIGHT, now, NOTIFICATION_PENDING, now,
+                                    self.batch_size)).fetchall()
+            db.commit()
+            return [dict(job) for job in jobs]
+        finally:
+            db.close()
+
+    def dispatch_batch(self):
+        """Взять пачку готовых к отправке задач и доставить их. Возвращает число задач"""
+        jobs = self._claim()
+        for job in jobs:
+            error = None
+            final_status = None
+            try:
+                job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+                handler = NOTIFICATION_HANDLERS.get(job['kind'])
+                if handler is None:
+                    error = f"Неизвестный тип уведомления: {job['kind']}"
+                    final_status = NOTIFICATION_FAILED
+                else:
+                    result = handler(job)
+                    if isinstance(result, NotificationSkipped):
+                        error = result.reason
+                        final_status = NOTIFICATION_SKIPPED
+                    elif not result:
+                        error = 'Telegram не принял сообщение'
+            except Exception as e:
+                error = str(e)
+            self._finish(job, error, final_status)
+        return len(jobs)
+
+    def _finish(self, job, error, final_status=None):
+        """final_status - исход, который повтор не изменит: задача закрывается сразу"""
+        now = time.time()
+        db = get_db()
+        try:
+            if error is None:
+                db.execute('UPDATE pending_notifications SET sent = ?, sent_at = ?, last_error = NULL WHERE id = ?',
+                           (NOTIFICATION_SENT, now, job['id']))
+                with self._lock:
+                    self._counters['delivered'] += 1
+                    if job['enqueued_at']:
+                        self._latencies.append(now - job['enqueued_at'])
+            elif final_status is not None or job['attempts'] >= self.max_attempts:
+                final_status = final_status if final_status is not None else NOTIFICATION_FAILED
+                db.execute('UPDATE pending_notifications SET sent = ?, last_error = ? WHERE id = ?',
+                           (final_status, error, job['id']))
+                with self._lock:
+                    self._counters['skipped' if final_status == NOTIFICATION_SKIPPED else 'failed'] += 1
+            else:
+                delay = min(self.retry_max, self.retry_base * (2 ** (job['attempts'] - 1)))
+                db.execute('''
+                           UPDATE pending_notifications
+                           SET sent         = ?,
+                               available_at = ?,
+                               last_error   = ?
+                           WHERE id = ?
+                           ''', (NOTIFICATION_PENDING, now + delay, error, job['id']))
+                with self._lock:
+                    self._counters['retried'] += 1
+            db.commit()
+        finally:
+            db.close()
+
+    def stats(self):
+        db = get_db()
+        try:
+            queue = db.execute('''
+                               SELECT COUNT(*)         as depth,
+                                      MIN(enqueued_at) as oldest
+                               FROM pending_notifications
+                               WHERE sent IN (?, ?)
+                                 AND kind IS NOT NULL
+                               ''', (NOTIFICATION_PENDING, NOTIFICATION_IN_FLIGHT)).fetchone()
+            failed = db.execute('SELECT COUNT(*) FROM pending_notifications WHERE sent = ?',
+                                (NOTIFICATION_FAILED,)).fetchone()[0]
+            skipped = db.execute('SELECT COUNT(*) FROM pending_notifications WHERE sent = ?',
+                                 (NOTIFICATION_SKIPPED,)).fetchone()[0]
+        finally:
+            db.close()
+
+        with self._lock:
+            latencies = sorted(self._latencies)
+            counters = dict(self._counters)
+
+        result = {
+            'queue_depth': queue['depth'],
+            'oldest_job_age_seconds': round(time.time() - queue['oldest'], 3) if queue['oldest'] else 0,
+            'failed_jobs': failed,
+            'skipped_jobs': skipped,
+            'dispatcher_alive': bool(self._thread and self._thread.is_alive() and self._pid == os.getpid()),
+            'worker': counters,
+            'delivery_latency_ms': None
+        }
+        if latencies:
+            result['delivery_latency_ms'] = {
+                'count': len(latencies),
+                'avg': round(sum(latencies) / len(latencies) * 1000, 1),
+                'p50': round(latencies[len(latencies) // 2] * 1000, 1),
+                'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1),
+                'max': round(latencies[-1] * 1000, 1)
+            }
+        return result
+
+
+notification_dispatcher = NotificationDispatcher()
+
+
+@app.before_request
+def start_notification_dispatcher():
+    # Поток стартует в каждом воркере gunicorn после fork, а не в мастере
+    notification_dispatcher.start()
+
+
+@app.route('/api/admin/notifications/outbox', methods=['GET'])
+def api_notification_outbox_stats():
+    """Глубина очереди уведомлений, возраст старейшей задачи и задержка доставки"""
+    try:
+        return jsonify({'success': True, 'outbox': notification_dispatcher.stats()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
 
 
 # ========== ЗАПУСК С БЕЗОПАСНОСТЬЮ ==========
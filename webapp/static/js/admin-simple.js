@@ -5,7 +5,10 @@ class AdminPanel {
     constructor() {
         this.currentPage = 'dashboard';
         this.products = [];
+        this.productsCursor = null;
         this.orders = [];
+        this.ordersCursor = null;
+        this.ordersUpdatedUntil = null;
         this.categories = [];
         this.selectedFile = null;
         this.uploadProgress = 0;
@@ -33,6 +36,38 @@ class AdminPanel {
         this.loadOrders();
         this.loadCategories();
         this.loadDashboardData();
+        this.connectEventStream();
+    }
+
+    // Живые обновления заказов и чатов; EventSource сам переподключается с Last-Event-ID
+    connectEventStream() {
+        if (!window.EventSource) return;
+
+        const stream = new EventSource('/api/stream/admin');
+        const refresh = () => {
+            clearTimeout(this.streamRefreshTimer);
+            this.streamRefreshTimer = setTimeout(() => {
+                if (this.currentPage === 'orders') {
+                    this.loadOrders();
+                } else if (this.currentPage === 'dashboard') {
+                    this.loadDashboardData();
+                }
+            }, 300);
+        };
+
+        stream.addEventListener('order-created', (event) => {
+            const data = JSON.parse(event.data);
+            this.showNotification(`🆕 Новый заказ #${data.order_id}`, 'info');
+            refresh();
+        });
+        stream.addEventListener('chat-message', (event) => {
+            const data = JSON.parse(event.data);
+            if (data.payload.sender_type !== 'admin') {
+                this.showNotification(`💬 Новое сообщение по заказу #${data.order_id}`, 'info');
+            }
+        });
+        ['status-changed', 'courier-assigned', 'order-updated']
+            .forEach(type => stream.addEventListener(type, refresh));
     }
 
     formatPrice(price) {
@@ -222,12 +257,16 @@ class AdminPanel {
         }
     }
 
-    async loadProducts() {
+    async loadProducts(append = false) {
         try {
             this.showLoading(true);
             console.log('📥 Загрузка товаров...');
 
-            const response = await fetch('/api/admin/products');
+            // Товары грузятся страницами по курсору (created_at, id)
+            const params = new URLSearchParams({ limit: 100 });
+            if (append && this.productsCursor) params.set('cursor', this.productsCursor);
+
+            const response = await fetch(`/api/admin/products?${params}`);
 
             if (!response.ok) {
                 throw new Error(`HTTP ${response.status}`);
@@ -236,8 +275,9 @@ class AdminPanel {
             const result = await response.json();
 
             if (result.success && Array.isArray(result.products)) {
-                this.products = result.products;
-                this.renderProducts(result.products);
+                this.productsCursor = result.next_cursor || null;
+                this.products = append ? this.products.concat(result.products) : result.products;
+                this.renderProducts(this.products);
             } else if (Array.isArray(result)) {
                 this.products = result;
                 this.renderProducts(result);
@@ -363,6 +403,18 @@ class AdminPanel {
                 `;
             });
 
+            if (this.productsCursor) {
+                html += `
+                    <tr>
+                        <td colspan="7" class="load-more-cell">
+                            <button class="btn btn-sm btn-outline" onclick="admin.loadProducts(true)">
+                                <i class="fas fa-chevron-down"></i> Показать еще
+                            </button>
+                        </td>
+                    </tr>
+                `;
+            }
+
             productsTableBody.innerHTML = html;
             console.log('✅ Таблица товаров отрендерена, строк:', products.length);
 
@@ -386,17 +438,62 @@ class AdminPanel {
         }
     }
 
+    async fetchOrdersPage(params) {
+        const response = await fetch(`/api/admin/orders?${params}`);
+        const page = await response.json();
+        if (!page.success) {
+            throw new Error(page.error || 'Ошибка загрузки');
+        }
+        return page;
+    }
+
+    mergeOrders(orders) {
+        const byId = new Map(this.orders.map(order => [order.id, order]));
+        orders.forEach(order => byId.set(order.id, order));
+        this.orders = Array.from(byId.values())
+            .sort((a, b) => (b.created_at || '').localeCompare(a.created_at || '') || b.id - a.id);
+    }
+
     async loadOrders() {
         try {
             console.log('📥 Загрузка заказов...');
 
-            const response = await fetch('/api/admin/orders');
-            const orders = await response.json();
+            if (!this.ordersUpdatedUntil) {
+                // Первая загрузка - свежая страница и отметка для последующих догрузок изменений
+                const page = await this.fetchOrdersPage(new URLSearchParams({ limit: 100 }));
+                this.orders = page.items;
+                this.ordersCursor = page.next_cursor || null;
+                this.ordersUpdatedUntil = page.updated_until || null;
+            } else {
+                // Дальше - только измененные заказы, все страницы по курсору
+                let cursor = null;
+                let page;
+                do {
+                    const params = new URLSearchParams({ updated_since: this.ordersUpdatedUntil, limit: 200 });
+                    if (cursor) params.set('cursor', cursor);
+                    page = await this.fetchOrdersPage(params);
+                    this.mergeOrders(page.items);
+                    cursor = page.next_cursor;
+                } while (page.has_more);
+                this.ordersUpdatedUntil = page.updated_until;
+            }
+
+            await this.renderOrders(this.orders);
 
-            console.log('📦 Получены заказы:', orders);
+        } catch (error) {
+            console.error('❌ Ошибка загрузки заказов:', error);
+            this.showNotification('❌ Не удалось загрузить заказы', 'error');
+        }
+    }
 
-            await this.renderOrders(orders);
+    async loadMoreOrders() {
+        if (!this.ordersCursor) return;
 
+        try {
+            const page = await this.fetchOrdersPage(new URLSearchParams({ limit: 100, cursor: this.ordersCursor }));
+            this.mergeOrders(page.items);
+            this.ordersCursor = page.next_cursor || null;
+            await this.renderOrders(this.orders);
         } catch (error) {
             console.error('❌ Ошибка загрузки заказов:', error);
             this.showNotification('❌ Не удалось загрузить заказы', 'error');
@@ -537,6 +634,18 @@ class AdminPanel {
                 `;
             });
 
+            if (this.ordersCursor) {
+                html += `
+                    <tr>
+                        <td colspan="7" class="load-more-cell">
+                            <button class="btn btn-sm btn-outline" onclick="admin.loadMoreOrders()">
+                                <i class="fas fa-chevron-down"></i> Показать еще
+                            </button>
+                        </td>
+                    </tr>
+                `;
+            }
+
             ordersTableBody.innerHTML = html;
             console.log('✅ Таблица заказов отрендерена, строк:', orders.length);
 
@@ -1,6 +1,8 @@
 // Telegram Shop - Полная версия
 console.log('🟢 Telegram Shop загружается...');
 
+const PRODUCTS_PAGE_SIZE = 40;
+
 function getTelegramParams() {
     try {
         const urlParams = new URLSearchParams(window.location.search);
@@ -50,6 +52,13 @@ class TelegramShop {
         };
         this.selectedWeight = 0.1;
         this.selectedWeightPrice = 0;
+        this.productCache = {};
+        this.productsCursor = null;
+        this.currentCategory = 'all';
+        // Ключ повторов оформления: живет, пока сервер не ответил на заказ
+        this.orderIdempotencyKey = null;
+        // Последний расчет сервера (/api/quote): суммы для экранов оформления и токен для заказа
+        this.quote = null;
         this.isInitialized = false;
 
         const params = getTelegramParams();
@@ -205,19 +214,23 @@ class TelegramShop {
 
     // ========== ТОВАРЫ И КАТЕГОРИИ ==========
 
-    async loadProducts(category = 'all') {
+    async loadProducts(category = 'all', append = false) {
         try {
             console.log(`📥 Загрузка товаров${category !== 'all' ? ` категории "${category}"` : ''}...`);
             this.showLoading(true);
 
-            const url = category !== 'all'
-                ? `/api/products?category=${encodeURIComponent(category)}`
-                : '/api/products';
+            // Товары приходят страницами по курсору; следующую страницу грузит кнопка "Показать еще"
+            const params = new URLSearchParams({ limit: PRODUCTS_PAGE_SIZE });
+            if (category !== 'all') params.set('category', category);
+            if (append && this.productsCursor) params.set('cursor', this.productsCursor);
 
-            const response = await fetch(url);
+            const response = await fetch(`/api/products?${params}`);
             if (!response.ok) throw new Error(`HTTP ${response.status}`);
 
-            this.products = await response.json();
+            const page = await response.json();
+            this.currentCategory = category;
+            this.productsCursor = page.next_cursor;
+            this.products = append ? this.products.concat(page.items) : page.items;
             console.log(`✅ Загружено ${this.products.length} товаров`);
             await this.applyDiscountsToProducts();
             this.renderProducts();
@@ -358,9 +371,21 @@ class TelegramShop {
         this.products.forEach(product => {
             html += this.createProductCard(product);
         });
+        if (this.productsCursor) {
+            html += `
+                <button class="load-more-products" onclick="shop.loadMoreProducts()">
+                    <i class="fas fa-chevron-down"></i> Показать еще
+                </button>
+            `;
+        }
         productsGrid.innerHTML = html;
     }
 
+    loadMoreProducts() {
+        if (!this.productsCursor) return;
+        this.loadProducts(this.currentCategory, true);
+    }
+
     createProductCard(product) {
         const inStock = product.stock > 0 || product.stock_weight > 0;
         const isWeightProduct = product.product_type === 'weight';
@@ -472,6 +497,39 @@ class TelegramShop {
 
     // ========== КОРЗИНА ==========
 
+    async fetchProductsBatch(ids) {
+        // Один запрос /api/products/batch вместо запроса на каждую позицию корзины
+        const uniqueIds = [...new Set(ids.map(id => parseInt(id)).filter(id => id > 0))];
+        if (uniqueIds.length === 0) return {};
+
+        const response = await fetch('/api/products/batch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ ids: uniqueIds })
+        });
+        const result = await response.json();
+        if (!result.success) throw new Error(result.error || 'Ошибка загрузки товаров');
+
+        const loadedAt = Date.now();
+        Object.values(result.products).forEach(product => {
+            this.productCache[product.id] = { product, loadedAt };
+        });
+        return result.products;
+    }
+
+    async getCartProduct(productId) {
+        // Данные товара из корзины; при промахе подгружаем сразу все товары корзины
+        const cached = this.productCache[productId];
+        if (cached && Date.now() - cached.loadedAt < 30000) {
+            return cached.product;
+        }
+
+        const ids = this.cart.map(item => item.original_product_id || item.id);
+        ids.push(productId);
+        const products = await this.fetchProductsBatch(ids);
+        return products[productId] || null;
+    }
+
     loadCart() {
         try {
             const cartData = localStorage.getItem('telegram_shop_cart');
@@ -658,10 +716,8 @@ class TelegramShop {
 
         try {
             // Получаем актуальную информацию о товаре
-            const response = await fetch(`/api/products/${item.original_product_id}`);
-            if (response.ok) {
-                const product = await response.json();
-
+            const product = await this.getCartProduct(item.original_product_id);
+            if (product) {
                 // Проверяем границы веса
                 const maxWeight = Math.min(
                     product.stock_weight || 5.0,
@@ -717,10 +773,8 @@ class TelegramShop {
 
         // Для обычных товаров проверяем наличие
         try {
-            const response = await fetch(`/api/products/${item.original_product_id}`);
-            if (response.ok) {
-                const product = await response.json();
-
+            const product = await this.getCartProduct(item.original_product_id);
+            if (product) {
                 // Проверяем наличие
                 const stock = product.stock || 0;
                 if (newQuantity > stock) {
@@ -781,10 +835,8 @@ class TelegramShop {
 
         try {
             // Получаем информацию о товаре
-            const response = await fetch(`/api/products/${item.original_product_id}`);
-            if (!response.ok) throw new Error('Товар не найден');
-
-            const product = await response.json();
+            const product = await this.getCartProduct(item.original_product_id);
+            if (!product) throw new Error('Товар не найден');
 
             // Создаем модальное окно для редактирования веса
             const modal = document.createElement('div');
@@ -973,10 +1025,19 @@ class TelegramShop {
 
         // Обновляем итоговую сумму
         cartTotal.textContent = `${this.formatPrice(discountedSubtotal)} ₽`;
+        this.refreshCartTotal(cartTotal);
 
         // Показываем кнопки
         this.showCartButtons();
     }
+
+    async refreshCartTotal(cartTotal) {
+        // Итог корзины по ценам сервера; расчет остается для экранов оформления
+        const quote = await this.ensureQuote(null);
+        if (quote && quote.key === this.quoteKey(this.quoteItems(), this.appliedPromoCode?.code || null, null)) {
+            cartTotal.textContent = `${this.formatPrice(quote.discounted_subtotal)} ₽`;
+        }
+    }
         // Выносим рендеринг в отдельный метод
     renderCartItems(cartItems, cartTotal) {
         console.log('🛒 Рендеринг корзины, товаров:', this.cart.length);
@@ -1320,13 +1381,18 @@ class TelegramShop {
             return;
         }
 
-        // Проверка доступности
+        // Проверка доступности: все товары корзины одним запросом
+        let products = {};
+        try {
+            products = await this.fetchProductsBatch(this.cart.map(item => item.original_product_id || item.id));
+        } catch (error) {
+            console.error(`Ошибка проверки товаров:`, error);
+        }
+
         for (const item of this.cart) {
             try {
-                const response = await fetch(`/api/products/${item.original_product_id || item.id}`);
-                if (response.ok) {
-                    const product = await response.json();
-
+                const product = products[parseInt(item.original_product_id || item.id)];
+                if (product) {
                     // Для обычных товаров
                     if (!item.is_weight) {
                         if (item.quantity > (product.stock || 0)) {
@@ -1363,23 +1429,14 @@ class TelegramShop {
         const cartOverlay = document.getElementById('cartOverlay');
         if (!cartOverlay) return;
 
-        const itemsTotal = this.cart.reduce((sum, item) => {
-            const priceToShow = item.discounted_price || item.price;
-            return sum + (priceToShow * item.quantity);
-        }, 0);
-
-        let deliveryCost = 0;
-        let deliveryMessage = 'Бесплатно';
-        const hasFreeDeliveryPromo = this.appliedPromoCode?.discount_type === 'free_delivery';
-
-        if (!hasFreeDeliveryPromo && itemsTotal < 1000) {
-            deliveryCost = 100;
-            deliveryMessage = '100 ₽';
-        }
-
-        const promoDiscount = this.appliedPromoCode ?
-            this.calculatePromoDiscount(itemsTotal, this.appliedPromoCode) : 0;
-        const finalTotal = itemsTotal + deliveryCost - promoDiscount;
+        // Пока способ не выбран, показываем итог с курьерской доставкой
+        const deliveryType = this.deliveryData.type || 'courier';
+        const totals = (await this.ensureQuote(deliveryType)) || this.estimateCartTotals(deliveryType);
+        const itemsTotal = totals.discounted_subtotal;
+        const promoDiscount = totals.promo_discount;
+        const deliveryCost = totals.delivery_cost;
+        const finalTotal = totals.total;
+        const courierFree = deliveryType !== 'courier' || deliveryCost === 0;
 
         cartOverlay.innerHTML = `
             <div class="cart-modal">
@@ -1438,8 +1495,8 @@ class TelegramShop {
                                             <div style="font-size: 13px; color: #666;">До двери, 30-60 мин</div>
                                         </div>
                                     </div>
-                                    <div style="font-weight: 600; color: ${hasFreeDeliveryPromo || itemsTotal >= 1000 ? '#28a745' : '#dc3545'};">
-                                        ${hasFreeDeliveryPromo || itemsTotal >= 1000 ? 'Бесплатно' : '100 ₽'}
+                                    <div style="font-weight: 600; color: ${courierFree ? '#28a745' : '#dc3545'};">
+                                        ${courierFree ? 'Бесплатно' : `${this.formatPrice(deliveryCost)} ₽`}
                                     </div>
                                 </div>
                             </div>
@@ -1475,8 +1532,8 @@ class TelegramShop {
 
                             <div style="display: flex; justify-content: space-between; margin-bottom: 12px;">
                                 <span style="color: #666;">Доставка:</span>
-                                <span style="color: ${hasFreeDeliveryPromo || itemsTotal >= 1000 || this.deliveryData.type === 'pickup' ? '#28a745' : '#dc3545'};">
-                                    ${hasFreeDeliveryPromo || itemsTotal >= 1000 || this.deliveryData.type === 'pickup' ? 'Бесплатно' : '100 ₽'}
+                                <span style="color: ${deliveryCost === 0 ? '#28a745' : '#dc3545'};">
+                                    ${deliveryCost === 0 ? 'Бесплатно' : `${this.formatPrice(deliveryCost)} ₽`}
                                 </span>
                             </div>
 
@@ -1812,28 +1869,28 @@ async editOrder(orderId) {
 
         try {
             this.showCompactPromoMessage('<i class="fas fa-spinner fa-spin"></i> Проверка...', 'loading');
-            const response = await fetch('/api/check-promo-code', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ code: code })
-            });
 
-            const result = await response.json();
-            if (result.success) {
-                const itemsTotal = this.cart.reduce((sum, item) => sum + ((item.discounted_price || item.price) * item.quantity), 0);
-                const promo = result.promo_code;
-
-                if (promo.min_order_amount > 0 && itemsTotal < promo.min_order_amount) {
-                    this.showCompactPromoMessage(`Минимум ${this.formatPrice(promo.min_order_amount)} ₽`, 'error');
-                    return;
-                }
-
-                this.appliedPromoCode = { ...promo, code: code };
-                this.showCompactPromoMessage('✅ Промокод применен!', 'success');
-                setTimeout(() => this.showDeliverySelection(), 800);
-            } else {
-                this.showCompactPromoMessage(`❌ ${result.error}`, 'error');
+            // Промокод проверяет тот же расчет, что покажет итог: минимальная сумма и скидка - с сервера
+            const deliveryType = this.deliveryData.type || 'courier';
+            const quote = await this.fetchQuote(this.quoteItems(), code, deliveryType);
+            if (!quote) {
+                this.showCompactPromoMessage('❌ Ошибка соединения', 'error');
+                return;
+            }
+            if (quote.promo_error || !quote.promo_code) {
+                this.showCompactPromoMessage(`❌ ${quote.promo_error || 'Промокод не найден'}`, 'error');
+                return;
             }
+
+            this.appliedPromoCode = {
+                id: quote.promo_code_id,
+                code: quote.promo_code,
+                discount_type: quote.promo_type,
+                value: quote.promo_value
+            };
+            this.quote = quote;
+            this.showCompactPromoMessage('✅ Промокод применен!', 'success');
+            setTimeout(() => this.showDeliverySelection(), 800);
         } catch (error) {
             console.error('❌ Ошибка:', error);
             this.showCompactPromoMessage('❌ Ошибка соединения', 'error');
@@ -2183,10 +2240,8 @@ async editOrder(orderId) {
 
         try {
             // Получаем информацию о товаре
-            const response = await fetch(`/api/products/${item.original_product_id}`);
-            if (!response.ok) throw new Error('Товар не найден');
-
-            const product = await response.json();
+            const product = await this.getCartProduct(item.original_product_id);
+            if (!product) throw new Error('Товар не найден');
 
             // Создаем модальное окно для редактирования веса
             const modal = document.createElement('div');
@@ -3436,32 +3491,14 @@ async editOrder(orderId) {
         const cartOverlay = document.getElementById('cartOverlay');
         if (!cartOverlay) return;
 
-        // Рассчитываем сумму с учетом скидок на товары
-        const subtotal = this.cart.reduce((sum, item) => sum + (item.price * item.quantity), 0);
-        const discountedSubtotal = this.cart.reduce((sum, item) => {
-            const priceToShow = item.discounted_price || item.price;
-            return sum + (priceToShow * item.quantity);
-        }, 0);
-        const itemsDiscount = subtotal - discountedSubtotal;
-
-        // Рассчитываем скидку по промокоду
-        const promoDiscount = this.appliedPromoCode ?
-            this.calculatePromoDiscount(discountedSubtotal, this.appliedPromoCode) : 0;
-
-        // Рассчитываем стоимость доставки
-        let deliveryCost = 0;
-        const hasFreeDeliveryPromo = this.appliedPromoCode?.discount_type === 'free_delivery';
-
-        if (this.deliveryData.type === 'courier') {
-            if (hasFreeDeliveryPromo) {
-                deliveryCost = 0;
-            } else if (discountedSubtotal < 1000) {
-                deliveryCost = 100;
-            }
-        }
-
-        // Итоговая сумма
-        const totalAmount = discountedSubtotal + deliveryCost - promoDiscount;
+        // Суммы считает сервер; этот же расчет (и его токен) уйдет в заказ
+        const quote = await this.ensureQuote();
+        const totals = quote || this.estimateCartTotals(this.deliveryData.type);
+        const subtotal = totals.subtotal;
+        const itemsDiscount = totals.items_discount;
+        const promoDiscount = totals.promo_discount;
+        const deliveryCost = totals.delivery_cost;
+        const totalAmount = totals.total;
 
         cartOverlay.innerHTML = `
             <div class="cart-modal">
@@ -3572,22 +3609,38 @@ async editOrder(orderId) {
     }
 
     calculateTotalAmount() {
-        const itemsTotal = this.cart.reduce((sum, item) => {
+        if (this.quote && this.quote.key === this.quoteKey(this.quoteItems(), this.appliedPromoCode?.code || null, this.deliveryData.type)) {
+            return this.quote.total;
+        }
+        return this.estimateCartTotals(this.deliveryData.type).total;
+    }
+
+    estimateCartTotals(deliveryType) {
+        // Оценка по ценам корзины - только если сервер недоступен; заказ все равно пересчитает сервер
+        const subtotal = this.cart.reduce((sum, item) => sum + (item.price * item.quantity), 0);
+        const discountedSubtotal = this.cart.reduce((sum, item) => {
             const priceToShow = item.discounted_price || item.price;
             return sum + (priceToShow * item.quantity);
         }, 0);
 
         const promoDiscount = this.appliedPromoCode ?
-            this.calculatePromoDiscount(itemsTotal, this.appliedPromoCode) : 0;
+            this.calculatePromoDiscount(discountedSubtotal, this.appliedPromoCode) : 0;
 
         let deliveryCost = 0;
         const hasFreeDeliveryPromo = this.appliedPromoCode?.discount_type === 'free_delivery';
 
-        if (this.deliveryData.type === 'courier' && !hasFreeDeliveryPromo && itemsTotal < 1000) {
+        if (deliveryType === 'courier' && !hasFreeDeliveryPromo && discountedSubtotal < 1000) {
             deliveryCost = 100;
         }
 
-        return itemsTotal + deliveryCost - promoDiscount;
+        return {
+            subtotal: subtotal,
+            items_discount: subtotal - discountedSubtotal,
+            discounted_subtotal: discountedSubtotal,
+            promo_discount: promoDiscount,
+            delivery_cost: deliveryCost,
+            total: discountedSubtotal + deliveryCost - promoDiscount
+        };
     }
 
     showCashPaymentModal(totalAmount) {
@@ -3836,6 +3889,72 @@ async editOrder(orderId) {
 
     // ========== СОЗДАНИЕ ЗАКАЗА ==========
 
+    quoteItems() {
+        return this.cart.map(item => ({
+            id: item.original_product_id || item.id,
+            name: item.name,
+            original_price: item.price,
+            price: item.discounted_price || item.price,
+            quantity: item.quantity,
+            weight: item.weight || null,
+            is_weight: item.is_weight || false,
+            discount_info: item.discount_info || null
+        }));
+    }
+
+    quoteKey(items, promoCode, deliveryType) {
+        return JSON.stringify([
+            items.map(item => [item.id, item.quantity, item.weight]),
+            promoCode || null,
+            deliveryType || null
+        ]);
+    }
+
+    async fetchQuote(items, promoCode = this.appliedPromoCode?.code || null, deliveryType = this.deliveryData.type) {
+        // Сервер считает корзину по своим ценам и подписывает расчет для /api/create-order
+        try {
+            const response = await fetch('/api/quote', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    items: items,
+                    promo_code: promoCode,
+                    delivery_type: deliveryType
+                })
+            });
+
+            const result = await response.json();
+            if (!result.success) return null;
+
+            // Токен обновляем заранее, чтобы не отправить заказ с истекающей подписью
+            const ttl = Math.max(0, (result.quote.expires_in || 0) - 30);
+            return {
+                ...result.quote,
+                token: result.quote_token,
+                key: this.quoteKey(items, promoCode, deliveryType),
+                expiresAt: Date.now() + ttl * 1000
+            };
+        } catch (error) {
+            console.error('❌ Ошибка расчета стоимости:', error);
+            return null;
+        }
+    }
+
+    async ensureQuote(deliveryType = this.deliveryData.type) {
+        // Пока корзина, промокод и доставка те же, а токен жив - используем расчет повторно
+        const items = this.quoteItems();
+        const promoCode = this.appliedPromoCode?.code || null;
+        const key = this.quoteKey(items, promoCode, deliveryType);
+
+        if (this.quote && this.quote.key === key && Date.now() < this.quote.expiresAt) {
+            return this.quote;
+        }
+
+        const quote = await this.fetchQuote(items, promoCode, deliveryType);
+        if (quote) this.quote = quote;
+        return quote;
+    }
+
     async createOrder(orderData) {
         if (this.userId && this.userId !== 0) {
             localStorage.setItem('telegram_user_id', this.userId);
@@ -3867,14 +3986,26 @@ async editOrder(orderId) {
 
         console.log('📦 Создание заказа с данными:', orderData);
 
+        // Повтор после обрыва сети идет с тем же ключом: сервер вернет уже созданный заказ
+        if (!this.orderIdempotencyKey) {
+            this.orderIdempotencyKey = window.crypto?.randomUUID
+                ? window.crypto.randomUUID()
+                : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+        }
+
         try {
             const response = await fetch('/api/create-order', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': this.orderIdempotencyKey
+                },
                 body: JSON.stringify(orderData)
             });
 
-            return await response.json();
+            const result = await response.json();
+            this.orderIdempotencyKey = null;
+            return result;
         } catch (error) {
             console.error('❌ Ошибка создания заказа:', error);
             throw error;
@@ -3885,43 +4016,13 @@ async editOrder(orderId) {
         try {
             console.log('🔍 Начинаем оформление заказа...');
 
-            // Рассчитываем суммы ПРАВИЛЬНО
-            const subtotal = this.cart.reduce((sum, item) => sum + (item.price * item.quantity), 0);
-            const discountedSubtotal = this.cart.reduce((sum, item) => {
-                const priceToShow = item.discounted_price || item.price;
-                return sum + (priceToShow * item.quantity);
-            }, 0);
-            const itemsDiscount = subtotal - discountedSubtotal;
-
-            let promoDiscount = 0;
-            let promoCodeApplied = false;
-
-            if (this.appliedPromoCode) {
-                promoDiscount = this.calculatePromoDiscount(discountedSubtotal, this.appliedPromoCode);
-                promoCodeApplied = true;
-                console.log(`🎟️ Промокод "${this.appliedPromoCode.code}": ${promoDiscount} руб, тип: ${this.appliedPromoCode.discount_type}`);
-            }
-
-            let deliveryCost = 0;
-            const hasFreeDeliveryPromo = this.appliedPromoCode?.discount_type === 'free_delivery';
-
-            if (!hasFreeDeliveryPromo && this.deliveryData.type === 'courier' && discountedSubtotal < 1000) {
-                deliveryCost = 100;
+            // Суммы берем из расчета, который уже показан на экране оплаты
+            const quote = await this.ensureQuote();
+            if (!quote) {
+                throw new Error('Не удалось рассчитать стоимость заказа');
             }
 
-            const totalWithDelivery = discountedSubtotal + deliveryCost - promoDiscount;
-
-            // ПРАВИЛЬНО подготавливаем items для сохранения
-            const orderItems = this.cart.map(item => ({
-                id: item.original_product_id || item.id,
-                name: item.name,
-                original_price: item.price,
-                price: item.discounted_price || item.price,
-                quantity: item.quantity,
-                weight: item.weight || null,
-                is_weight: item.is_weight || false,
-                discount_info: item.discount_info || null
-            }));
+            const orderItems = this.quoteItems();
 
             // 🚨 ИСПРАВЛЕНИЕ: Подготавливаем delivery_details С ВСЕМИ полями
             let deliveryDetails = null;
@@ -3960,13 +4061,13 @@ async editOrder(orderId) {
                 user_id: parseInt(this.userId) || 0,
                 username: this.username || 'Гость',
                 items: orderItems,
-                subtotal: subtotal,
-                items_discount: itemsDiscount,
-                discounted_subtotal: discountedSubtotal,
+                subtotal: quote.subtotal,
+                items_discount: quote.items_discount,
+                discounted_subtotal: quote.discounted_subtotal,
                 delivery_type: this.deliveryData.type,
                 // 🚨 ИСПРАВЛЕНИЕ: Отправляем ВЕСЬ адрес как JSON строку
                 delivery_address: deliveryDetails ? JSON.stringify(deliveryDetails) : '{}',
-                delivery_cost: deliveryCost,
+                delivery_cost: quote.delivery_cost,
                 pickup_point: this.deliveryData.pickup_point,
                 payment_method: this.deliveryData.payment_method || 'cash',
                 // 🚨 ДОБАВЛЯЕМ поля на верхнем уровне для гарантии:
@@ -3986,8 +4087,9 @@ async editOrder(orderId) {
                 cash_payment: this.deliveryData.cash_payment || null,
                 promo_code: this.appliedPromoCode?.code || null,
                 promo_code_id: this.appliedPromoCode?.id || null,
-                promo_discount: promoDiscount,
-                total: totalWithDelivery
+                promo_discount: quote.promo_discount,
+                total: quote.total,
+                quote_token: quote.token
             };
 
             console.log('📤 Отправка заказа на сервер:', JSON.stringify(orderData, null, 2));
@@ -3997,15 +4099,16 @@ async editOrder(orderId) {
             if (result.success) {
                 // СБРАСЫВАЕМ ПРОМОКОД ПОСЛЕ ОФОРМЛЕНИЯ
                 this.appliedPromoCode = null;
+                this.quote = null;
                 localStorage.removeItem('applied_promo_code');
                 // Показываем правильную сумму в подтверждении
                 this.showOrderConfirmation(
                     result.order_id,
-                    subtotal,
-                    itemsDiscount,
-                    deliveryCost,
-                    promoDiscount,
-                    totalWithDelivery
+                    quote.subtotal,
+                    quote.items_discount,
+                    quote.delivery_cost,
+                    quote.promo_discount,
+                    quote.total
                 );
 
                 this.cart = [];
@@ -4,6 +4,7 @@ class CourierApp {
         this.currentCourier = null;
         this.currentOrderId = null;
         this.currentPhoto = null;
+        this.eventSource = null;
 
         this.init();
     }
@@ -58,6 +59,36 @@ class CourierApp {
             if (infoEl) {
                 infoEl.textContent = `${this.currentCourier.full_name} • ${this.currentCourier.phone}`;
             }
+            this.connectEventStream();
+        }
+    }
+
+    // Живые обновления: сервер присылает события заказов, вместо ручного обновления списков
+    connectEventStream() {
+        if (this.eventSource || !window.EventSource || !this.currentCourier) return;
+
+        this.eventSource = new EventSource(`/api/stream/courier?courier_id=${this.currentCourier.id}`);
+        const refresh = (event) => {
+            const data = JSON.parse(event.data);
+            if (event.type === 'order-created') {
+                this.showNotification(`🆕 Новый заказ #${data.order_id}`, 'info');
+            }
+            clearTimeout(this.streamRefreshTimer);
+            this.streamRefreshTimer = setTimeout(() => {
+                this.loadOrders();
+                if (document.getElementById('availableSection')?.classList.contains('active')) {
+                    this.loadAvailableOrders();
+                }
+            }, 300);
+        };
+        ['order-created', 'status-changed', 'courier-assigned', 'order-updated', 'chat-message']
+            .forEach(type => this.eventSource.addEventListener(type, refresh));
+    }
+
+    disconnectEventStream() {
+        if (this.eventSource) {
+            this.eventSource.close();
+            this.eventSource = null;
         }
     }
 
@@ -463,9 +494,9 @@ class CourierApp {
         `;
     }
 
-    // Добавляем глобальную функцию для взятия заказа
-    async function takeOrder(orderId) {
-        if (!window.courierApp || !window.courierApp.currentCourier) {
+    // Взять заказ в доставку (кнопка в карточке вызывает глобальную takeOrder, см. конец файла)
+    async takeOrder(orderId) {
+        if (!this.currentCourier) {
             alert('Сначала войдите в систему');
             return;
         }
@@ -479,24 +510,24 @@ class CourierApp {
                     },
                     body: JSON.stringify({
                         order_id: orderId,
-                        courier_id: window.courierApp.currentCourier.id
+                        courier_id: this.currentCourier.id
                     })
                 });
 
                 const result = await response.json();
 
                 if (result.success) {
-                    window.courierApp.showNotification(`✅ Заказ #${orderId} взят в доставку!`, 'success');
+                    this.showNotification(`✅ Заказ #${orderId} взят в доставку!`, 'success');
 
                     // Перезагружаем списки заказов
-                    window.courierApp.loadAvailableOrders();
-                    window.courierApp.loadOrders();
+                    this.loadAvailableOrders();
+                    this.loadOrders();
                 } else {
                     throw new Error(result.error);
                 }
             } catch (error) {
                 console.error('Ошибка взятия заказа:', error);
-                window.courierApp.showNotification(`❌ ${error.message}`, 'error');
+                this.showNotification(`❌ ${error.message}`, 'error');
             }
         }
     }
@@ -558,6 +589,7 @@ class CourierApp {
     // Выход
     logout() {
         if (confirm('Вы уверены, что хотите выйти?')) {
+            this.disconnectEventStream();
             this.currentCourier = null;
             localStorage.removeItem('courier_session');
             this.showLogin();
@@ -1251,4 +1283,11 @@ class CourierApp {
 }
 
 // Экспортируем для глобального доступа
-window.CourierApp = CourierApp;
\ No newline at end of file
+window.CourierApp = CourierApp;
+window.takeOrder = window.takeOrder || ((orderId) => {
+    if (!window.courierApp) {
+        alert('Сначала войдите в систему');
+        return;
+    }
+    return window.courierApp.takeOrder(orderId);
+});
\ No newline at end of file